@@ -1,5 +1,6 @@
 from django.contrib import admin  # Django's admin interface
-from .models import Category, Cart, CartItem  # Our custom models
+from .models import Category, Cart, CartItem, MediaBlob, OutboundEmail  # Our custom models
+from django.utils import timezone  # Current time for retries
 
 @admin.register(Category)  # This makes Category model appear in admin panel
 class CategoryAdmin(admin.ModelAdmin):
@@ -18,3 +19,39 @@ class CartItemAdmin(admin.ModelAdmin):
     """Customize how items in carts appear in admin"""
     list_display = ('cart', 'item', 'quantity', 'added_at')  # Show cart, item, and quantity
     # This helps admins see what items users have saved in their carts
+
+@admin.register(OutboundEmail)  # Register the outgoing email queue in admin
+class OutboundEmailAdmin(admin.ModelAdmin):
+    """Let admins see what mail is waiting, sent or failed, and send failed mail again"""
+    list_display = ('subject', 'to', 'status', 'attempts', 'next_attempt_at', 'sent_at')  # Queue overview
+    list_filter = ('status',)  # Quickly find failed messages
+    search_fields = ('subject', 'to')  # Find mail sent to someone
+    # The message itself can't be edited: a queued password reset holds a live link, and must not be redirected
+    readonly_fields = ('subject', 'from_email', 'to', 'cc', 'bcc', 'reply_to', 'headers', 'body', 'html_body',
+                       'status', 'attempts', 'next_attempt_at', 'claim', 'last_error', 'created_at', 'sent_at')
+    actions = ['retry']
+
+    def get_exclude(self, request, obj=None):
+        if obj is not None and obj.status == OutboundEmail.SENT:
+            return ('body', 'html_body')  # Delivered: nobody needs to read its links again
+        return super().get_exclude(request, obj)
+
+    def get_readonly_fields(self, request, obj=None):
+        excluded = self.get_exclude(request, obj) or ()
+        return [field for field in super().get_readonly_fields(request, obj) if field not in excluded]
+
+    def has_add_permission(self, request):
+        return False  # Mail is queued by the site, never written by hand
+
+    @admin.action(description='Send again')
+    def retry(self, request, queryset):
+        """Put the selected messages back in the queue with a fresh set of attempts"""
+        count = queryset.update(status=OutboundEmail.QUEUED, attempts=0, claim=None, next_attempt_at=timezone.now())
+        self.message_user(request, f'{count} messages queued again.')
+
+@admin.register(MediaBlob)  # Register stored uploads in admin
+class MediaBlobAdmin(admin.ModelAdmin):
+    """Let admins see which stored files are shared and which are waiting to be deleted"""
+    list_display = ('name', 'refs', 'orphaned_at', 'created_at')  # File and how many rows use it
+    search_fields = ('name',)  # Find a file by its path
+    readonly_fields = ('name', 'refs', 'orphaned_at', 'created_at')  # Kept up to date by core/media.py
@@ -0,0 +1,225 @@
+"""Caching for rendered pages and template fragments.
+
+Every cache key includes the current version number of the data it depends on
+("items", "categories"). When an Item or Category is saved or deleted its
+signal bumps that version, so every stale entry is simply never looked up
+again and expires on its own; nothing has to find and delete keys.
+
+Hits and misses are counted per cache name (see `stats()` and the
+`cache_stats` management command).
+
+`conditional_response` lets browsers and CDNs revalidate a page they already
+have: it works out an ETag (and Last-Modified) from one small aggregate query
+and answers a matching If-None-Match / If-Modified-Since with an empty 304
+before the view, the page cache or any template runs.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import routers
+
+TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 600)  # Seconds a cached page or fragment lives
+
+ITEMS = 'items'  # Anything showing item listings
+CATEGORIES = 'categories'  # Anything showing category names or lists
+
+STATS_NAMES_KEY = 'cachestats:names'
+BUMPED_AT_KEY = 'cachever:bumped_at'
+
+
+def _version_key(namespace):
+    return f'cachever:{namespace}'
+
+
+def get_versions(namespaces):
+    """Current version of each namespace, starting one off if the cache lost it"""
+    keys = [_version_key(namespace) for namespace in namespaces]
+    versions = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        # A fresh, never-used number so entries from before the cache was cleared can't come back
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def bump(*namespaces):
+    """Invalidate everything cached under these namespaces"""
+    for namespace in namespaces:
+        try:
+            cache.incr(_version_key(namespace))
+        except ValueError:  # Not set yet; get_versions() will pick a new one
+            pass
+    cache.set(BUMPED_AT_KEY, time.time(), None)
+
+
+def _may_be_stale():
+    """Whether this request read from a replica that may not have the latest bumped change yet"""
+    if not routers.used_replica():
+        return False
+    window = routers.MAX_LAG + routers.CHECK_INTERVAL  # Lag can grow between health checks
+    return time.time() - cache.get(BUMPED_AT_KEY, 0) < window
+
+
+def make_key(name, namespaces, parts=()):
+    """Cache key for `name`, tied to the namespace versions and any varying parts"""
+    versions = '.'.join(str(version) for version in get_versions(namespaces))
+    digest = hashlib.md5('\x1f'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'cached:{name}:{versions}:{digest}'
+
+
+def record(name, hit):
+    """Count a hit or a miss for the cache called `name`"""
+    names = cache.get(STATS_NAMES_KEY, set())
+    if name not in names:
+        cache.set(STATS_NAMES_KEY, names | {name}, None)
+    key = f'cachestats:{name}:{"hits" if hit else "misses"}'
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:  # Evicted in between
+            cache.set(key, 1, None)
+
+
+def stats():
+    """{name: {'hits': n, 'misses': n}} for every cache that has been used"""
+    result = {}
+    for name in sorted(cache.get(STATS_NAMES_KEY, set())):
+        counts = cache.get_many([f'cachestats:{name}:hits', f'cachestats:{name}:misses'])
+        result[name] = {
+            'hits': counts.get(f'cachestats:{name}:hits', 0),
+            'misses': counts.get(f'cachestats:{name}:misses', 0),
+        }
+    return result
+
+
+def _cacheable_request(request):
+    """Only anonymous GETs with nothing personal on the page can share a cached copy"""
+    if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+        return False
+    # A guest with a session may have a cart, whose count is on every page
+    if settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return False
+    # Pending flash messages are shown once to this visitor only
+    storage = getattr(request, '_messages', None)
+    return not (storage and len(storage))
+
+
+def cache_response(name, namespaces, timeout=None):
+    """Cache a view's whole response for anonymous visitors
+
+    The key covers the path, query string and URL kwargs; `namespaces` lists
+    what data the page shows so saving that data invalidates it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable_request(request):
+                return view(request, *args, **kwargs)
+
+            key = make_key(name, namespaces, [
+                request.path, sorted(request.GET.lists()), sorted(kwargs.items()),
+            ])
+            cached = cache.get(key)
+            if cached is not None:
+                record(name, hit=True)
+                status, content_type, content = cached
+                return HttpResponse(content, status=status, content_type=content_type)
+
+            record(name, hit=False)
+            response = view(request, *args, **kwargs)
+            # Don't share pages that set cookies (e.g. a fresh CSRF token) or aren't plain successes
+            # nor pages read from a replica that may not have caught up with the change behind the bump
+            if (response.status_code == 200 and not response.streaming and not response.cookies
+                    and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE') and not _may_be_stale()):
+                cache.set(key, (response.status_code, response['Content-Type'], response.content),
+                          timeout or TIMEOUT)
+            return response
+        return wrapper
+    return decorator
+
+
+def freshness(queryset, field='updated_at'):
+    """(etag parts, last modified) for a set of rows, from one MAX/COUNT query without loading them
+
+    The newest `field` moves when a row is added or edited; the count moves when one is removed.
+    There is no last modified: removing a row (or one leaving the filter) doesn't move
+    the newest timestamp, so If-Modified-Since alone would get a stale 304. The ETag decides.
+    """
+    row = queryset.order_by().aggregate(changed=Max(field), count=Count('pk'))
+    return [row['changed'], row['count']], None
+
+
+def _viewer_parts(request):
+    """What base.html shows about the visitor: the account menu, navigation counts and CSRF token"""
+    from . import navigation
+    from .cart import SessionCart
+    user = request.user
+    parts = [request.META.get('CSRF_COOKIE', ''), *get_versions([CATEGORIES])]
+    if user.is_authenticated:
+        # The account menu also counts the user's own items
+        parts += [user.pk, user.username, navigation.cart_count(user), navigation.unread_count(user),
+                  *get_versions([ITEMS])]
+    elif settings.SESSION_COOKIE_NAME in request.COOKIES:
+        parts.append(SessionCart(request.session).count())
+    return parts
+
+
+def _etag(request, parts):
+    digest = hashlib.md5('\x1f'.join(str(part) for part in [request.get_full_path(), *parts]).encode())
+    return quote_etag(digest.hexdigest())
+
+
+def conditional_response(validators, page=True):
+    """Answer If-None-Match / If-Modified-Since with 304 without running the view
+
+    `validators(request, *args, **kwargs)` returns (parts, last_modified) - whatever
+    the response shows, read with a cheap query (see freshness()) - or None when
+    there is nothing to validate, e.g. for a 404. The ETag also covers the path
+    and query string, and for a `page` everything base.html shows about the visitor;
+    a page only gets Last-Modified when nothing on it is personal.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            storage = getattr(request, '_messages', None)
+            if page and storage and len(storage):
+                return view(request, *args, **kwargs)  # Flash messages are shown once; always render
+
+            validated = validators(request, *args, **kwargs)
+            if validated is None:
+                return view(request, *args, **kwargs)
+            parts, last_modified = validated
+            personal = request.user.is_authenticated or settings.SESSION_COOKIE_NAME in request.COOKIES
+            viewer = _viewer_parts(request) if page else []
+            etag = _etag(request, parts + viewer)
+            # The visitor's own counts on a page have no timestamp, so only the ETag can cover them
+            timestamp = int(last_modified.timestamp()) if last_modified and not (page and personal) else None
+
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if page and request.META.get('CSRF_COOKIE', '') != viewer[0]:
+                    etag = _etag(request, parts + _viewer_parts(request))  # Rendering issued a CSRF cookie
+            response['ETag'] = etag
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+            if personal or response.cookies:
+                patch_cache_control(response, private=True, no_cache=True)
+            else:
+                patch_cache_control(response, public=True, no_cache=True)  # Shared caches revalidate too
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,128 @@
+"""Shopping carts for logged-in users (database) and guests (session).
+
+Both kinds share one small interface: add(), remove(), count() and lines().
+Guests' carts live in their session only, so browsing never touches the cart
+tables; when a guest logs in their session cart is merged into their account.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum, Value, Window
+from django.db.models.functions import Coalesce
+
+from .models import Cart, CartItem
+
+SESSION_KEY = 'cart'  # request.session[SESSION_KEY] = {"<item id>": quantity}
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+
+class DatabaseCart:
+    """The cart of a logged-in user"""
+
+    def __init__(self, user):
+        self.user = user
+
+    def _cart(self):
+        # Cart.user is unique, so concurrent first clicks can't make two carts;
+        # get_or_create re-reads the winner's row if its own INSERT loses the race
+        cart, created = Cart.objects.get_or_create(user=self.user)
+        return cart
+
+    def add(self, item, quantity=1):
+        """Add `quantity` of an item, incrementing in SQL so concurrent clicks are all counted"""
+        cart = self._cart()
+        increment = {'quantity': F('quantity') + quantity}
+        if CartItem.objects.filter(cart=cart, item=item).update(**increment):
+            return
+        try:
+            with transaction.atomic():  # Savepoint, so a lost race doesn't break the outer transaction
+                CartItem.objects.create(cart=cart, item=item, quantity=quantity)
+        except IntegrityError:  # Another request inserted the row first; add to it instead
+            CartItem.objects.filter(cart=cart, item=item).update(**increment)
+
+    def remove(self, item_id):
+        """Take an item out of the cart; returns False if it wasn't there"""
+        deleted, _ = CartItem.objects.filter(cart__user=self.user, item_id=item_id).delete()
+        return bool(deleted)
+
+    def count(self):
+        return CartItem.objects.filter(cart__user=self.user).count()
+
+    def lines(self):
+        """(cart items with their items and line totals, cart total) from one joined query"""
+        line_total = ExpressionWrapper(F('quantity') * Coalesce('item__price', Value(Decimal('0'))),
+                                       output_field=MONEY)
+        cart_items = list(
+            CartItem.objects.filter(cart__user=self.user)
+            .select_related('item')
+            .annotate(line_total=line_total, cart_total=Window(Sum(line_total), output_field=MONEY))
+            .order_by('-added_at')
+        )
+        total = cart_items[0].cart_total if cart_items else Decimal('0')
+        return cart_items, total
+
+
+class SessionCart:
+    """The cart of a visitor who isn't logged in, kept in their session"""
+
+    def __init__(self, session):
+        self.session = session
+
+    @property
+    def data(self):
+        return self.session.get(SESSION_KEY, {})
+
+    def _save(self, data):
+        self.session[SESSION_KEY] = data  # Reassign so the session knows it changed
+
+    def add(self, item, quantity=1):
+        data = dict(self.data)
+        data[str(item.pk)] = data.get(str(item.pk), 0) + quantity
+        self._save(data)
+
+    def remove(self, item_id):
+        data = dict(self.data)
+        removed = data.pop(str(item_id), None) is not None
+        self._save(data)
+        return removed
+
+    def count(self):
+        return len(self.data)
+
+    def lines(self):
+        """Unsaved CartItems for display, from a single query on the items table"""
+        from items.models import Item  # items imports core, so import this lazily
+
+        quantities = {int(item_id): quantity for item_id, quantity in self.data.items()}
+        cart_items = []
+        for item in Item.objects.filter(pk__in=quantities, is_active=True):
+            cart_item = CartItem(item=item, quantity=quantities[item.pk])
+            cart_item.line_total = cart_item.quantity * (item.price or Decimal('0'))
+            cart_items.append(cart_item)
+        return cart_items, sum((cart_item.line_total for cart_item in cart_items), Decimal('0'))
+
+    def clear(self):
+        self.session.pop(SESSION_KEY, None)
+
+
+def get_cart(request):
+    """The right cart for whoever made this request"""
+    if request.user.is_authenticated:
+        return DatabaseCart(request.user)
+    return SessionCart(request.session)
+
+
+def merge_session_cart(request, user):
+    """Move a guest's session cart into their account when they log in"""
+    session_cart = SessionCart(request.session)
+    if not session_cart.data:
+        return
+    from items.models import Item
+
+    database_cart = DatabaseCart(user)
+    quantities = {int(item_id): quantity for item_id, quantity in session_cart.data.items()}
+    with transaction.atomic():
+        for item in Item.objects.filter(pk__in=quantities, is_active=True):
+            database_cart.add(item, quantities[item.pk])
+    session_cart.clear()
@@ -1,29 +1,25 @@
-from .models import Cart, CartItem, Category  # Our database models
-from items.models import Conversation, Message  # Messaging system models
+from functools import cache  # Remember a value after the first time it is worked out
+
+from . import navigation  # Cached navigation counters and category list
+from .cart import SessionCart  # Carts of visitors who aren't logged in
+
+
+def _lazy(func):
+    """Templates call callables when they read them, so this only runs if the page uses it (and only once)"""
+    return cache(func)
 
-def cart_count(request):
-    """This makes the cart item count available on every page"""
-    if request.user.is_authenticated:  # Only for logged-in users
-        # Get the user's cart, or create one if it doesn't exist
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        # Count how many different items are in their cart
-        count = CartItem.objects.filter(cart=cart).count()
-    else:
-        count = 0  # Guests don't have carts
-    return {'cart_count': count}  # This number will be available in all templates
-def categories(request):
-    """This makes all categories available for the navigation menu"""
-    categories = Category.objects.all()  # Get every category from database
-    return {'categories': categories}  # Categories will be in every page's navigation
 
-def unread_messages_count(request):
-    """This shows how many unread messages a user has"""
-    if request.user.is_authenticated:  # Only for logged-in users
-        # Count messages where user is participant, message is unread, and not sent by user
-        count = Message.objects.filter(
-            conversation__participants=request.user,  # User is in conversation
-            is_read=False  # Message hasn't been read yet
-        ).exclude(sender=request.user).count()  # Don't count user's own messages
+def navigation_context(request):
+    """Cart count, unread message count and categories for the navigation bar on every page"""
+    user = request.user
+    if user.is_authenticated:  # Only logged-in users have messages
+        cart_count = _lazy(lambda: navigation.cart_count(user))
+        unread_messages_count = _lazy(lambda: navigation.unread_count(user))
     else:
-        count = 0  # Guests don't have messages
-    return {'unread_messages_count': count}  # This count shows in the navigation
+        cart_count = _lazy(lambda: SessionCart(request.session).count())  # Guests' carts live in the session
+        unread_messages_count = 0  # Guests don't have messages
+    return {
+        'cart_count': cart_count,  # Shown next to the cart link
+        'unread_messages_count': unread_messages_count,  # Shown next to the messages link
+        'categories': _lazy(navigation.category_list),  # Categories dropdown and footer
+    }
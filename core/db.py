@@ -0,0 +1,77 @@
+"""Writing safely when many requests share one SQLite database.
+
+SQLite lets one connection write at a time. settings.DATABASES turns on WAL
+(readers never wait for the writer) and makes every atomic() block start with
+BEGIN IMMEDIATE, so a transaction queues for the write lock when it begins
+rather than failing with "database is locked" halfway through when it tries
+to upgrade from reading to writing. Each connection also waits up to
+OPTIONS['timeout'] seconds for that lock.
+
+Views that write wrap their writes in write_transaction() and use @retry_on_busy.
+Under a long burst the lock wait can still time out, and the decorator
+then runs the whole view again a few times, after a short random pause.
+That is safe because the failed attempt's transaction was rolled back.
+@write_view does both for short views that always write.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+
+from . import metrics
+
+BUSY_RETRIES = getattr(settings, 'DATABASE_BUSY_RETRIES', 3)  # Extra attempts after "database is locked"
+BUSY_RETRY_DELAY = getattr(settings, 'DATABASE_BUSY_RETRY_DELAY', 0.05)  # Seconds; doubles on each retry
+
+_write_lock = threading.Lock()  # One SQLite write transaction at a time per process
+
+
+def is_busy(error):
+    """Whether a database error means another connection held the lock for too long"""
+    message = str(error).lower()
+    return isinstance(error, OperationalError) and ('database is locked' in message or 'database is busy' in message
+                                                    or 'database table is locked' in message)
+
+
+def retry_on_busy(view):
+    """Run the view again (up to BUSY_RETRIES times, with jittered backoff) if the database was locked"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                return view(request, *args, **kwargs)
+            except OperationalError as error:
+                # Inside an outer transaction only the outermost caller can start over
+                if attempt == BUSY_RETRIES or not is_busy(error) or connection.in_atomic_block:
+                    raise
+            metrics.inc('db_busy_retries_total')
+            time.sleep(BUSY_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
+
+
+@contextmanager
+def write_transaction(using=DEFAULT_DB_ALIAS):
+    """atomic() for a block that writes; on SQLite, threads of this process take turns at the write lock
+
+    Waiting on a Python lock wakes the next writer as soon as the last one
+    commits, while SQLite's own busy handler polls with ever longer sleeps.
+    Other processes are still kept in order by the busy timeout.
+    """
+    outermost = not connections[using].in_atomic_block
+    lock = _write_lock if outermost and connections[using].vendor == 'sqlite' else nullcontext()
+    with lock, transaction.atomic(using=using):
+        yield
+
+
+def write_view(view):
+    """Run the whole view in one write transaction, retried if the database stays locked"""
+    @retry_on_busy
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with write_transaction():
+            return view(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,154 @@
+"""Resized, EXIF-free copies of uploaded images, made off the request thread.
+
+Uploads themselves lose their EXIF block (with it any GPS position), XMP and
+comments before they are stored, so the original at /media/ gives away no more
+than the copies; `manage.py strip_image_metadata` does the same for files
+stored before that.
+
+When an Item, Profile or Category gets a new image, its post_save receiver
+hands the file to a small thread pool (after the transaction commits). The
+worker writes a WebP and a JPEG copy at each width in IMAGE_VARIANT_WIDTHS
+next to MEDIA_ROOT/variants/, e.g.
+
+    items/bike.jpg -> variants/items/bike.jpg-320w.webp, variants/items/bike.jpg-320w.jpg, ...
+
+Templates use the `srcset` filter from image_tags to point browsers at them.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = tuple(sorted(getattr(settings, 'IMAGE_VARIANT_WIDTHS', (320, 640, 1024))))
+# WebP last: has_variants() checks for the final file written
+FORMATS = {'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+           'webp': ('WEBP', {'quality': 80, 'method': 4})}
+
+# Formats whose metadata is stripped from uploads, and how to write them again: JPEGs keep their
+# quantization tables so the picture barely changes
+STRIP_OPTIONS = {'JPEG': {'quality': 'keep', 'subsampling': 'keep'}, 'PNG': {'optimize': True},
+                 'WEBP': {'quality': 90}}
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+# Variants get predictable names so templates can build URLs without a lookup
+variant_storage = FileSystemStorage(
+    location=os.path.join(settings.MEDIA_ROOT, 'variants'),
+    base_url=settings.MEDIA_URL + 'variants/',
+)
+
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'IMAGE_WORKERS', 2),
+                               thread_name_prefix='image-variants')
+
+
+def variant_name(name, width, extension):
+    """Where the `width`-pixel `extension` copy of the stored file `name` lives"""
+    # The whole name, extension included, so bike.jpg and bike.png don't share copies
+    return f'{name}-{width}w.{extension}'
+
+
+def has_variants(name):
+    """True once every copy of `name` has been written (the largest WebP is written last)"""
+    return variant_storage.exists(variant_name(name, WIDTHS[-1], 'webp'))
+
+
+def variant_urls(name, extension='webp'):
+    """[(url, width), ...] for the copies of `name`"""
+    return [(variant_storage.url(variant_name(name, width, extension)), width) for width in WIDTHS]
+
+
+def delete_variants(name):
+    """Remove every resized copy of `name` (when the original is deleted)"""
+    for width in WIDTHS:
+        for extension in FORMATS:
+            variant_storage.delete(variant_name(name, width, extension))
+
+
+def generate_variants(storage, name):
+    """Write every resized copy of one stored image; safe to run again"""
+    with storage.open(name, 'rb') as source:
+        original = Image.open(source)
+        original.load()
+    # Apply the camera's rotation before the EXIF block (with it GPS data etc.) is dropped
+    image = ImageOps.exif_transpose(original)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    # Largest last, so has_variants() only turns true when everything is there
+    for width in WIDTHS:
+        resized = image.copy()
+        resized.thumbnail((width, width * 10), Image.LANCZOS)  # Never upscales
+        for extension, (image_format, options) in FORMATS.items():
+            frame = resized.convert('RGB') if image_format == 'JPEG' else resized
+            buffer = BytesIO()
+            frame.save(buffer, image_format, **options)  # No exif= argument, so no metadata
+            target = variant_name(name, width, extension)
+            variant_storage.delete(target)  # Keep the predictable name instead of getting a suffix
+            variant_storage.save(target, ContentFile(buffer.getvalue()))
+
+
+def strip_metadata(content):
+    """The image in the file `content` without EXIF, XMP or comments, as bytes; None if there is nothing to strip"""
+    content.seek(0)
+    try:
+        image = Image.open(content)
+        image_format = 'JPEG' if image.format == 'MPO' else image.format  # Phone photos often open as MPO
+        if image_format not in STRIP_OPTIONS:
+            return None
+        if not any(key in image.info for key in METADATA_KEYS) and not getattr(image, 'text', None):
+            return None  # Nothing to hide, so store the bytes as they came
+        animated = image_format != 'JPEG' and getattr(image, 'n_frames', 1) > 1
+        if not animated:
+            ImageOps.exif_transpose(image, in_place=True)  # The rotation tag goes with the EXIF block
+        image.info.pop('comment', None)  # The JPEG writer copies it over otherwise
+        buffer = BytesIO()
+        image.save(buffer, image_format, save_all=animated, icc_profile=image.info.get('icc_profile'),
+                   **STRIP_OPTIONS[image_format])  # No exif= or xmp= argument, so no metadata
+        return buffer.getvalue()
+    except Exception:
+        logger.warning('Could not strip metadata from %s', getattr(content, 'name', content), exc_info=True)
+        return None
+    finally:
+        content.seek(0)
+
+
+def _generate_safely(storage, name):
+    try:
+        generate_variants(storage, name)
+    except Exception:
+        logger.exception('Could not make image variants for %s', name)
+
+
+def schedule_variants(field_file):
+    """Queue variant generation for an uploaded file once the current transaction commits"""
+    if not field_file:
+        return
+    storage, name = field_file.storage, field_file.name
+    transaction.on_commit(lambda: _executor.submit(_generate_safely, storage, name))
+
+
+def note_new_uploads(instance, *field_names):
+    """pre_save helper: strip the metadata from files about to be uploaded, and remember which fields hold one"""
+    instance._new_image_uploads = [
+        field_name for field_name in field_names
+        if (field_file := getattr(instance, field_name)) and not field_file._committed
+    ]
+    for field_name in instance._new_image_uploads:
+        field_file = getattr(instance, field_name)
+        stripped = strip_metadata(field_file.file)
+        if stripped is not None:
+            field_file.file = ContentFile(stripped, name=field_file.name)  # What FileField.pre_save stores
+
+
+def process_new_uploads(instance):
+    """post_save helper: queue variants for the files note_new_uploads() spotted"""
+    for field_name in getattr(instance, '_new_image_uploads', ()):
+        schedule_variants(getattr(instance, field_name))
+    instance._new_image_uploads = []
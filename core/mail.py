@@ -0,0 +1,166 @@
+"""Outbound email through a queue table, so no request ever waits on the mail server.
+
+With EMAIL_BACKEND = 'core.mail.QueuedEmailBackend', send_mail() and friends
+only store the message as an OutboundEmail row (in the caller's transaction,
+so mail about something that was rolled back is never sent). The
+send_queued_email command delivers them in batches through
+EMAIL_QUEUE_DELIVERY_BACKEND - normally Django's SMTP backend - over one
+connection per batch.
+
+A message that fails with a temporary error is tried again later, waiting
+twice as long each time; one the server rejects outright, or that keeps
+failing for EMAIL_QUEUE_MAX_ATTEMPTS tries, is marked failed and shown in
+the admin.
+
+For development, point EMAIL_HOST/EMAIL_PORT at a local SMTP stand-in that
+prints what it receives, e.g. `python -m aiosmtpd -n -l localhost:1025`.
+"""
+import random
+import smtplib
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .db import write_transaction
+
+DELIVERY_BACKEND = getattr(settings, 'EMAIL_QUEUE_DELIVERY_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+BATCH_SIZE = getattr(settings, 'EMAIL_QUEUE_BATCH_SIZE', 100)  # Messages sent over one connection
+MAX_ATTEMPTS = getattr(settings, 'EMAIL_QUEUE_MAX_ATTEMPTS', 8)  # Then the message is marked failed
+RETRY_DELAY = getattr(settings, 'EMAIL_QUEUE_RETRY_DELAY', 30)  # Seconds before the first retry; doubles each time
+MAX_RETRY_DELAY = getattr(settings, 'EMAIL_QUEUE_MAX_RETRY_DELAY', 3600)
+LEASE = timedelta(minutes=5)  # A claimed message goes back in the queue if its worker dies
+# Sent messages can hold live links (password resets), so they are deleted soon after sending
+KEEP_SENT_HOURS = getattr(settings, 'EMAIL_QUEUE_KEEP_SENT_HOURS', 24)
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """Email backend that stores messages for send_queued_email instead of sending them"""
+
+    def send_messages(self, email_messages):
+        from .models import OutboundEmail
+        rows = []
+        for message in email_messages:
+            if message.attachments:
+                raise ValueError('Queued email does not support attachments.')
+            if not message.recipients():
+                continue
+            html = next((content for content, mimetype in getattr(message, 'alternatives', [])
+                         if mimetype == 'text/html'), '')
+            rows.append(OutboundEmail(
+                subject=message.subject, body=message.body, html_body=html,
+                from_email=message.from_email or settings.DEFAULT_FROM_EMAIL,
+                to=list(message.to), cc=list(message.cc), bcc=list(message.bcc),
+                reply_to=list(message.reply_to), headers=dict(message.extra_headers),
+            ))
+        try:
+            OutboundEmail.objects.bulk_create(rows)
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
+        return len(rows)
+
+
+def _message(row):
+    message = EmailMultiAlternatives(
+        subject=row.subject, body=row.body, from_email=row.from_email, to=row.to, cc=row.cc,
+        bcc=row.bcc, reply_to=row.reply_to, headers=row.headers,
+    )
+    if row.html_body:
+        message.attach_alternative(row.html_body, 'text/html')
+    return message
+
+
+def is_permanent(error):
+    """Whether the server refused the message itself (5xx), so trying again can't help"""
+    if not isinstance(error, OSError):
+        return True  # Not a delivery problem (smtplib's errors are OSErrors too): the message itself is bad
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    code = getattr(error, 'smtp_code', None)
+    return isinstance(error, smtplib.SMTPResponseException) and code is not None and code >= 500
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the given number of failed attempts, with jitter so retries spread out"""
+    delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim(batch_size=BATCH_SIZE):
+    """Take up to `batch_size` due messages for this worker; several workers never get the same one"""
+    from .models import OutboundEmail
+    now = timezone.now()
+    due = OutboundEmail.objects.filter(status=OutboundEmail.QUEUED, next_attempt_at__lte=now)
+    token = uuid.uuid4().hex
+    # One transaction on the primary, so the read-back sees the claim even with replicas configured
+    with write_transaction():
+        ids = list(due.order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+        # The update only takes rows still due, so a row another worker just claimed is skipped
+        due.filter(id__in=ids).update(claim=token, next_attempt_at=now + LEASE, attempts=F('attempts') + 1)
+        return list(OutboundEmail.objects.filter(claim=token).order_by('id'))
+
+
+def _record_failure(row, error):
+    from .models import OutboundEmail
+    row.last_error = f'{type(error).__name__}: {error}'[:1000]
+    if is_permanent(error) or row.attempts >= MAX_ATTEMPTS:
+        row.status = OutboundEmail.FAILED
+        metrics.inc('emails_total', result='failed')
+    else:
+        row.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(row.attempts))
+        metrics.inc('emails_total', result='retried')
+    row.claim = None
+    row.save(update_fields=['status', 'next_attempt_at', 'last_error', 'claim'])
+
+
+def send_batch(batch_size=BATCH_SIZE):
+    """Send one batch of due messages over a single connection; returns (sent, failed)"""
+    from .models import OutboundEmail
+    rows = claim(batch_size)
+    if not rows:
+        return 0, 0
+
+    sent_ids, failed = [], 0
+    connection = get_connection(DELIVERY_BACKEND)
+    try:
+        for index, row in enumerate(rows):
+            try:
+                connection.open()  # No-op while the connection is up; reconnects after a drop
+                connection.send_messages([_message(row)])
+            except Exception as error:  # Whatever went wrong, it must not stop the rest of the batch
+                _record_failure(row, error)
+                failed += 1
+                if isinstance(error, smtplib.SMTPServerDisconnected):
+                    connection.close()  # Reconnect for the next message
+                elif isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException):
+                    # Can't reach the server at all; hand the rest back untried for the next run
+                    OutboundEmail.objects.filter(id__in=[other.id for other in rows[index + 1:]]).update(
+                        claim=None, next_attempt_at=timezone.now(), attempts=F('attempts') - 1)
+                    break
+            else:
+                sent_ids.append(row.id)
+    finally:
+        try:
+            connection.close()
+        finally:
+            # Even if the run dies part way, what the server accepted must never be sent twice
+            OutboundEmail.objects.filter(id__in=sent_ids).update(
+                status=OutboundEmail.SENT, sent_at=timezone.now(), claim=None, last_error='')
+
+    if sent_ids:
+        metrics.inc('emails_total', len(sent_ids), result='sent')
+    return len(sent_ids), failed
+
+
+def purge_sent(hours=KEEP_SENT_HOURS):
+    """Delete messages sent more than `hours` hours ago; returns how many"""
+    from .models import OutboundEmail
+    cutoff = timezone.now() - timedelta(hours=hours)
+    return OutboundEmail.objects.filter(status=OutboundEmail.SENT, sent_at__lt=cutoff).delete()[0]
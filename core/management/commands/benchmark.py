@@ -0,0 +1,363 @@
+import json
+import logging
+import platform
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, build_opener
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Max
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils.crypto import get_random_string
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from core.models import Category
+from items.models import ConversationReadState, Item, Message
+
+NAMESPACES = ('core', 'users', 'items')  # Every route of these apps needs a scenario below
+
+
+class Sample:
+    """Real ids for one benchmark user, so each request hits a different, valid object"""
+
+    def __init__(self, user, rng, size=50):
+        self.user = user
+        self.rng = rng
+        self.items = list(Item.objects.filter(is_active=True).order_by('-id').values_list('id', flat=True)[:1000])
+        self.own_items = list(user.items.values_list('id', flat=True)[:size]) or self.items
+        self.others_items = [pk for pk in self.items if pk not in set(self.own_items)] or self.items
+        self.categories = list(Category.objects.values_list('id', flat=True)) or [0]
+        self.conversations = list(
+            ConversationReadState.objects.filter(user=user).order_by('-last_message_at')
+            .annotate(latest=Max('conversation__messages__id')).values_list('conversation_id', 'latest')[:size])
+        self.chats = [pair for pair in self.conversations if pair[1]] or self.conversations
+        self.incoming = list(Message.objects.filter(conversation__participants=user).exclude(sender=user)
+                             .order_by('-id').values_list('id', flat=True)[:size])
+
+    def pick(self, values):
+        return self.rng.choice(values) if values else 0
+
+    def reset_link(self):
+        """uidb64 and token for a password reset; made fresh because logging in invalidates old tokens"""
+        user = User.objects.get(pk=self.user.pk)
+        return urlsafe_base64_encode(force_bytes(user.pk)), default_token_generator.make_token(user)
+
+    def conversation(self, with_messages=False):
+        return self.pick(self.chats if with_messages else self.conversations) or (0, 0)
+
+
+def _conversation_path(name, suffix=''):
+    return lambda s: reverse(name, args=[s.conversation()[0]]) + suffix
+
+
+def _since_latest(s):
+    # One message behind the newest, so the long poll answers straight away
+    conversation_id, latest = s.conversation(with_messages=True)
+    return reverse('items:wait_messages', args=[conversation_id]) + f'?since={max((latest or 1) - 1, 0)}'
+
+
+def _read_up_to_latest(s):
+    # What chat.js posts as messages scroll into view; repeats of an already read id change nothing
+    conversation_id, latest = s.conversation(with_messages=True)
+    return reverse('items:mark_read', args=[conversation_id]), {'up_to': latest or 0}
+
+
+# route name -> (method, logged in?, path builder); writes only run with --writes.
+# A builder returns the path, or (path, form data) for a POST that needs a body
+SCENARIOS = {
+    'core:home': ('GET', False, lambda s: reverse('core:home')),
+    'core:about': ('GET', False, lambda s: reverse('core:about')),
+    'core:contact': ('GET', False, lambda s: reverse('core:contact')),
+    'users:register': ('GET', False, lambda s: reverse('users:register')),
+    'users:login': ('GET', False, lambda s: reverse('users:login')),
+    'users:logout': ('GET', True, lambda s: reverse('users:logout')),
+    'users:profile': ('GET', True, lambda s: reverse('users:profile')),
+    'users:change_password': ('GET', True, lambda s: reverse('users:change_password')),
+    'users:delete_account': ('GET', True, lambda s: reverse('users:delete_account')),  # Confirmation page only
+    'users:password_reset_request': ('GET', False, lambda s: reverse('users:password_reset_request')),
+    'users:password_reset_confirm': ('GET', False, lambda s: reverse('users:password_reset_confirm',
+                                                                     args=s.reset_link())),
+    'users:password_reset_done': ('GET', False, lambda s: reverse('users:password_reset_done')),
+    'items:item_list': ('GET', False, lambda s: reverse('items:item_list') + s.pick([
+        '', '?sort=price_low_high', f'?category={s.pick(s.categories)}', '?type=rent', '?search=lamp',
+        '?near=Dhaka', '?near=Sylhet&radius=25'])),
+    'items:item_list_json': ('GET', False, lambda s: reverse('items:item_list_json') + s.pick(
+        ['', '?sort=newest', '?search=chair'])),
+    'items:item_facets': ('GET', False, lambda s: reverse('items:item_facets') + s.pick(
+        ['', '?type=rent', f'?category={s.pick(s.categories)}&condition=good', '?search=lamp'])),
+    'items:my_items': ('GET', True, lambda s: reverse('items:my_items')),
+    'items:item_create': ('GET', True, lambda s: reverse('items:item_create')),
+    'items:item_detail': ('GET', False, lambda s: reverse('items:item_detail', args=[s.pick(s.items)])),
+    'items:item_update': ('GET', True, lambda s: reverse('items:item_update', args=[s.pick(s.own_items)])),
+    'items:item_delete': ('GET', True, lambda s: reverse('items:item_delete', args=[s.pick(s.own_items)])),
+    'items:cart': ('GET', True, lambda s: reverse('items:cart')),
+    'items:add_to_cart': ('POST', True, lambda s: reverse('items:add_to_cart', args=[s.pick(s.items)])),
+    'items:remove_from_cart': ('POST', True, lambda s: reverse('items:remove_from_cart',
+                                                               args=[s.pick(s.items)])),
+    'items:conversations': ('GET', True, lambda s: reverse('items:conversations')),
+    'items:conversation_detail': ('GET', True, _conversation_path('items:conversation_detail')),
+    'items:get_messages': ('GET', True, _conversation_path('items:get_messages')),
+    'items:wait_messages': ('GET', True, _since_latest),
+    'items:start_conversation': ('POST', True, lambda s: reverse('items:start_conversation',
+                                                                 args=[s.pick(s.others_items)])),
+    'items:mark_read': ('POST', True, _read_up_to_latest),
+    'items:mark_message_read': ('POST', True, lambda s: reverse('items:mark_message_read',
+                                                                args=[s.pick(s.incoming)])),
+    'items:delete_conversation': ('GET', True, _conversation_path('items:delete_conversation')),
+}
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def summarize(latencies, queries, statuses, wall_time):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': sum(count for status, count in statuses.items() if status >= 500 or status == 0),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'p50_ms': ms(percentile(ordered, 0.50)),
+        'p95_ms': ms(percentile(ordered, 0.95)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'max_ms': ms(ordered[-1]) if ordered else None,
+        'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+        'queries_max': max(queries) if queries else None,
+        'throughput_rps': round(len(ordered) / wall_time, 1) if wall_time else None,
+    }
+
+
+class TestClientWorker:
+    """Drives the app in-process through Django's test client, counting queries per request"""
+
+    def __init__(self, user):
+        # Outside the test runner 'testserver' is not an allowed host, so pose as one that is
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        self.user = user
+        self.client = Client(raise_request_exception=False, SERVER_NAME=host)
+        self.client.force_login(user)
+        self.anonymous = Client(raise_request_exception=False, SERVER_NAME=host)
+
+    def request(self, method, path, logged_in, data=None):
+        client = self.client if logged_in else self.anonymous
+        body = urlencode(data or {})
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = client.generic(method, path, body, content_type='application/x-www-form-urlencoded')
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - started
+        if path == reverse('users:logout'):
+            self.client.force_login(self.user)
+        return elapsed, len(queries), response.status_code
+
+
+class ServerWorker:
+    """Drives a running server over HTTP; query counts are not visible from outside
+
+    The server must share this database (and session store): the worker signs
+    in by creating a session directly, the way the test client's force_login does.
+    """
+
+    def __init__(self, user, base_url):
+        self.user = user
+        self.base_url = base_url.rstrip('/')
+        self.opener = build_opener()  # No cookie jar: the Cookie header below is the whole session
+        self.csrf_token = get_random_string(32)  # Any well-formed token works if cookie and header agree
+        self.login()
+
+    def login(self):
+        client = Client()
+        client.force_login(self.user)
+        session = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.cookie = f'{settings.SESSION_COOKIE_NAME}={session}; {settings.CSRF_COOKIE_NAME}={self.csrf_token}'
+
+    def request(self, method, path, logged_in, data=None):
+        headers = {'X-CSRFToken': self.csrf_token, 'Referer': self.base_url + '/',
+                   'Content-Type': 'application/x-www-form-urlencoded'}
+        headers['Cookie'] = self.cookie if logged_in else f'{settings.CSRF_COOKIE_NAME}={self.csrf_token}'
+        request = Request(self.base_url + path, data=urlencode(data or {}).encode() if method == 'POST' else None,
+                          method=method, headers=headers)
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                status = response.status
+        except HTTPError as e:
+            e.read()
+            status = e.code
+        except OSError:
+            status = 0  # Connection refused, reset, timed out...
+        elapsed = time.perf_counter() - started
+        if path == reverse('users:logout'):
+            self.login()
+        return elapsed, None, status
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=settings.BASE_DIR, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Hit every core, users and items route concurrently and report latency percentiles, queries and throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100, help='Requests per route')
+        parser.add_argument('--concurrency', type=int, default=8, help='Parallel clients')
+        parser.add_argument('--routes', nargs='*', help="Only these route names, e.g. items:item_list")
+        parser.add_argument('--writes', action='store_true',
+                            help='Also run routes that change data (add to cart, start a conversation, ...)')
+        parser.add_argument('--server', help='Base URL of a running server; default is the in-process test client')
+        parser.add_argument('--users-prefix', default='seed', help='Log in as users created by seed_data')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Earlier JSON results to compare against')
+        parser.add_argument('--max-regression', type=float, default=None,
+                            help='Fail if any route p95 got this many percent slower than the baseline')
+
+    def handle(self, *args, **options):
+        self.warn_about_missing_scenarios()
+        if not options['server']:
+            # Server errors are counted per route; a traceback for each one would bury the report
+            logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        routes = self.chosen_routes(options['routes'], options['writes'])
+
+        users = list(User.objects.filter(username__startswith=options['users_prefix'] + '_', is_active=True)
+                     .annotate(conversation_count=Count('conversation_states'))
+                     .order_by('-conversation_count')[:options['concurrency']])
+        if not users:
+            raise CommandError(f"No users named {options['users_prefix']}_*; run seed_data first.")
+        rng = random.Random(options['seed'])
+
+        workers = []
+        for index in range(options['concurrency']):
+            user = users[index % len(users)]
+            if options['server']:
+                worker = ServerWorker(user, options['server'])
+            else:
+                worker = TestClientWorker(user)
+            worker.sample = Sample(user, random.Random(rng.random()))
+            workers.append(worker)
+
+        results = {}
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+            for name in routes:
+                results[name] = self.run_route(pool, workers, name, options['requests'])
+                self.print_route(name, results[name])
+        total_time = time.perf_counter() - started
+
+        report = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'mode': 'server' if options['server'] else 'test-client',
+                'server': options['server'],
+                'concurrency': len(workers),
+                'requests_per_route': options['requests'],
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+            },
+            'routes': results,
+            'totals': {
+                'requests': sum(r['requests'] for r in results.values()),
+                'errors': sum(r['errors'] for r in results.values()),
+                'seconds': round(total_time, 2),
+                'throughput_rps': round(sum(r['requests'] for r in results.values()) / total_time, 1),
+            },
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}.")
+        if options['baseline']:
+            self.compare(report, options['baseline'], options['max_regression'])
+
+    def warn_about_missing_scenarios(self):
+        resolver = get_resolver()
+        for namespace in NAMESPACES:
+            for name in resolver.namespace_dict[namespace][1].reverse_dict:
+                if isinstance(name, str) and f'{namespace}:{name}' not in SCENARIOS:
+                    self.stderr.write(self.style.WARNING(f'No benchmark scenario for {namespace}:{name}'))
+
+    def chosen_routes(self, names, writes):
+        if names:
+            unknown = set(names) - set(SCENARIOS)
+            if unknown:
+                raise CommandError(f"Unknown routes: {', '.join(sorted(unknown))}")
+            return names
+        return [name for name, (method, _, _) in SCENARIOS.items() if writes or method == 'GET']
+
+    def run_route(self, pool, workers, name, count):
+        """Spread `count` requests to one route over every worker at once"""
+        method, logged_in, build_path = SCENARIOS[name]
+        latencies, queries, statuses = [], [], {}
+        lock = threading.Lock()
+        shares = [count // len(workers) + (index < count % len(workers)) for index in range(len(workers))]
+
+        def drive(worker, share):
+            for _ in range(share):
+                target = build_path(worker.sample)
+                path, data = target if isinstance(target, tuple) else (target, None)
+                elapsed, query_count, status = worker.request(method, path, logged_in, data)
+                with lock:
+                    latencies.append(elapsed)
+                    if query_count is not None:
+                        queries.append(query_count)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        list(pool.map(drive, workers, shares))
+        return summarize(latencies, queries, statuses, time.perf_counter() - started)
+
+    def print_route(self, name, result):
+        queries = '' if result['queries_mean'] is None else f"  {result['queries_mean']:>6} q/req"
+        line = (f"{name:<32} p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  "
+                f"p99 {result['p99_ms']:>8} ms  {result['throughput_rps']:>7} req/s{queries}")
+        self.stdout.write(self.style.ERROR(line) if result['errors'] else line)
+
+    def compare(self, report, baseline_path, max_regression):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = []
+        self.stdout.write(f"Compared with {baseline_path} (commit {baseline['meta'].get('commit')}):")
+        for name, result in report['routes'].items():
+            before = baseline['routes'].get(name)
+            if not before or not before.get('p95_ms') or result['p95_ms'] is None:
+                continue
+            change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            queries = ''
+            if result['queries_mean'] is not None and before.get('queries_mean') is not None:
+                queries = f"  queries {before['queries_mean']} -> {result['queries_mean']}"
+            self.stdout.write(f"  {name:<32} p95 {before['p95_ms']} -> {result['p95_ms']} ms ({change:+.0f}%){queries}")
+            if max_regression is not None and change > max_regression:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"p95 regressed more than {max_regression}% on: {', '.join(regressions)}")
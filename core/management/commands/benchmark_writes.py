@@ -0,0 +1,139 @@
+import json
+import logging
+import multiprocessing
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+
+from core import metrics
+from core.management.commands.benchmark import Sample, summarize
+
+
+class Writer:
+    """One simulated user posting chat messages, filling their cart and browsing, as fast as it can"""
+
+    def __init__(self, user, rng):
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        self.client = Client(raise_request_exception=False, SERVER_NAME=host)
+        self.client.force_login(user)
+        self.sample = Sample(user, rng)
+        self.rng = rng
+        self.in_cart = []
+
+    def chat(self):
+        conversation_id = self.sample.conversation()[0]
+        return self.client.post(reverse('items:conversation_detail', args=[conversation_id]),
+                                {'content': f'benchmark {self.rng.random()}'},
+                                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def cart(self):
+        if self.in_cart and self.rng.random() < 0.5:
+            return self.client.post(reverse('items:remove_from_cart', args=[self.in_cart.pop()]))
+        item_id = self.sample.pick(self.sample.others_items)
+        self.in_cart.append(item_id)
+        return self.client.post(reverse('items:add_to_cart', args=[item_id]))
+
+    def read(self):
+        return self.client.get(reverse('items:item_list_json'))
+
+    def run_until(self, deadline, read_share):
+        latencies, statuses = [], {}
+        while time.perf_counter() < deadline:
+            action = self.read if self.rng.random() < read_share else self.rng.choice((self.chat, self.cart))
+            started = time.perf_counter()
+            status = action().status_code
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+        return latencies, statuses
+
+
+def run_level(user_ids, threads, seconds, read_share, seed):
+    """Run `threads` writers until the time is up; returns (latencies, statuses, busy retries)"""
+    users = list(User.objects.filter(pk__in=user_ids))
+    rng = random.Random(seed)
+    writers = [Writer(users[index % len(users)], random.Random(rng.random())) for index in range(threads)]
+    retries_before = metrics.current('db_busy_retries_total')
+    deadline = time.perf_counter() + seconds
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda writer: writer.run_until(deadline, read_share), writers))
+    latencies, statuses = [], {}
+    for run_latencies, run_statuses in results:
+        latencies += run_latencies
+        for status, count in run_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    connections.close_all()
+    return latencies, statuses, metrics.current('db_busy_retries_total') - retries_before
+
+
+class Command(BaseCommand):
+    help = ('Measure how many concurrent chat posts and cart updates the database sustains, '
+            'at several thread counts. Writes real rows; run it against seed_data, not production.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8, 16],
+                            help='Threads per process to measure, one run each')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Processes running those threads, like several server workers')
+        parser.add_argument('--seconds', type=float, default=10, help='Length of each run')
+        parser.add_argument('--read-share', type=float, default=0.5,
+                            help='Share of requests that only read (the JSON browse feed)')
+        parser.add_argument('--users-prefix', default='seed', help='Act as users created by seed_data')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        # Errors and slow requests are counted instead of logged one by one
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        logging.getLogger('core.performance').setLevel(logging.CRITICAL)
+        processes = options['processes']
+        user_ids = list(User.objects.filter(username__startswith=options['users_prefix'] + '_', is_active=True)
+                        .annotate(conversation_count=Count('conversation_states'))
+                        .filter(conversation_count__gt=0).order_by('-conversation_count')
+                        .values_list('id', flat=True)[:max(options['threads']) * processes])
+        if not user_ids:
+            raise CommandError(f"No users named {options['users_prefix']}_* with conversations; run seed_data first.")
+        rng = random.Random(options['seed'])
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                self.stdout.write(f'SQLite journal mode: {cursor.fetchone()[0]}')
+        connections.close_all()  # Forked processes must not share the parent's connection
+
+        runs = []
+        for threads in options['threads']:
+            jobs = [(user_ids[index::processes] or user_ids, threads, options['seconds'], options['read_share'],
+                     rng.random()) for index in range(processes)]
+            started = time.perf_counter()
+            if processes == 1:
+                results = [run_level(*jobs[0])]
+            else:
+                with multiprocessing.get_context('fork').Pool(processes) as pool:
+                    results = pool.starmap(run_level, jobs)
+            wall_time = time.perf_counter() - started
+            latencies, statuses, retries = [], {}, 0
+            for run_latencies, run_statuses, run_retries in results:
+                latencies += run_latencies
+                retries += run_retries
+                for status, count in run_statuses.items():
+                    statuses[status] = statuses.get(status, 0) + count
+            result = summarize(latencies, [], statuses, wall_time)
+            result.update(processes=processes, threads=threads, busy_retries=retries)
+            runs.append(result)
+            line = (f"{processes} x {threads:>2} threads  {result['throughput_rps']:>7} req/s  "
+                    f"p50 {result['p50_ms']:>7} ms  p95 {result['p95_ms']:>7} ms  p99 {result['p99_ms']:>8} ms  "
+                    f"{result['errors']} errors  {result['busy_retries']} retries")
+            self.stdout.write(self.style.ERROR(line) if result['errors'] else line)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'database': connection.vendor, 'read_share': options['read_share'], 'runs': runs},
+                          f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}.")
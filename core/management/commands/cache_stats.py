@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core import caching
+
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counts for the page and fragment caches'
+
+    def handle(self, *args, **options):
+        stats = caching.stats()
+        if not stats:
+            self.stdout.write('No cache activity recorded yet.')
+            return
+        for name, counts in stats.items():
+            total = counts['hits'] + counts['misses']
+            ratio = counts['hits'] / total * 100 if total else 0
+            self.stdout.write(f"{name:<40} {counts['hits']:>8} hits {counts['misses']:>8} misses {ratio:6.1f}%")
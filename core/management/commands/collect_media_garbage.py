@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import media
+
+
+class Command(BaseCommand):
+    help = 'Delete uploaded files (and their resized copies) that no item, profile or category uses any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=media.GRACE,
+                            help='Seconds a file must have been unused before it is deleted')
+        parser.add_argument('--recount', action='store_true',
+                            help='First set every reference count from the tables (after bulk imports, '
+                                 'or once for files uploaded before counting started)')
+        parser.add_argument('--untracked', action='store_true',
+                            help='Also walk the media directory for files no count knows about, '
+                                 'e.g. from uploads whose transaction rolled back')
+        parser.add_argument('--dry-run', action='store_true', help='Only list what would be deleted')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, sweeping again every --interval seconds')
+        parser.add_argument('--interval', type=float, default=3600.0, help='Seconds between sweeps with --loop')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            changed = media.recount()
+            self.stdout.write(f'Corrected {changed} reference counts.')
+
+        total = 0
+        try:
+            while True:
+                deleted = media.collect_garbage(options['grace'], dry_run=options['dry_run'])
+                if options['untracked']:
+                    deleted += media.collect_untracked(options['grace'], dry_run=options['dry_run'])
+                total += len(deleted)
+                if options['verbosity'] >= 2 or options['dry_run']:
+                    for name in deleted:
+                        self.stdout.write(name)
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {total} unused files.'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from core import images
+from core.models import Category
+from items.models import Item
+from users.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Create resized/WebP copies for images uploaded before the variant pipeline existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate copies that already exist')
+
+    def handle(self, *args, **options):
+        sources = [(Item, 'image'), (Profile, 'profile_picture'), (Category, 'image')]
+        done = failed = 0
+        for model, field_name in sources:
+            queryset = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            for field_file in (getattr(obj, field_name) for obj in queryset.only(field_name).iterator()):
+                if not options['force'] and images.has_variants(field_file.name):
+                    continue
+                try:
+                    images.generate_variants(field_file.storage, field_file.name)
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{field_file.name}: {e}')
+        self.stdout.write(self.style.SUCCESS(f'Generated variants for {done} images ({failed} failed).'))
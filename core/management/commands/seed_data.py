@@ -0,0 +1,244 @@
+import random
+import time
+from array import array
+from bisect import bisect
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core import caching, media
+from core.models import Cart, CartItem, Category
+from items import facets, geo, search
+from items.models import Conversation, ConversationReadState, Item, Message
+from items.messaging import snippet
+from users.models import Profile
+
+CATEGORY_NAMES = ['Electronics', 'Furniture', 'Books', 'Clothing', 'Sports', 'Toys', 'Kitchen', 'Garden',
+                  'Tools', 'Music']
+LOCATIONS = ['Dhaka', 'Chittagong', 'Sylhet', 'Khulna', 'Rajshahi', 'Barisal', 'Rangpur', 'Comilla']
+WORDS = ('lamp chair table phone laptop bike guitar jacket shoes camera drill kettle sofa desk book '
+         'novel racket ball stroller blender monitor keyboard speaker tent rug mirror clock fan heater').split()
+ADJECTIVES = 'old new small large red blue wooden vintage portable used spare classic modern'.split()
+
+
+class Skewed:
+    """Pick indexes 0..n-1 with Zipf-like weights 1/(i+1)**skew (skew 0 = uniform)"""
+
+    def __init__(self, rng, n, skew):
+        self.rng = rng
+        self.n = n
+        self.cumulative = list(accumulate(1 / (i + 1) ** skew for i in range(n))) if skew else None
+
+    def pick(self):
+        if self.cumulative is None:
+            return self.rng.randrange(self.n)
+        return min(bisect(self.cumulative, self.rng.random() * self.cumulative[-1]), self.n - 1)
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with synthetic users, items, conversations, messages and carts for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--items', type=int, default=10000)
+        parser.add_argument('--conversations', type=int, default=5000)
+        parser.add_argument('--messages', type=int, default=50000, help='Spread over the new conversations')
+        parser.add_argument('--carts', type=float, default=0.3, help='Share of the new users who get a cart')
+        parser.add_argument('--cart-items', type=int, default=3, help='Average items per cart')
+        parser.add_argument('--owner-skew', type=float, default=1.0,
+                            help='How unevenly items are spread over owners (0 = evenly, 1 = Zipf)')
+        parser.add_argument('--item-skew', type=float, default=0.8,
+                            help='How much conversations crowd around popular items')
+        parser.add_argument('--message-skew', type=float, default=0.8,
+                            help='How much messages crowd into busy conversations')
+        parser.add_argument('--active-ratio', type=float, default=0.9, help='Share of items still listed')
+        parser.add_argument('--read-ratio', type=float, default=0.8, help='Share of each chat already read')
+        parser.add_argument('--password', default='benchmark', help='Password for every generated user')
+        parser.add_argument('--prefix', default='seed', help='Username prefix for generated users')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for repeatable data')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2 so conversations have someone to talk to.')
+        started = time.monotonic()
+
+        user_ids = self.create_users(options['users'], options['prefix'], options['password'])
+        category_ids = self.create_categories()
+        item_ids, item_owners = self.create_items(options['items'], user_ids, category_ids,
+                                                  options['owner_skew'], options['active_ratio'])
+        self.create_conversations(options['conversations'], options['messages'], user_ids, item_ids,
+                                  item_owners, options['item_skew'], options['message_skew'],
+                                  options['read_ratio'])
+        self.create_carts(user_ids, item_ids, options['carts'], options['cart_items'])
+
+        caching.bump(caching.ITEMS, caching.CATEGORIES)  # bulk_create skips the signals that do this
+        facets.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Seeded in {time.monotonic() - started:.1f}s.'))
+
+    def batches(self, total):
+        """Sizes of the batches needed to make `total` rows"""
+        for start in range(0, total, self.batch_size):
+            yield min(self.batch_size, total - start)
+
+    def progress(self, label, done, started):
+        if self.verbosity >= 1:
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'  {label}: {done} ({done / elapsed if elapsed else 0:.0f}/s)')
+
+    def create_users(self, count, prefix, password):
+        """Users and their profiles; every user shares one pre-hashed password"""
+        started = time.monotonic()
+        hashed = make_password(password)  # Hashing once instead of per user is most of the speed-up
+        first = User.objects.filter(username__startswith=f'{prefix}_').count()
+        ids = array('q')
+        for size in self.batches(count):
+            with transaction.atomic():
+                users = User.objects.bulk_create([
+                    User(username=f'{prefix}_{n}', email=f'{prefix}_{n}@example.com', password=hashed)
+                    for n in range(first + len(ids), first + len(ids) + size)
+                ])
+                # bulk_create skips the post_save receiver that normally makes the profile
+                Profile.objects.bulk_create([Profile(user=user, full_name=user.username) for user in users])
+            ids.extend(user.pk for user in users)
+            self.progress('users', len(ids), started)
+        return ids
+
+    def create_categories(self):
+        for name in CATEGORY_NAMES:
+            Category.objects.get_or_create(name=name)
+        return list(Category.objects.values_list('id', flat=True))
+
+    def create_items(self, count, user_ids, category_ids, owner_skew, active_ratio):
+        started = time.monotonic()
+        rng = self.rng
+        owners = Skewed(rng, len(user_ids), owner_skew)
+        ids, owner_ids = array('q'), array('q')
+        for size in self.batches(count):
+            batch = []
+            for _ in range(size):
+                item_type = rng.choice(('swap', 'donate', 'rent'))
+                word = rng.choice(WORDS)
+                item = Item(
+                    owner_id=user_ids[owners.pick()], category_id=rng.choice(category_ids),
+                    item_type=item_type, name=f'{rng.choice(ADJECTIVES).title()} {word}',
+                    description=' '.join(rng.choices(WORDS + ADJECTIVES, k=rng.randint(8, 40))),
+                    price=round(rng.uniform(1, 500), 2) if item_type == 'rent' else None,
+                    condition=rng.choice(Item.CONDITION_CHOICES)[0], location=rng.choice(LOCATIONS),
+                    contact_info='seed@example.com', image=f'items/{word}.jpg',
+                    is_active=rng.random() < active_ratio,
+                )
+                geo.locate(item)  # bulk_create skips the pre_save geocoding signal
+                batch.append(item)
+            with transaction.atomic():
+                created = Item.objects.bulk_create(batch)
+                # bulk_create skips the search and media reference signals
+                search.index_items(item.pk for item in created)
+                media.acquire_many(item.image.name for item in created)
+            ids.extend(item.pk for item in created)
+            owner_ids.extend(item.owner_id for item in created)
+            self.progress('items', len(ids), started)
+        return ids, owner_ids
+
+    def create_conversations(self, count, message_count, user_ids, item_ids, item_owners,
+                             item_skew, message_skew, read_ratio):
+        """Conversations between an item's owner and a buyer, their messages and read states"""
+        if not count or not item_ids:
+            return
+        started = time.monotonic()
+        rng = self.rng
+        items = Skewed(rng, len(item_ids), item_skew)
+        busy = Skewed(rng, count, message_skew)
+        # How many messages each conversation gets, decided up front so batches stay independent
+        lengths = array('l', [0]) * count
+        for _ in range(message_count):
+            lengths[busy.pick()] += 1
+
+        Participant = Conversation.participants.through
+        offset = 0
+        for size in self.batches(count):
+            pairs = []
+            for _ in range(size):
+                index = items.pick()
+                owner = item_owners[index]
+                buyer = owner
+                while buyer == owner:
+                    buyer = user_ids[rng.randrange(len(user_ids))]
+                pairs.append((item_ids[index], owner, buyer))
+
+            with transaction.atomic():
+                conversations = Conversation.objects.bulk_create(
+                    [Conversation(item_id=item_id) for item_id, _, _ in pairs])
+                Participant.objects.bulk_create([
+                    Participant(conversation_id=conversation.pk, user_id=user_id)
+                    for conversation, (_, owner, buyer) in zip(conversations, pairs)
+                    for user_id in (owner, buyer)
+                ])
+                messages, read_upto_by_conversation = [], []
+                for position, (conversation, (_, owner, buyer)) in enumerate(zip(conversations, pairs)):
+                    length = lengths[offset + position]
+                    read_upto = int(length * read_ratio)  # Older messages read, the newest ones not yet
+                    read_upto_by_conversation.append(read_upto)
+                    sender = buyer  # The buyer opens the chat
+                    for _ in range(length):
+                        messages.append(Message(
+                            conversation_id=conversation.pk, sender_id=sender,
+                            content=' '.join(rng.choices(WORDS + ADJECTIVES, k=rng.randint(2, 20))),
+                        ))
+                        if rng.random() < 0.6:
+                            sender = owner if sender == buyer else buyer
+                created = Message.objects.bulk_create(messages, batch_size=self.batch_size)
+                ConversationReadState.objects.bulk_create(
+                    self.read_states(conversations, pairs, created, read_upto_by_conversation))
+            offset += size
+            self.progress('conversations', offset, started)
+
+    def read_states(self, conversations, pairs, messages, read_upto_by_conversation):
+        """Inbox rows worked out from the messages just created: each side has read the first
+        `read_upto` messages, and everything up to its own last message"""
+        by_conversation = {}
+        for message in messages:
+            by_conversation.setdefault(message.conversation_id, []).append(message)
+        states = []
+        for conversation, (_, owner, buyer), read_upto in zip(conversations, pairs, read_upto_by_conversation):
+            history = by_conversation.get(conversation.pk, [])
+            last = history[-1] if history else None
+            for user_id in (owner, buyer):
+                seen = [m.pk for n, m in enumerate(history) if n < read_upto or m.sender_id == user_id]
+                mark = max(seen) if seen else None
+                unread = [m for m in history if m.sender_id != user_id and (mark is None or m.pk > mark)]
+                states.append(ConversationReadState(
+                    conversation_id=conversation.pk, user_id=user_id, unread_count=len(unread),
+                    last_read_message_id=mark,
+                    last_message_snippet=snippet(last.content) if last else '',
+                    last_message_at=last.created_at if last else conversation.updated_at,
+                ))
+        return states
+
+    def create_carts(self, user_ids, item_ids, share, average_items):
+        if not item_ids or share <= 0:
+            return
+        started = time.monotonic()
+        rng = self.rng
+        shoppers = rng.sample(range(len(user_ids)), int(len(user_ids) * share))
+        done = 0
+        for start in range(0, len(shoppers), self.batch_size):
+            chunk = [user_ids[i] for i in shoppers[start:start + self.batch_size]]
+            with transaction.atomic():
+                Cart.objects.bulk_create([Cart(user_id=user_id) for user_id in chunk],
+                                         ignore_conflicts=True)  # Users keep any cart they had
+                carts = Cart.objects.filter(user_id__in=chunk)
+                lines = []
+                for cart in carts:
+                    picks = min(max(1, round(rng.expovariate(1 / average_items))), len(item_ids))
+                    lines.extend(CartItem(cart_id=cart.pk, item_id=item_id, quantity=rng.randint(1, 3))
+                                 for item_id in rng.sample(item_ids, picks))
+                CartItem.objects.bulk_create(lines, ignore_conflicts=True)
+            done += len(chunk)
+            self.progress('carts', done, started)
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import mail, metrics
+
+PURGE_INTERVAL = 600  # Seconds between deletes of old sent messages with --loop
+
+
+class Command(BaseCommand):
+    help = 'Send queued outbound email in batches over one mail server connection each'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=mail.BATCH_SIZE,
+                            help='Messages sent over one connection')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking the queue every --interval seconds when it is empty')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between checks with --loop')
+        parser.add_argument('--keep-sent-hours', type=int, default=mail.KEEP_SENT_HOURS,
+                            help='Delete sent messages older than this many hours')
+
+    def purge(self, options):
+        purged = mail.purge_sent(options['keep_sent_hours'])
+        if purged and options['verbosity'] >= 2:
+            self.stdout.write(f'Deleted {purged} old sent messages.')
+        return time.monotonic()
+
+    def handle(self, *args, **options):
+        purged_at = self.purge(options)
+        total_sent = total_failed = 0
+        try:
+            while True:
+                if time.monotonic() - purged_at >= PURGE_INTERVAL:  # A --loop worker runs for days
+                    purged_at = self.purge(options)
+                sent, failed = mail.send_batch(options['batch_size'])
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    metrics.maybe_flush()
+                    if options['verbosity'] >= 2:
+                        self.stdout.write(f'Sent {sent}, {failed} failed.')
+                if sent + failed < options['batch_size'] or failed and not sent:
+                    # Queue drained, or the server is refusing everything: wait before trying again
+                    if not options['loop']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Sent {total_sent} emails ({total_failed} failed or retried later).'))
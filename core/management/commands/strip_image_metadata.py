@@ -0,0 +1,61 @@
+import os
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+
+from core import images, media
+from core.models import Category
+from items.models import Item
+from users.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Remove EXIF/GPS data, XMP and comments from images uploaded before uploads were stripped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows whose image has metadata')
+
+    def handle(self, *args, **options):
+        sources = [(Item, 'image'), (Profile, 'profile_picture'), (Category, 'image')]
+        self.dry_run = options['dry_run']
+        self.failed = 0
+        replacements = {}  # Stored name -> stripped copy's name (None: nothing to strip), so shared files are read once
+        changed = 0
+        for model, field_name in sources:
+            queryset = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            for obj in queryset.iterator():
+                field_file = getattr(obj, field_name)
+                if field_file.name not in replacements:
+                    replacements[field_file.name] = self.strip(field_file)
+                new_name = replacements[field_file.name]
+                if new_name is None:
+                    continue
+                changed += 1
+                if not self.dry_run:
+                    setattr(obj, field_name, new_name)
+                    obj.save(update_fields=[field_name])  # Its signals move the media reference counts
+        verb = 'Would strip' if self.dry_run else 'Stripped'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} metadata from the images of {changed} rows ({self.failed} failed).'))
+
+    def strip(self, field_file):
+        """Store a stripped copy of one file and return its name, or None if it has no metadata"""
+        try:
+            with field_file.storage.open(field_file.name, 'rb') as source:
+                stripped = images.strip_metadata(source)
+        except OSError as e:
+            self.failed += 1
+            self.stderr.write(f'{field_file.name}: {e}')
+            return None
+        if stripped is None:
+            return None
+        if self.dry_run:
+            return field_file.name
+        name = field_file.name
+        if media.HASHED_NAME_RE.search(name):  # Saving adds the two hash directories again
+            name = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(name))),
+                                'image' + os.path.splitext(name)[1])
+        # The copy gets a new content-addressed name; collect_media_garbage removes the old file once unused
+        name = field_file.storage.save(name, ContentFile(stripped))
+        images.generate_variants(field_file.storage, name)
+        return name
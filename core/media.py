@@ -0,0 +1,243 @@
+"""Uploaded files stored under the hash of their content, each copy kept once.
+
+With STORAGES['default'] set to ContentAddressedStorage, a photo uploaded to
+`items/` is saved as
+
+    items/9f/86/9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08.jpg
+
+whatever its original filename. The name changes whenever the bytes do, so a
+media URL always means the same file and can be cached forever (e.g.
+`Cache-Control: public, max-age=31536000, immutable` on /media/ in the web
+server). Uploading a photo that is already stored - saving a listing again
+with the same picture, reposting an item - reuses the stored file instead of
+writing another copy.
+
+A MediaBlob row counts how many Item, Profile and Category rows use each
+file. The receivers in each app's models.py keep the count in step, in the
+same transaction as the row that changed; bulk loads, which send no signals,
+call acquire_many(). The collect_media_garbage command
+deletes files (and their resized copies) that nothing has used for
+MEDIA_GC_GRACE seconds, checking the tables once more first, and files left
+behind by uploads whose transaction rolled back.
+"""
+import hashlib
+import os
+import re
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from . import metrics
+
+GRACE = getattr(settings, 'MEDIA_GC_GRACE', 24 * 3600)  # Seconds a file stays after its last user lets go
+REFERENCES = [('items.Item', 'image'), ('users.Profile', 'profile_picture'), ('core.Category', 'image')]
+HASHED_NAME_RE = re.compile(r'(?:^|/)([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(?:\.\w{1,10})?$')
+UNKNOWN = None  # Stored name of a field that wasn't loaded (e.g. after .only())
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that names each file after the SHA-256 of its content (see module docstring)"""
+
+    def get_available_name(self, name, max_length=None):
+        return name  # _save() picks the real name from the content, and the same name means the same bytes
+
+    @staticmethod
+    def hashed_name(name, digest):
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        extension = extension if re.fullmatch(r'\.\w{1,10}', extension) else ''
+        return os.path.join(directory, digest[:2], digest[2:4], digest + extension).replace(os.sep, '/')
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        name = self.hashed_name(name, digest.hexdigest())
+        path = self.path(name)
+        if os.path.exists(path):
+            os.utime(path)  # A fresh mtime tells the garbage collector it was just uploaded again
+            metrics.inc('media_uploads_total', result='duplicate')
+            return name
+        # Write under a temporary name and rename, so nobody ever reads a half-written file;
+        # if the same bytes are being uploaded elsewhere at the same time, either copy will do
+        temporary = super()._save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(temporary), path)
+        metrics.inc('media_uploads_total', result='stored')
+        return name
+
+
+def _name(value):
+    """Stored file name of a raw field value: a string, a File, or missing"""
+    if value is None:
+        return ''
+    return value if isinstance(value, str) else (value.name or '')
+
+
+def remember_names(instance, *field_names):
+    """post_init helper: note which files the row points at in the database"""
+    # Raw values, so loading a row doesn't build FieldFile objects; deferred fields are simply missing
+    instance._stored_media = {field_name: _name(instance.__dict__[field_name]) if field_name in instance.__dict__
+                              else UNKNOWN for field_name in field_names}
+
+
+def update_references(instance, *field_names, created=False, update_fields=None):
+    """post_save helper: move the reference counts from the files the row used to point at"""
+    stored = getattr(instance, '_stored_media', {})
+    for field_name in field_names:
+        if update_fields is not None and field_name not in update_fields:
+            continue
+        before = '' if created else stored.get(field_name, UNKNOWN)
+        after = _name(getattr(instance, field_name))
+        if before is UNKNOWN or before == after:
+            continue  # Can't tell what it was; collect_media_garbage --recount puts that right
+        acquire(after)
+        release(before)
+        stored[field_name] = after
+
+
+def release_references(instance, *field_names):
+    """post_delete helper: the deleted row no longer uses its files"""
+    stored = getattr(instance, '_stored_media', {})
+    for field_name in field_names:
+        name = stored.get(field_name, UNKNOWN)
+        if name is UNKNOWN:
+            continue  # Deferred when loaded, and the row is gone now; collect_media_garbage --recount puts that right
+        release(name)
+
+
+def acquire(name):
+    """Count one more user of a stored file"""
+    from .models import MediaBlob
+    if not name:
+        return
+    blobs = MediaBlob.objects.filter(name=name)
+    if not blobs.update(refs=F('refs') + 1, orphaned_at=None):
+        MediaBlob.objects.bulk_create([MediaBlob(name=name)], ignore_conflicts=True)
+        blobs.update(refs=F('refs') + 1, orphaned_at=None)
+
+
+def acquire_many(names):
+    """acquire() for every name, for rows made by bulk_create (which sends no signals): a few queries per batch"""
+    from .models import MediaBlob
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return
+    MediaBlob.objects.bulk_create([MediaBlob(name=name) for name in counts], ignore_conflicts=True, batch_size=500)
+    by_count = {}
+    for name, count in counts.items():
+        by_count.setdefault(count, []).append(name)
+    for count, same in by_count.items():  # Usually every file is used once, so few UPDATEs
+        for start in range(0, len(same), 500):
+            MediaBlob.objects.filter(name__in=same[start:start + 500]).update(refs=F('refs') + count, orphaned_at=None)
+
+
+def release(name):
+    """Count one user fewer; the file becomes an orphan when the last one goes"""
+    from .models import MediaBlob
+    if not name:
+        return
+    MediaBlob.objects.filter(name=name, refs__gt=0).update(
+        refs=F('refs') - 1,
+        orphaned_at=Case(When(refs=1, then=Value(timezone.now())), default=F('orphaned_at')),
+    )
+
+
+def referenced(names):
+    """The subset of `names` that some row really points at right now"""
+    names, found = list(names), set()
+    for label, field_name in REFERENCES:
+        model = apps.get_model(label)
+        found.update(model.objects.filter(**{f'{field_name}__in': names}).values_list(field_name, flat=True))
+    return found
+
+
+def recount():
+    """Set every reference count from the tables themselves; returns how many counts changed"""
+    from .models import MediaBlob
+    counts = Counter()
+    for label, field_name in REFERENCES:
+        model = apps.get_model(label)
+        counts.update(name for name in model.objects.exclude(**{f'{field_name}__isnull': True})
+                      .exclude(**{field_name: ''}).values_list(field_name, flat=True).iterator())
+    now = timezone.now()
+    MediaBlob.objects.bulk_create([MediaBlob(name=name) for name in counts], ignore_conflicts=True, batch_size=500)
+    changed = []
+    for blob in MediaBlob.objects.only('name', 'refs', 'orphaned_at').iterator():
+        refs = counts.get(blob.name, 0)
+        if blob.refs != refs:
+            blob.refs = refs
+            blob.orphaned_at = (blob.orphaned_at or now) if refs == 0 else None
+            changed.append(blob)
+    MediaBlob.objects.bulk_update(changed, ['refs', 'orphaned_at'], batch_size=500)
+    return len(changed)
+
+
+def _delete_file(storage, name, cutoff):
+    """Delete a stored file and its resized copies, unless it was uploaded again since `cutoff`"""
+    from . import images
+    path = storage.path(name)
+    try:
+        if os.path.getmtime(path) >= cutoff.timestamp():
+            return False
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    images.delete_variants(name)
+    return True
+
+
+def collect_garbage(grace=GRACE, limit=1000, dry_run=False):
+    """Delete up to `limit` files that nothing has used for `grace` seconds; returns their names"""
+    from .models import MediaBlob
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    orphans = list(MediaBlob.objects.filter(refs=0, orphaned_at__lt=cutoff)
+                   .order_by('orphaned_at').values_list('name', flat=True)[:limit])
+    still_used = referenced(orphans)  # A bulk update may have pointed a row at it without the signals
+    for name in still_used:
+        MediaBlob.objects.filter(name=name).update(refs=F('refs') + 1, orphaned_at=None)
+    deleted = []
+    for name in orphans:
+        if name in still_used:
+            continue
+        if dry_run:
+            deleted.append(name)
+            continue
+        # Conditional, so a row that started using the file a moment ago keeps it
+        if MediaBlob.objects.filter(name=name, refs=0, orphaned_at__lt=cutoff).delete()[0]:
+            if _delete_file(default_storage, name, cutoff):
+                deleted.append(name)
+    return deleted
+
+
+def collect_untracked(grace=GRACE, dry_run=False):
+    """Delete content-addressed files no MediaBlob row knows about, e.g. from a rolled-back upload
+
+    Walks the whole media directory, so it is worth running far less often than collect_garbage().
+    """
+    from .models import MediaBlob
+    storage = default_storage
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    candidates = []
+    for directory, _, filenames in os.walk(storage.location):
+        if os.path.relpath(directory, storage.location).split(os.sep)[0] == 'variants':
+            continue
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+            if filename.endswith('.tmp') or HASHED_NAME_RE.search(name):
+                if os.path.getmtime(path) < cutoff.timestamp():
+                    candidates.append(name)
+    deleted = []
+    for start in range(0, len(candidates), 500):
+        batch = candidates[start:start + 500]
+        known = set(MediaBlob.objects.filter(name__in=batch).values_list('name', flat=True)) | referenced(batch)
+        for name in batch:
+            if name not in known and (dry_run or _delete_file(storage, name, cutoff)):
+                deleted.append(name)
+    return deleted
@@ -0,0 +1,316 @@
+"""Prometheus metrics, aggregated across worker processes without any external service.
+
+Each thread records into its own shard (no lock on the hot path); when the
+thread ends, its shard is folded into the process total. Every few seconds,
+and when a reporting process (a server, the email worker) exits, it writes its totals to
+METRICS_DIR/<pid>-<token>.json with an atomic rename, and holds a lock on the
+matching .lock file for as long as it lives. /metrics adds up every process's
+file and renders the Prometheus text format, so any gunicorn worker can
+answer a scrape for the whole server. Files of processes that have exited
+(their lock is free) are folded into retired.json, so the totals never go
+down when a worker is replaced and the directory doesn't grow without end.
+
+    metrics.inc('messages_sent_total')
+    metrics.observe('template_render_seconds', 0.012, template='items/item_list.html')
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: files of exited processes are kept as they are
+    fcntl = None
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled, by URL name, method and status.', None),
+    'http_request_duration_seconds': ('histogram', 'Time to produce a response, by URL name.', DEFAULT_BUCKETS),
+    'db_queries_per_request': ('histogram', 'Database queries run by one request, by URL name.', QUERY_BUCKETS),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in database queries, by URL name.', None),
+    'template_render_seconds': ('histogram', 'Time to render a page template, by template name.', DEFAULT_BUCKETS),
+    'messages_sent_total': ('counter', 'Chat messages sent.', None),
+    'items_created_total': ('counter', 'Item listings created.', None),
+    'db_busy_retries_total': ('counter', 'Write views run again because the database was locked.', None),
+    'emails_total': ('counter', 'Queued emails handled by send_queued_email, by result.', None),
+    'media_uploads_total': ('counter', 'Uploaded files, by result (stored, or duplicate of a stored file).', None),
+}
+
+METRICS_DIR = str(getattr(settings, 'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'swapdonaterent-metrics')))
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 2)  # Seconds between writes of this process's file
+
+RETIRED = 'retired'  # File stem holding the totals of processes that have exited
+
+_local = threading.local()
+_shards = []  # Shards of the threads still running, for flushing
+_shards_lock = threading.RLock()  # Not taken on the hot path: new threads, finished threads and flushes only
+_last_flush = 0.0
+_reporting = False  # Set by maybe_flush(): this process reports its numbers as it goes
+_process = {'pid': None, 'stem': None, 'lock': None}  # This process's file name and the lock it holds
+
+
+class _Shard:
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+
+    def add(self, counters, histograms):
+        for key, value in counters:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, series in histograms:
+            merged = self.histograms.setdefault(key, [0] * len(series))
+            for index, value in enumerate(series):
+                merged[index] += value
+
+
+_finished = _Shard()  # Everything recorded by threads that have ended
+
+
+class _ThreadMarker:
+    """Lives in the thread-local storage, so it is freed when its thread ends"""
+
+
+def _retire_shard(shard):
+    with _shards_lock:
+        _shards.remove(shard)
+        _finished.add(list(shard.counters.items()), list(shard.histograms.items()))
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+        _local.marker = _ThreadMarker()
+        # Under ASGI every request may get a fresh thread; keep their numbers, not their shards
+        weakref.finalize(_local.marker, _retire_shard, shard).atexit = False
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Add to a counter"""
+    counters = _shard().counters
+    key = (name, _labels(labels))
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """Record one value in a histogram"""
+    buckets = METRICS[name][2]
+    histograms = _shard().histograms
+    key = (name, _labels(labels))
+    series = histograms.get(key)
+    if series is None:
+        series = histograms[key] = [0] * (len(buckets) + 2)
+    series[bisect_left(buckets, value)] += 1  # Bucket counts are made cumulative when rendering
+    series[-1] += value
+
+
+def _snapshot():
+    """This process's totals across all its threads"""
+    total = _Shard()
+    # Under the lock, so a thread that ends meanwhile is counted once: in its shard or in _finished
+    with _shards_lock:
+        for shard in [_finished, *_shards]:
+            total.add(list(shard.counters.items()), [(key, list(series)) for key, series in
+                                                      list(shard.histograms.items())])
+    return total.counters, total.histograms
+
+
+def _file_stem():
+    """Name of this process's files; new after a fork, and never that of an earlier process with the same pid"""
+    if _process['pid'] != os.getpid():
+        _process.update(pid=os.getpid(), stem=f'{os.getpid()}-{uuid.uuid4().hex[:8]}', lock=None)
+    return _process['stem']
+
+
+def _hold_lock(stem):
+    """Lock this process's .lock file for as long as it lives; a free lock means the process is gone"""
+    if fcntl is None or _process['lock'] is not None:
+        return
+    lock = open(os.path.join(METRICS_DIR, f'{stem}.lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    _process['lock'] = lock
+
+
+@contextmanager
+def _directory_lock(mode):
+    """Shared while reading the files, exclusive while folding an exited process into retired.json"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, f'{RETIRED}.lock'), 'a') as lock:
+        fcntl.flock(lock, mode)
+        yield
+
+
+def _read(path):
+    with open(path) as f:
+        data = json.load(f)
+    return ([((metric, tuple(map(tuple, labels))), value) for metric, labels, value in data['counters']],
+            [((metric, tuple(map(tuple, labels))), series) for metric, labels, series in data['histograms']])
+
+
+def _write(path, counters, histograms):
+    data = {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, series] for (name, labels), series in histograms.items()],
+    }
+    with tempfile.NamedTemporaryFile('w', dir=METRICS_DIR, suffix='.tmp', delete=False) as f:
+        json.dump(data, f)
+    os.replace(f.name, path)  # Readers never see a half-written file
+
+
+def retire_exited():
+    """Fold the files of processes that have exited into retired.json; returns how many"""
+    if fcntl is None:
+        return 0
+    own = _process['stem'] if _process['pid'] == os.getpid() else None
+    try:
+        stems = [name[:-5] for name in os.listdir(METRICS_DIR)
+                 if name.endswith('.lock') and name[:-5] not in (own, RETIRED)]
+    except FileNotFoundError:
+        return 0
+    retired = 0
+    for stem in stems:
+        try:
+            lock = open(os.path.join(METRICS_DIR, f'{stem}.lock'))
+        except FileNotFoundError:  # Another process retired it a moment ago
+            continue
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue  # Still running (or being retired by someone else)
+            with _directory_lock(fcntl.LOCK_EX):
+                path = os.path.join(METRICS_DIR, f'{stem}.json')
+                if os.path.exists(path):
+                    total = _Shard()
+                    for source in (os.path.join(METRICS_DIR, f'{RETIRED}.json'), path):
+                        try:
+                            total.add(*_read(source))
+                        except (OSError, ValueError):
+                            pass
+                    _write(os.path.join(METRICS_DIR, f'{RETIRED}.json'), total.counters, total.histograms)
+                    os.remove(path)
+                    retired += 1
+                os.remove(lock.name)
+    return retired
+
+
+def flush():
+    """Write this process's totals to its file in METRICS_DIR"""
+    global _last_flush
+    _last_flush = time.monotonic()
+    counters, histograms = _snapshot()
+    if not counters and not histograms:
+        return  # Nothing recorded (e.g. a management command); don't leave an empty file behind
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    stem = _file_stem()
+    _hold_lock(stem)
+    _write(os.path.join(METRICS_DIR, f'{stem}.json'), counters, histograms)
+
+
+def maybe_flush():
+    """Flush if the last flush was more than FLUSH_INTERVAL seconds ago (cheap to call per request)"""
+    global _reporting
+    _reporting = True
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+@atexit.register
+def _flush_at_exit():
+    # Only processes that report (servers, the email worker) write their last numbers on the way out;
+    # a management command that merely saved an item must not leave a file behind
+    if _reporting:
+        flush()
+
+
+def collect():
+    """Totals from every process's file: ({(name, labels): value}, {(name, labels): series})"""
+    retire_exited()
+    total = _Shard()
+    # Shared lock: a file being folded into retired.json is never counted in both places
+    with _directory_lock(fcntl.LOCK_SH if fcntl else None):
+        try:
+            names = [name for name in os.listdir(METRICS_DIR) if name.endswith('.json')]
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            try:
+                total.add(*_read(os.path.join(METRICS_DIR, name)))
+            except (OSError, ValueError):  # Removed while we were listing
+                continue
+    return total.counters, total.histograms
+
+
+def current(name, **labels):
+    """This process's total so far for one counter series"""
+    counters, _ = _snapshot()
+    return counters.get((name, _labels(labels)), 0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(extra_counters=()):
+    """Every process's metrics in the Prometheus text exposition format
+
+    `extra_counters` are (name, help, {labels tuple: value}) read straight from
+    somewhere shared, such as the cache hit/miss counts.
+    """
+    flush()  # Include this process's latest numbers
+    counters, histograms = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        if kind == 'counter':
+            series = {labels: value for (metric, labels), value in counters.items() if metric == name}
+            for labels, value in sorted(series.items()):
+                lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+            continue
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], values[:-1]):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_number(float(bound))
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(float(values[-1]))}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    for name, help_text, series in extra_counters:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for labels, value in sorted(series.items()):
+            lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,243 @@
+"""Per-request performance instrumentation.
+
+PerformanceMiddleware times every request. For a sampled share of them
+(PERF_SAMPLE_RATE) it also wraps every database connection to count queries
+and their time, and fingerprints each statement so the same query repeated
+many times in one request - the classic N+1 loop - gets flagged together with
+the line of our code that issued it.
+
+Sampled requests get a Server-Timing header (visible in the browser's network
+panel) and a JSON log line on the "core.performance" logger: INFO normally,
+WARNING when the request was slow or had an N+1. Requests slower than
+PERF_SLOW_REQUEST_MS go into an in-memory ring buffer per process, shown at
+/admin/slow-requests/.
+
+MetricsMiddleware is the always-on, aggregate side: it only counts queries
+(no fingerprints) and feeds latency and query histograms to core/metrics.py.
+
+Both work sync and async, so under ASGI an async view such as the chat long
+poll is awaited directly instead of each request being handed to a thread.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from . import metrics
+
+logger = logging.getLogger('core.performance')
+
+SAMPLE_RATE = getattr(settings, 'PERF_SAMPLE_RATE', 1.0)  # Share of requests that get query details
+SLOW_REQUEST_MS = getattr(settings, 'PERF_SLOW_REQUEST_MS', 500)  # Slower than this goes in the ring buffer
+SLOW_REQUESTS_KEPT = getattr(settings, 'PERF_SLOW_REQUESTS_KEPT', 100)  # Size of the ring buffer
+DUPLICATE_THRESHOLD = getattr(settings, 'PERF_DUPLICATE_THRESHOLD', 5)  # Same query this often = N+1
+
+IN_LIST_RE = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')  # IN (%s, %s, ...) of any length
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")  # Values written straight into the SQL
+SPACE_RE = re.compile(r'\s+')
+
+_slow_requests = deque(maxlen=SLOW_REQUESTS_KEPT)
+_slow_requests_lock = threading.Lock()
+
+
+def fingerprint(sql):
+    """The shape of a statement with its values taken out, so repeats of one query compare equal"""
+    sql = IN_LIST_RE.sub('(...)', sql)
+    sql = LITERAL_RE.sub('?', sql)
+    return SPACE_RE.sub(' ', sql).strip()
+
+
+def _calling_code():
+    """'path/to/file.py:123 in function' for the innermost frame of our own code, if any"""
+    base_dir = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        if frame.filename.startswith(base_dir) and frame.filename != __file__:
+            return f'{frame.filename[len(base_dir) + 1:]}:{frame.lineno} in {frame.name}'
+    return None
+
+
+class QueryCounter:
+    """connection.execute_wrapper() hook counting the queries of one request and their time"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.recorded(sql)
+
+    def recorded(self, sql):
+        pass
+
+
+class QueryRecorder(QueryCounter):
+    """QueryCounter that also fingerprints each query to spot repeats"""
+
+    def __init__(self):
+        super().__init__()
+        self.fingerprints = Counter()
+        self.callers = {}  # fingerprint -> where it crossed DUPLICATE_THRESHOLD
+
+    def recorded(self, sql):
+        shape = fingerprint(sql)
+        self.fingerprints[shape] += 1
+        if self.fingerprints[shape] == DUPLICATE_THRESHOLD:
+            # Only look at the stack once per repeated query; doing it for every query is too slow
+            self.callers[shape] = _calling_code()
+
+    def duplicates(self):
+        """[{'sql', 'count', 'caller'}] for every query repeated at least DUPLICATE_THRESHOLD times"""
+        return [{'sql': shape, 'count': count, 'caller': self.callers.get(shape)}
+                for shape, count in self.fingerprints.most_common() if count >= DUPLICATE_THRESHOLD]
+
+
+def _wrap_connections(stack, wrapper):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(wrapper))
+
+
+def long_running(view):
+    """Mark a view that is slow on purpose (e.g. a long poll) so it stays out of the slow-request list"""
+    view.long_running = True
+    return view
+
+
+def slow_requests():
+    """The slow requests this process has kept, slowest first"""
+    with _slow_requests_lock:
+        return sorted(_slow_requests, key=lambda record: record['total_ms'], reverse=True)
+
+
+class PerformanceMiddleware:
+    """Time requests; for sampled ones also count queries and look for N+1 patterns"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        recorder = QueryRecorder() if random.random() < SAMPLE_RATE else None
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            if recorder:
+                _wrap_connections(stack, recorder)
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - started) * 1000
+        if recorder or self.is_slow(request, total_ms):
+            self.record(request, response, recorder, total_ms, getattr(request, 'user', None))
+        return response
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder() if random.random() < SAMPLE_RATE else None
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            if recorder:
+                _wrap_connections(stack, recorder)
+            response = await self.get_response(request)
+        total_ms = (time.perf_counter() - started) * 1000
+        if recorder or self.is_slow(request, total_ms):
+            # request.user would load the user synchronously, which async code must not do
+            user = await request.auser() if hasattr(request, 'auser') else None
+            self.record(request, response, recorder, total_ms, user)
+        return response
+
+    @staticmethod
+    def is_slow(request, total_ms):
+        match = request.resolver_match
+        return total_ms >= SLOW_REQUEST_MS and not getattr(match and match.func, 'long_running', False)
+
+    def record(self, request, response, recorder, total_ms, user):
+        """Log a request that was sampled or slow (most requests are neither, and skip this)"""
+        match = request.resolver_match
+        slow = self.is_slow(request, total_ms)
+        sampled = recorder is not None
+        record = {
+            'time': timezone.now().isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'user_id': user.pk if user is not None and user.is_authenticated else None,
+            'total_ms': round(total_ms, 1),
+            'sampled': sampled,
+        }
+        if recorder:
+            record.update(db_ms=round(recorder.seconds * 1000, 1), queries=recorder.count,
+                          duplicates=recorder.duplicates())
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={recorder.seconds * 1000:.1f};desc="{recorder.count} queries"',
+                f'app;dur={total_ms - recorder.seconds * 1000:.1f}',
+                f'total;dur={total_ms:.1f}',
+            ])
+
+        if slow:
+            with _slow_requests_lock:
+                _slow_requests.append(record)
+        level = logging.WARNING if slow or record.get('duplicates') else logging.INFO
+        logger.log(level, json.dumps(record), extra={'performance': record})
+        return response
+
+
+class MetricsMiddleware:
+    """Feed every request's latency and query count into the /metrics histograms (core/metrics.py)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        counter = QueryCounter()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            _wrap_connections(stack, counter)
+            response = self.get_response(request)
+        return self.record(request, response, counter, started)
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            _wrap_connections(stack, counter)
+            response = await self.get_response(request)
+        return self.record(request, response, counter, started)
+
+    def record(self, request, response, counter, started):
+        elapsed = time.perf_counter() - started
+
+        # Label by URL name, never by path, so ids don't create a new series per object
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        metrics.inc('http_requests_total', view=view, method=request.method, status=response.status_code)
+        metrics.observe('http_request_duration_seconds', elapsed, view=view)
+        metrics.observe('db_queries_per_request', counter.count, view=view)
+        metrics.inc('db_query_duration_seconds_total', counter.seconds, view=view)
+        metrics.maybe_flush()
+        return response
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('core', '0001_initial'),
+        ('items', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='items.item'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cartitem',
+            unique_together={('cart', 'item')},
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_duplicate_carts(apps, schema_editor):
+    """Fold extra carts into each user's oldest one so the unique constraint can be added"""
+    Cart = apps.get_model('core', 'Cart')
+    CartItem = apps.get_model('core', 'CartItem')
+    duplicated = (Cart.objects.values('user_id').annotate(carts=models.Count('id'))
+                  .filter(carts__gt=1).values_list('user_id', flat=True))
+    for user_id in list(duplicated):
+        keep, *extras = Cart.objects.filter(user_id=user_id).order_by('created_at', 'id')
+        for extra in extras:
+            for cart_item in CartItem.objects.filter(cart=extra):
+                existing = CartItem.objects.filter(cart=keep, item_id=cart_item.item_id).first()
+                if existing:
+                    existing.quantity += cart_item.quantity
+                    existing.save(update_fields=['quantity'])
+                else:
+                    CartItem.objects.create(cart=keep, item_id=cart_item.item_id,
+                                            quantity=cart_item.quantity)
+            extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_carts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cart', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,5 +1,9 @@
 from django.db import models  # Django's database tools
 from django.contrib.auth.models import User  # Built-in user accounts
+from django.contrib.auth.signals import user_logged_in  # Hook into logins
+from django.db.models.signals import post_init, pre_save, post_save, post_delete  # Hook into changes
+from django.dispatch import receiver  # Connect functions to events
+from django.utils import timezone  # Current time for defaults
 
 
 class Category(models.Model):
@@ -18,7 +22,7 @@ class Category(models.Model):
 
 class Cart(models.Model):
     """Each user has a shopping cart to save items they're interested in"""
-    user = models.ForeignKey(User, on_delete=models.CASCADE)  # Which user owns this cart
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='cart')  # One cart per user
     created_at = models.DateTimeField(auto_now_add=True)  # When the cart was created
     updated_at = models.DateTimeField(auto_now=True)  # When cart was last modified
 
@@ -42,3 +46,114 @@ class CartItem(models.Model):
 
     def __str__(self):
         return f"{self.quantity} x {self.item.name}"  # Show item name and quantity
+
+
+class OutboundEmail(models.Model):
+    """An email waiting to be sent, or already sent, by the send_queued_email command (see core/mail.py)"""
+    QUEUED, SENT, FAILED = 'queued', 'sent', 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    subject = models.CharField(max_length=255)  # Subject line
+    body = models.TextField()  # Plain-text body
+    html_body = models.TextField(blank=True)  # Optional HTML version
+    from_email = models.CharField(max_length=254)  # Sender address
+    to = models.JSONField(default=list)  # Recipient addresses
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)  # Extra headers
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)  # Where it is in the queue
+    attempts = models.PositiveSmallIntegerField(default=0)  # Times a worker has tried to send it
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # Not tried again before this
+    claim = models.CharField(max_length=32, null=True, blank=True)  # Which worker run is sending it right now
+    last_error = models.TextField(blank=True)  # Why the last attempt failed
+    created_at = models.DateTimeField(auto_now_add=True)  # When it was queued
+    sent_at = models.DateTimeField(null=True, blank=True)  # When the mail server accepted it
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(status='queued'),
+                         name='outboundemail_due_idx'),  # Messages due for sending, oldest first
+            models.Index(fields=['claim'], condition=models.Q(claim__isnull=False),
+                         name='outboundemail_claim_idx'),  # The batch one worker run claimed
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)}"  # Show subject and recipients
+
+
+class MediaBlob(models.Model):
+    """One stored upload and how many rows use it, so unused files can be deleted (see core/media.py)"""
+    name = models.CharField(max_length=255, unique=True)  # Path in the media storage
+    refs = models.PositiveIntegerField(default=0)  # Items, profiles and categories pointing at it
+    orphaned_at = models.DateTimeField(null=True, blank=True)  # When the last of them let go
+    created_at = models.DateTimeField(auto_now_add=True)  # When it was first used
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['orphaned_at'], condition=models.Q(refs=0),
+                         name='mediablob_orphaned_idx'),  # What collect_media_garbage looks at
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.refs} users)"  # Show the file and how many rows use it
+
+
+# These functions keep the cached navigation bar (core/navigation.py) up to date
+@receiver([post_save, post_delete], sender=Category)  # Run this when a category changes
+def refresh_navigation_categories(sender, **kwargs):
+    """Drop the cached category list and every cached page that shows categories"""
+    from . import caching, navigation
+    navigation.invalidate_categories()
+    caching.bump(caching.CATEGORIES, caching.ITEMS)  # Item pages show their category too
+
+
+@receiver(post_delete, sender=Cart)  # Run this when a whole cart is deleted
+@receiver([post_save, post_delete], sender=CartItem)  # Run this when an item is added or removed
+def refresh_navigation_cart_count(sender, instance, **kwargs):
+    """Drop the cached cart count of the user this cart belongs to"""
+    from . import navigation
+    user_id = instance.user_id if isinstance(instance, Cart) else instance.cart.user_id
+    navigation.invalidate_cart(user_id)
+
+
+@receiver(user_logged_in)  # Run this when someone logs in
+def merge_guest_cart(sender, request, user, **kwargs):
+    """Keep what a visitor put in their cart before logging in"""
+    from .cart import merge_session_cart
+    merge_session_cart(request, user)
+
+
+@receiver(pre_save, sender=Category)  # Run this before a category is saved
+def note_category_image_upload(sender, instance, **kwargs):
+    """Spot a newly uploaded category picture before Django stores it"""
+    from . import images
+    images.note_new_uploads(instance, 'image')
+
+
+@receiver(post_save, sender=Category)  # Run this after a category is saved
+def make_category_image_variants(sender, instance, **kwargs):
+    """Resize a newly uploaded category picture in the background"""
+    from . import images
+    images.process_new_uploads(instance)
+
+
+@receiver(post_init, sender=Category)  # Run this when a category is loaded or created in memory
+def remember_category_image(sender, instance, **kwargs):
+    """Note which stored file the category points at, to compare against after a save"""
+    from . import media
+    media.remember_names(instance, 'image')
+
+
+@receiver(post_save, sender=Category)  # Run this after a category is saved
+def count_category_image_use(sender, instance, created, update_fields=None, **kwargs):
+    """Move the reference count to the category's new picture"""
+    from . import media
+    media.update_references(instance, 'image', created=created, update_fields=update_fields)
+
+
+@receiver(post_delete, sender=Category)  # Run this after a category is deleted
+def release_category_image(sender, instance, **kwargs):
+    """The deleted category no longer uses its picture"""
+    from . import media
+    media.release_references(instance, 'image')
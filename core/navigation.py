@@ -0,0 +1,65 @@
+"""Cached numbers and lists shown in the navigation bar on every page.
+
+Per-user counters live in the cache under the user's id and are dropped by the
+Cart/CartItem/Message signals whenever they could have changed, so a page view
+normally costs no queries for them at all.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import CartItem, Category
+
+# How long cached navigation values live even if no signal clears them
+TIMEOUT = getattr(settings, 'NAVIGATION_CACHE_TIMEOUT', 300)
+
+CATEGORIES_KEY = 'nav:categories'
+
+
+def cart_key(user_id):
+    return f'nav:cart:{user_id}'
+
+
+def unread_key(user_id):
+    return f'nav:unread:{user_id}'
+
+
+def cart_count(user):
+    """How many different items are in this user's cart"""
+    count = cache.get(cart_key(user.pk))
+    if count is None:
+        # Count straight through the join; no need to create a cart just to count it
+        count = CartItem.objects.filter(cart__user=user).count()
+        cache.set(cart_key(user.pk), count, TIMEOUT)
+    return count
+
+
+def unread_count(user):
+    """How many messages other people sent this user that they have not read yet"""
+    from items import messaging  # items imports core, so import this lazily
+
+    count = cache.get(unread_key(user.pk))
+    if count is None:
+        count = messaging.unread_total(user)  # One SUM over the user's read-state rows
+        cache.set(unread_key(user.pk), count, TIMEOUT)
+    return count
+
+
+def category_list():
+    """Every category, shared by all users and all requests"""
+    categories = cache.get(CATEGORIES_KEY)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(CATEGORIES_KEY, categories, TIMEOUT)
+    return categories
+
+
+def invalidate_cart(user_id):
+    cache.delete(cart_key(user_id))
+
+
+def invalidate_unread(user_ids):
+    cache.delete_many([unread_key(user_id) for user_id in user_ids])
+
+
+def invalidate_categories():
+    cache.delete(CATEGORIES_KEY)
@@ -0,0 +1,230 @@
+"""Send reads to replica databases and writes to the primary.
+
+List the replica aliases from DATABASES in DATABASE_REPLICAS and add the router:
+
+    DATABASES = {
+        'default': {...},  # The primary
+        'replica1': {..., 'TEST': {'MIRROR': 'default'}},
+    }
+    DATABASE_REPLICAS = ['replica1']
+    DATABASE_ROUTERS = ['core.routers.PrimaryReplicaRouter']
+
+Only requests read from replicas. Everything else - management commands, the
+email worker - reads from the primary, so it always sees what it just wrote;
+code that only reads can opt in with `with replica_reads():`.
+
+Within a request, reads go to the primary instead when:
+
+- the request isn't a GET/HEAD, or its view is marked @read_from_primary;
+- the code is inside a transaction on the primary (read-then-write stays consistent);
+- the browser wrote something in the last DATABASE_PRIMARY_PIN_SECONDS, so people
+  always see their own new message or listing. ReplicaRoutingMiddleware sets a
+  cookie after any request that wrote to the primary;
+- every replica is down or further behind than DATABASE_REPLICA_MAX_LAG seconds.
+  Each process checks its replicas at most every DATABASE_REPLICA_CHECK_INTERVAL
+  seconds.
+
+Lag can only be measured on PostgreSQL streaming replicas. Other replicas count
+as up to date. Local testing with SQLite can point a "replica" at the same file
+as the primary, or at a copy of it.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PIN_SECONDS = getattr(settings, 'DATABASE_PRIMARY_PIN_SECONDS', 10)  # Reads stay on the primary this long after a write
+MAX_LAG = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5)  # Seconds behind before a replica is skipped
+CHECK_INTERVAL = getattr(settings, 'DATABASE_REPLICA_CHECK_INTERVAL', 5)  # Seconds between health checks
+PIN_COOKIE = 'primary_pin'
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class _RoutingState:
+    def __init__(self, pinned=False):
+        self.pinned = pinned  # Read from the primary for the rest of this request
+        self.wrote = False  # Something was written; pin this browser for a while
+        self.replica = None  # The replica chosen for this request, so all its reads agree
+        self.used_replica = False  # Some of this request's data may be behind the primary
+
+
+_state = contextvars.ContextVar('db_routing_state', default=None)
+_health = {}  # alias -> (checked at, usable)
+_health_lock = threading.Lock()
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def _pin_to_primary():
+    state = _state.get()
+    if state is not None:
+        state.pinned = True
+
+
+def read_from_primary(view):
+    """Decorate a view whose reads must see the latest writes (e.g. one woken up by a new chat message)"""
+    # A wrapper rather than process_view, which Django would have to run on a thread for async views
+    if iscoroutinefunction(view):
+        async def wrapper(request, *args, **kwargs):
+            _pin_to_primary()
+            return await view(request, *args, **kwargs)
+    else:
+        def wrapper(request, *args, **kwargs):
+            _pin_to_primary()
+            return view(request, *args, **kwargs)
+    wrapper = wraps(view)(wrapper)
+    wrapper.read_from_primary = True
+    return wrapper
+
+
+@contextmanager
+def replica_reads():
+    """Let reads in this block go to a replica outside a request, e.g. in a report that writes nothing"""
+    token = _state.set(_RoutingState())
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+def replica_lag(alias):
+    """Seconds the replica is behind the primary, or 0 when the database can't tell us
+
+    Raises DatabaseError if the replica can't be reached.
+    """
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor != 'postgresql':
+            cursor.execute('SELECT 1')  # Still make sure it answers
+            return 0
+        # NULL on a primary, or on a replica that hasn't replayed anything yet
+        cursor.execute('SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())')
+        lag = cursor.fetchone()[0]
+    return float(lag or 0)
+
+
+def is_usable(alias):
+    """Whether a replica is up and close enough behind, checked at most every CHECK_INTERVAL seconds"""
+    now = time.monotonic()
+    checked_at, usable = _health.get(alias, (None, False))
+    if checked_at is not None and now - checked_at < CHECK_INTERVAL:
+        return usable
+    with _health_lock:
+        checked_at, usable = _health.get(alias, (None, False))
+        if checked_at is not None and now - checked_at < CHECK_INTERVAL:
+            return usable  # Another thread just checked
+        try:
+            lag = replica_lag(alias)
+            usable = lag <= MAX_LAG
+            if not usable:
+                logger.warning('Replica %s is %.1fs behind; reading from the primary.', alias, lag)
+        except DatabaseError as e:
+            usable = False
+            logger.warning('Replica %s is unavailable (%s); reading from the primary.', alias, e)
+        _health[alias] = (now, usable)
+    return usable
+
+
+def used_replica():
+    """Whether the current request has read from a replica, so it may not see the very latest writes"""
+    state = _state.get()
+    return state is not None and state.used_replica
+
+
+def pick_replica():
+    """A random usable replica, or None"""
+    usable = [alias for alias in replicas() if is_usable(alias)]
+    return random.choice(usable) if usable else None
+
+
+class PrimaryReplicaRouter:
+    """Reads to a replica unless the primary is needed (see the module docstring), writes to the primary"""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.pinned:
+            return DEFAULT_DB_ALIAS  # Outside a request (and replica_reads()), or pinned
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if state.replica is None or not is_usable(state.replica):
+            state.replica = pick_replica()
+        state.used_replica = state.used_replica or state.replica is not None
+        return state.replica or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+            state.pinned = True  # Read what we just wrote for the rest of the request too
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True  # Same data either way
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False  # Replicas get their schema from the primary
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """Tell PrimaryReplicaRouter when a request must read from the primary, and pin browsers that wrote"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not replicas():
+            return self.get_response(request)
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(response, state)
+
+    async def __acall__(self, request):
+        if not replicas():
+            return await self.get_response(request)
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(response, state)
+
+    @staticmethod
+    def start(request):
+        pinned_until = request.COOKIES.get(PIN_COOKIE, '')
+        return _RoutingState(request.method not in READ_METHODS or (
+            pinned_until.isdigit() and int(pinned_until) > time.time()))
+
+    @staticmethod
+    def finish(response, state):
+        if state.wrote:
+            response.set_cookie(PIN_COOKIE, str(int(time.time() + PIN_SECONDS)), max_age=PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,238 @@
+"""Static files that browsers download once.
+
+`collectstatic` with CompressedManifestStaticFilesStorage (settings.STORAGES)
+minifies CSS (and JS, if the optional rjsmin package is installed), gives every
+file a content-hashed name such as css/style.3f2a9c1e.css, and writes .gz and
+.br copies next to each text file. The .br copies need the optional `brotli`
+package; without it only .gz is written.
+
+StaticFilesMiddleware serves STATIC_ROOT when DEBUG is off. Each file goes out
+in the best encoding the browser accepts. Hashed names are cached for a year
+as `immutable`, so a repeat visit doesn't even ask for them again; a change
+gets a new name. Unhashed names are cached briefly and revalidate with their
+ETag.
+"""
+import gzip
+import json
+import mimetypes
+import os
+import re
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_etags
+
+try:
+    import brotli
+except ImportError:  # Optional: only gzip copies are written without it
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:  # Optional: JS is then only compressed, which saves most of the bytes anyway
+    rjsmin = None
+
+COMPRESSIBLE = ('.css', '.js', '.map', '.json', '.svg', '.txt', '.html', '.xml', '.ico')
+MIN_COMPRESS_SIZE = 256  # Bytes; smaller files aren't worth an extra lookup
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # Most preferred first
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+MUTABLE_MAX_AGE = getattr(settings, 'STATIC_MAX_AGE', 60)  # Seconds for files without a hash in their name
+
+# Strings and unquoted url(...) are single tokens: nothing inside them is a comment or collapsible space
+CSS_TOKEN_RE = re.compile(r'''"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|url\([^"')]*\)'''
+                          r'''|/\*.*?\*/|\s+|[{};,:]|[^"'/\s{};,:]+|/''', re.DOTALL | re.IGNORECASE)
+NO_SPACE_AROUND = set('{};,')
+
+
+def minify_css(css):
+    """CSS without comments and with whitespace collapsed; strings are left exactly as they were"""
+    tokens = []
+    for token in CSS_TOKEN_RE.findall(css):
+        if token.startswith('/*'):
+            continue
+        if token.isspace():
+            if tokens and tokens[-1] != ' ':
+                tokens.append(' ')
+            continue
+        if token in NO_SPACE_AROUND and tokens and tokens[-1] == ' ':
+            tokens.pop()  # No space before { } ; ,
+        if token == '}' and tokens and tokens[-1] == ';':
+            tokens.pop()  # The last declaration needs no semicolon
+        if tokens and tokens[-1] == ' ' and len(tokens) > 1 and tokens[-2] in NO_SPACE_AROUND | {':'}:
+            tokens.pop()  # No space after { } ; , or a declaration's colon
+        tokens.append(token)
+    return ''.join(tokens).strip()
+
+
+def minify(name, content):
+    """Minified text of a CSS or JS file, or None for other files"""
+    if name.endswith('.css'):
+        return minify_css(content)
+    if name.endswith('.js') and rjsmin is not None:
+        return rjsmin.jsmin(content)
+    return None
+
+
+def compressed_copies(data):
+    """{suffix: bytes} of the compressed copies worth keeping"""
+    copies = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        copies['.br'] = brotli.compress(data, quality=11)
+    return {suffix: copy for suffix, copy in copies.items() if len(copy) < len(data) * 0.95}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest (content-hashed) static storage that also minifies and writes .gz/.br copies"""
+
+    def _save(self, name, content):
+        if name.endswith(('.css', '.js')):
+            text = b''.join(content.chunks()).decode('utf-8')  # chunks() rewinds; hashing leaves it at the end
+            minified = minify(name, text)
+            content = ContentFile((minified if minified is not None else text).encode('utf-8'))
+        return super()._save(name, content)
+
+    def post_process(self, paths, dry_run=False, **options):
+        names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not isinstance(processed, Exception) and not dry_run:
+                names.update({name, hashed_name} if hashed_name else {name})
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        names.update(path for path in paths if path not in names)  # Files the hashing left alone
+        for name in sorted(names):
+            if not name.endswith(COMPRESSIBLE) or not self.exists(name):
+                continue
+            with self.open(name) as f:
+                data = f.read()
+            if len(data) < MIN_COMPRESS_SIZE:
+                continue
+            for suffix, copy in compressed_copies(data).items():
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(copy))
+
+
+class StaticFile:
+    """One file under STATIC_ROOT and its compressed copies"""
+
+    def __init__(self, path, immutable):
+        self.path = path
+        self.immutable = immutable
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'image/svg+xml'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self.variants = {None: self._stat(path)}  # encoding -> (path, size, mtime)
+        for encoding, suffix in ENCODINGS:
+            if os.path.exists(path + suffix):
+                self.variants[encoding] = self._stat(path + suffix)
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return path, stat.st_size, int(stat.st_mtime)
+
+    def choose(self, accept_encoding):
+        """(encoding, path, size, mtime) of the best copy the client accepts"""
+        accepted = {}
+        for part in accept_encoding.lower().split(','):
+            coding, _, params = part.strip().partition(';')
+            quality = 1.0
+            if params.strip().startswith('q='):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding.strip()] = quality
+        for encoding, _ in ENCODINGS:
+            if encoding in self.variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return (encoding, *self.variants[encoding])
+        return (None, *self.variants[None])
+
+
+def _manifest_names(root):
+    try:
+        with open(os.path.join(root, 'staticfiles.json')) as f:
+            return set(json.load(f).get('paths', {}).values())
+    except (OSError, ValueError):
+        return set()
+
+
+class StaticFilesMiddleware:
+    """Serve collected static files with content negotiation and long-lived caching (see module docstring)"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if settings.DEBUG or not settings.STATIC_ROOT or not os.path.isdir(settings.STATIC_ROOT):
+            raise MiddlewareNotUsed  # runserver serves the source files in development
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.prefix = settings.STATIC_URL if settings.STATIC_URL.startswith('/') else '/' + settings.STATIC_URL
+        self.files = self.scan(str(settings.STATIC_ROOT))
+
+    @staticmethod
+    def scan(root):
+        """{url path: StaticFile} for everything collected; read once, when the process starts"""
+        immutable = _manifest_names(root)
+        compressed = tuple(suffix for _, suffix in ENCODINGS)
+        files = {}
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                if name.endswith(compressed) and os.path.exists(path.rsplit('.', 1)[0]):
+                    continue  # A compressed copy; served in place of its original
+                files[name] = StaticFile(path, name in immutable)
+        return files
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        static_file = self.find(request)
+        if static_file is None:
+            return self.get_response(request)
+        return self.serve(request, static_file)
+
+    async def __acall__(self, request):
+        static_file = self.find(request)
+        if static_file is None:
+            return await self.get_response(request)
+        return self.serve(request, static_file)
+
+    def find(self, request):
+        """The collected file a request asks for, if any"""
+        if not request.path_info.startswith(self.prefix) or request.method not in ('GET', 'HEAD'):
+            return None
+        return self.files.get(request.path_info[len(self.prefix):])
+
+    def serve(self, request, static_file):
+        encoding, path, size, mtime = static_file.choose(request.headers.get('Accept-Encoding', ''))
+        etag = f'"{size:x}-{mtime:x}{"-" + encoding if encoding else ""}"'
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        elif request.method == 'HEAD':
+            response = HttpResponse(content_type=static_file.content_type)
+            response['Content-Length'] = size
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=static_file.content_type)
+            response['Content-Length'] = size
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        if len(static_file.variants) > 1:
+            response['Vary'] = 'Accept-Encoding'
+        if static_file.immutable:
+            response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response['Cache-Control'] = f'public, max-age={MUTABLE_MAX_AGE}'
+        return response
@@ -0,0 +1,34 @@
+"""Django template backend that times every page render for /metrics"""
+import time
+
+from django.template.backends.django import DjangoTemplates
+
+from . import metrics
+
+
+class TimedTemplate:
+    """Wraps a backend template; renders it and records how long that took"""
+
+    def __init__(self, template, name):
+        self.template = template
+        self.name = name
+
+    def __getattr__(self, attr):  # origin, backend, ... pass straight through
+        return getattr(self.template, attr)
+
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.observe('template_render_seconds', time.perf_counter() - started, template=self.name)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """The normal Django template engine, with render times recorded per template name"""
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name), template_name)
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code), '<string>')
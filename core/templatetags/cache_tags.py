@@ -0,0 +1,53 @@
+from django import template
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+
+from core import caching
+
+register = template.Library()
+
+
+class CachedFragmentNode(template.Node):
+    def __init__(self, nodelist, name, namespaces, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.namespaces = namespaces
+        self.vary_on = vary_on
+
+    def render(self, context):
+        name = self.name.resolve(context)
+        namespaces = [namespace.strip() for namespace in self.namespaces.resolve(context).split(',')]
+        key = caching.make_key(f'fragment:{name}', namespaces,
+                               [variable.resolve(context) for variable in self.vary_on])
+        content = cache.get(key)
+        caching.record(f'fragment:{name}', hit=content is not None)
+        if content is None:
+            content = self.nodelist.render(context)
+            cache.set(key, content, caching.TIMEOUT)
+        return mark_safe(content)
+
+
+@register.tag('cachefragment')
+def do_cachefragment(parser, token):
+    """Cache the enclosed template until the data it shows changes
+
+    Usage::
+
+        {% cachefragment "nav_categories" "categories" %} ... {% endcachefragment %}
+        {% cachefragment "item_card" "items,categories" item.pk %} ... {% endcachefragment %}
+
+    The second argument lists the caching namespaces (comma separated) the
+    fragment depends on; anything after it becomes part of the key. Only put
+    content in here that looks the same for every user.
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires a name and namespaces.")
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        parser.compile_filter(bits[2]),
+        [parser.compile_filter(bit) for bit in bits[3:]],
+    )
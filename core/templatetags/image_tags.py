@@ -0,0 +1,22 @@
+from django import template
+
+from core import images
+
+register = template.Library()
+
+
+@register.filter
+def srcset(field_file, extension='webp'):
+    """srcset value listing the resized copies of an image, or '' until they exist
+
+    Usage::
+
+        <picture>
+            <source type="image/webp" srcset="{{ item.image|srcset }}" sizes="(max-width: 600px) 100vw, 320px">
+            <img src="{{ item.image.url }}" srcset="{{ item.image|srcset:'jpg' }}"
+                 sizes="(max-width: 600px) 100vw, 320px" alt="{{ item.name }}" loading="lazy">
+        </picture>
+    """
+    if not field_file or not images.has_variants(field_file.name):
+        return ''
+    return ', '.join(f'{url} {width}w' for url, width in images.variant_urls(field_file.name, extension))
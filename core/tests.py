@@ -1,3 +1,842 @@
-from django.test import TestCase
+import fcntl
+import gc
+import io
+import json
+import os
+import smtplib
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import mail as outbox
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.mail.backends import locmem
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, router, transaction
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import ResolverMatch, resolve, reverse
+from django.utils import timezone
+from PIL import Image as PILImage
+
+from items.models import Item
+from . import caching, cart, images, mail, media, metrics, middleware, routers, staticfiles
+from .models import CartItem, Category, MediaBlob, OutboundEmail
+
+REPLICA = 'replica'
+# A replica that mirrors the primary's test database, like the DATABASE_REPLICAS example in settings.py.
+# Registered before the test databases are set up, so the runner configures the mirror
+connections.settings.setdefault(REPLICA, {
+    **connections.settings[DEFAULT_DB_ALIAS],
+    'OPTIONS': {},  # Read-only: none of the primary's write-lock tuning
+    'TEST': {**connections.settings[DEFAULT_DB_ALIAS]['TEST'], 'MIRROR': DEFAULT_DB_ALIAS},
+})
+
+
+class MetricsTests(SimpleTestCase):
+    """Per-thread shards and per-process files of core/metrics.py"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(metrics, 'METRICS_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def total(self, name='messages_sent_total'):
+        counters, _ = metrics.collect()
+        return counters.get((name, ()), 0)
+
+    def test_finished_threads_leave_no_shards(self):
+        before = metrics.current('messages_sent_total')
+        shards = len(metrics._shards)
+        for _ in range(50):  # Like 50 ASGI requests, each on a thread of its own
+            thread = threading.Thread(target=metrics.inc, args=('messages_sent_total',))
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertLessEqual(len(metrics._shards), shards)
+        self.assertEqual(metrics.current('messages_sent_total'), before + 50)
+
+    def test_exited_process_files_are_retired(self):
+        metrics.inc('messages_sent_total')
+        metrics.flush()
+        ours = self.total()
+        # A process that wrote 7 and has exited: its lock file is there but nobody holds it
+        metrics._write(os.path.join(self.directory, '99999-deadbeef.json'),
+                       {('messages_sent_total', ()): 7}, {})
+        open(os.path.join(self.directory, '99999-deadbeef.lock'), 'w').close()
+        self.assertEqual(self.total(), ours + 7)
+        self.assertFalse({'99999-deadbeef.json', '99999-deadbeef.lock'} & set(os.listdir(self.directory)))
+        self.assertEqual(self.total(), ours + 7)  # Still counted, from retired.json
+
+    def test_running_process_files_are_kept(self):
+        path = os.path.join(self.directory, '99998-cafebabe')
+        metrics._write(f'{path}.json', {('messages_sent_total', ()): 3}, {})
+        with open(f'{path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)  # Held, as by a live worker
+            self.assertEqual(metrics.retire_exited(), 0)
+            self.assertTrue(os.path.exists(f'{path}.json'))
+
+    def test_exit_flush_only_for_reporting_processes(self):
+        metrics.inc('messages_sent_total')
+        with mock.patch.object(metrics, '_reporting', False):  # E.g. a command that saved an item
+            metrics._flush_at_exit()
+        self.assertEqual(os.listdir(self.directory), [])
+        with mock.patch.object(metrics, '_reporting', True):  # A server or the email worker
+            metrics._flush_at_exit()
+        self.assertTrue(any(name.endswith('.json') for name in os.listdir(self.directory)))
+
+    def test_tests_keep_out_of_the_real_directory(self):
+        self.assertNotEqual(os.path.realpath(settings.METRICS_DIR),
+                            os.path.realpath(os.path.join(settings.BASE_DIR, 'metrics')))
+
+    def test_scrapes_only_from_loopback_by_default(self):
+        client = Client()
+        self.assertEqual(client.get(reverse('metrics')).status_code, 200)  # The test client is 127.0.0.1
+        self.assertEqual(client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7').status_code, 403)
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA])
+class ReplicaRoutingTests(TransactionTestCase):
+    """Which database PrimaryReplicaRouter picks inside a request (see core/routers.py)
+
+    Not a TestCase: its transaction around each test would keep every read on the primary.
+    """
+    databases = {DEFAULT_DB_ALIAS, REPLICA}
+
+    def setUp(self):
+        routers._health.clear()
+        self.factory = RequestFactory()
+
+    def handle(self, request, view=None):
+        """Run `view` behind ReplicaRoutingMiddleware; returns (response, database its read went to)"""
+        used = []
+
+        def get_response(request):
+            if view is not None:
+                view(request)
+            used.append(router.db_for_read(Item))
+            return HttpResponse()
+
+        response = routers.ReplicaRoutingMiddleware(get_response)(request)
+        return response, used[0]
+
+    def test_reads_go_to_the_replica(self):
+        _, database = self.handle(self.factory.get('/'))
+        self.assertEqual(database, REPLICA)
+
+    def test_reads_outside_requests_go_to_the_primary(self):
+        # E.g. a management command reading back what it just wrote
+        self.assertEqual(Item.objects.all().db, DEFAULT_DB_ALIAS)
+        with routers.replica_reads():  # Unless it opts in
+            self.assertEqual(Item.objects.all().db, REPLICA)
+
+    def test_email_worker_reads_its_claims_from_the_primary(self):
+        OutboundEmail.objects.create(subject='Hi', body='Hello', from_email='site@example.com', to=['a@example.com'])
+        with CaptureQueriesContext(connections[REPLICA]) as replica_queries:
+            claimed = mail.claim()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(len(replica_queries), 0)  # A lagging replica can't hide the rows just claimed
+
+    def test_writes_stay_on_the_primary(self):
+        _, database = self.handle(self.factory.post('/'))
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_write(Item), DEFAULT_DB_ALIAS)
+
+    def test_read_from_primary_views(self):
+        _, database = self.handle(self.factory.get('/'), routers.read_from_primary(lambda request: None))
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+
+    def test_async_read_from_primary_views(self):
+        used = []
+
+        @routers.read_from_primary
+        async def view(request):
+            used.append(router.db_for_read(Item))
+            return HttpResponse()
+
+        middleware = routers.ReplicaRoutingMiddleware(view)
+        async_to_sync(middleware)(self.factory.get('/'))
+        self.assertEqual(used, [DEFAULT_DB_ALIAS])
+
+    def test_browser_that_wrote_is_pinned(self):
+        response, _ = self.handle(self.factory.get('/'), lambda request: router.db_for_write(Item))
+        cookie = response.cookies[routers.PIN_COOKIE].value
+        # The next reads from that browser see its write
+        request = self.factory.get('/')
+        request.COOKIES[routers.PIN_COOKIE] = cookie
+        _, database = self.handle(request)
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+        # ...and other browsers' reads still go to the replica
+        response, database = self.handle(self.factory.get('/'))
+        self.assertEqual(database, REPLICA)
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_unhealthy_replica_falls_back_to_the_primary(self):
+        with mock.patch.object(routers, 'replica_lag', side_effect=DatabaseError('connection refused')):
+            _, database = self.handle(self.factory.get('/'))
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+        routers._health.clear()
+        with mock.patch.object(routers, 'replica_lag', return_value=routers.MAX_LAG + 1):  # Too far behind
+            _, database = self.handle(self.factory.get('/'))
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+
+    def test_facet_rebuild_does_not_pin(self):
+        from items import facets
+        response, _ = self.handle(self.factory.get('/'), lambda request: facets.rebuild())
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+
+class CachingTests(TestCase):
+    """Page and fragment caching keyed on namespace versions (core/caching.py, templatetags/cache_tags.py)"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.factory = RequestFactory()
+        self.calls = 0
+
+        @caching.cache_response('listing', [caching.ITEMS])
+        def view(request, **kwargs):
+            self.calls += 1
+            return HttpResponse(f'render {self.calls}')
+        self.view = view
+
+    def get(self, path='/items/', user=None, **extra):
+        request = self.factory.get(path, **extra)
+        request.user = user or AnonymousUser()
+        return self.view(request)
+
+    def render_fragment(self, **context):
+        return Template('{% load cache_tags %}{% cachefragment "nav" "categories" section %}'
+                        '{{ label }}{% endcachefragment %}').render(Context(context))
+
+    def test_anonymous_requests_share_one_render(self):
+        first, second = self.get(), self.get()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.content, first.content)
+        self.get('/items/?page=2')  # Another query string is another page
+        self.assertEqual(self.calls, 2)
+
+    def test_authenticated_and_session_requests_bypass_the_cache(self):
+        user = User.objects.create_user('member', 'member@example.com', 'pw')
+        self.get()
+        self.assertEqual(self.get(user=user).content, b'render 2')
+        self.assertEqual(self.get(user=user).content, b'render 3')
+        self.get(HTTP_COOKIE=f'{settings.SESSION_COOKIE_NAME}=abc')  # A guest with a cart
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(caching.stats(), {'listing': {'hits': 0, 'misses': 1}})  # Bypasses aren't counted
+
+    def test_bump_invalidates_entries(self):
+        self.get()
+        caching.bump(caching.CATEGORIES)  # Not something this page shows
+        self.get()
+        self.assertEqual(self.calls, 1)
+        caching.bump(caching.ITEMS)
+        self.assertEqual(self.get().content, b'render 2')
+        self.assertEqual(self.get().content, b'render 2')
+
+    def test_saving_an_item_bumps_its_namespace(self):
+        self.get()
+        Item.objects.create(owner=User.objects.create_user('owner', 'owner@example.com', 'pw'),
+                            category=Category.objects.create(name='Tools'), item_type='swap', name='Drill')
+        self.get()
+        self.assertEqual(self.calls, 2)
+
+    def test_responses_setting_cookies_are_not_cached(self):
+        @caching.cache_response('cookie', [caching.ITEMS])
+        def view(request):
+            self.calls += 1
+            response = HttpResponse('hello')
+            response.set_cookie('seen', '1')
+            return response
+        request = self.factory.get('/')
+        request.user = AnonymousUser()
+        view(request)
+        view(request)
+        self.assertEqual(self.calls, 2)
+
+    def test_hits_and_misses_are_counted(self):
+        for _ in range(3):
+            self.get()
+        self.get('/items/?page=2')
+        self.assertEqual(caching.stats(), {'listing': {'hits': 2, 'misses': 2}})
+        output = io.StringIO()
+        call_command('cache_stats', stdout=output)
+        self.assertIn('listing', output.getvalue())
+        self.assertIn('50.0%', output.getvalue())
+
+    def test_fragments_are_cached_until_their_namespace_is_bumped(self):
+        self.assertEqual(self.render_fragment(section='top', label='first'), 'first')
+        self.assertEqual(self.render_fragment(section='top', label='second'), 'first')  # From the cache
+        self.assertEqual(self.render_fragment(section='footer', label='second'), 'second')  # Varies on section
+        Category.objects.create(name='Garden')  # Its signal bumps "categories"
+        self.assertEqual(self.render_fragment(section='top', label='third'), 'third')
+        self.assertEqual(caching.stats(), {'fragment:nav': {'hits': 1, 'misses': 3}})
+
+
+class StaticFilesTests(SimpleTestCase):
+    """CSS minifying, encoding negotiation and caching headers of core/staticfiles.py"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.write('css/style.3f2a9c1e.css', b'body{color:red}' * 40, '.gz', '.br')
+        self.write('css/style.css', b'body{color:red}' * 40, '.gz')
+        self.write('img/logo.png', b'\x89PNG')
+        with open(os.path.join(self.root, 'staticfiles.json'), 'w') as manifest:
+            json.dump({'version': '1.1', 'paths': {'css/style.css': 'css/style.3f2a9c1e.css'}}, manifest)
+        override = override_settings(DEBUG=False, STATIC_ROOT=self.root, STATIC_URL='/static/')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.middleware = staticfiles.StaticFilesMiddleware(lambda request: HttpResponse('from the view'))
+        self.factory = RequestFactory()
+
+    def write(self, name, data, *suffixes):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for suffix in ('', *suffixes):
+            with open(path + suffix, 'wb') as f:
+                f.write(data + suffix.encode())  # Each copy its own bytes, to tell them apart
+
+    def get(self, path, accept_encoding='', method='get', **headers):
+        request = getattr(self.factory, method)(path, headers={'accept-encoding': accept_encoding, **headers})
+        response = self.middleware(request)
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_minify_css(self):
+        cases = [
+            ('a :hover { color : red ; }', 'a :hover{color :red}'),  # "a :hover" is not "a:hover"
+            ('/* header */ a , b { margin: 0  auto; }\n/* end */', 'a,b{margin:0 auto}'),
+            ('p::before { content: "/* kept */  {two;  spaces}"; }', 'p::before{content:"/* kept */  {two;  spaces}"}'),
+            ("q { quotes: 'it\\'s  ' ; }", "q{quotes:'it\\'s  '}"),
+            ('b { background: url(/img/*x*/a.png) no-repeat, url( "a b.png" ) ; }',
+             'b{background:url(/img/*x*/a.png) no-repeat,url( "a b.png" )}'),
+            ('i { background: url(data:image/png;base64,AA==) }', 'i{background:url(data:image/png;base64,AA==)}'),
+            ('@media screen and (max-width: 600px) and (orientation: landscape) {\n  .a  >  .b { margin: 0; }\n}',
+             '@media screen and (max-width:600px) and (orientation:landscape){.a > .b{margin:0}}'),
+        ]
+        for css, minified in cases:
+            self.assertEqual(staticfiles.minify_css(css), minified)
+
+    def test_choose_follows_accept_encoding(self):
+        static_file = self.middleware.files['css/style.3f2a9c1e.css']
+        cases = [
+            ('', None), ('identity', None), ('gzip', 'gzip'), ('gzip, br', 'br'), ('br;q=0, gzip', 'gzip'),
+            ('br; q=0.0, gzip;q=0.5', 'gzip'), ('gzip;q=0', None), ('br;q=0,gzip;q=0', None),
+            ('*', 'br'), ('gzip, *;q=0', 'gzip'), ('*;q=0', None), (' GZIP ; q=0.8 ', 'gzip'), ('br;q=high', None),
+        ]
+        for accept_encoding, encoding in cases:
+            self.assertEqual(static_file.choose(accept_encoding)[0], encoding, accept_encoding)
+
+    def test_serves_the_best_copy_with_etag_and_vary(self):
+        response = self.get('/static/css/style.3f2a9c1e.css', 'gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(self.body(response), b'body{color:red}' * 40 + b'.br')
+        self.assertEqual(response['Content-Length'], str(len(b'body{color:red}' * 40 + b'.br')))
+        self.assertEqual(response['Content-Type'], 'text/css; charset=utf-8')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        gzipped = self.get('/static/css/style.3f2a9c1e.css', 'gzip')
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertNotEqual(gzipped['ETag'], response['ETag'])  # Each encoding is its own representation
+        plain = self.get('/static/img/logo.png', 'gzip, br')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertNotIn('Vary', plain)  # Nothing to choose between
+
+    def test_matching_etag_gets_304(self):
+        etag = self.get('/static/css/style.css', 'gzip')['ETag']
+        revalidated = self.get('/static/css/style.css', 'gzip', **{'if-none-match': etag})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.content, b'')
+        self.assertEqual(revalidated['ETag'], etag)
+        # The same ETag for the uncompressed copy is a different representation
+        self.assertEqual(self.get('/static/css/style.css', '', **{'if-none-match': etag}).status_code, 200)
+
+    def test_only_manifest_names_are_immutable(self):
+        self.assertEqual(self.get('/static/css/style.3f2a9c1e.css')['Cache-Control'],
+                         f'public, max-age={staticfiles.IMMUTABLE_MAX_AGE}, immutable')
+        for path in ('/static/css/style.css', '/static/img/logo.png'):
+            self.assertEqual(self.get(path)['Cache-Control'], f'public, max-age={staticfiles.MUTABLE_MAX_AGE}')
+
+    def test_head_sends_headers_only(self):
+        response = self.get('/static/css/style.css', 'gzip', method='head')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Content-Length'], str(len(b'body{color:red}' * 40 + b'.gz')))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_other_requests_reach_the_view(self):
+        for path, method in (('/static/missing.css', 'get'), ('/items/', 'get'), ('/static/css/style.css', 'post')):
+            self.assertEqual(self.get(path, method=method).content, b'from the view', path)
+
+    def test_not_used_in_debug(self):
+        with override_settings(DEBUG=True), self.assertRaises(MiddlewareNotUsed):
+            staticfiles.StaticFilesMiddleware(lambda request: HttpResponse())
+
+
+class PerformanceTests(TestCase):
+    """PerformanceMiddleware and QueryRecorder (core/middleware.py)"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        for name, value in (('SAMPLE_RATE', 1.0), ('_slow_requests', deque(maxlen=10))):
+            patcher = mock.patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_view(self, view, path='/'):
+        request = self.factory.get(path)
+        request.resolver_match = ResolverMatch(view, (), {}, url_name='test_view')
+        with self.assertLogs('core.performance', 'INFO') as logs:
+            response = middleware.PerformanceMiddleware(view)(request)
+        return response, json.loads(logs.records[-1].getMessage())
+
+    def test_repeated_query_is_reported_with_its_caller(self):
+        def view(request):
+            for pk in range(middleware.DUPLICATE_THRESHOLD):
+                User.objects.filter(pk=pk).exists()  # One query per loop turn: an N+1
+            Category.objects.count()
+            return HttpResponse()
+
+        response, record = self.run_view(view)
+        self.assertEqual(record['queries'], middleware.DUPLICATE_THRESHOLD + 1)
+        [duplicate] = record['duplicates']
+        self.assertEqual(duplicate['count'], middleware.DUPLICATE_THRESHOLD)
+        self.assertIn('"auth_user"', duplicate['sql'])
+        self.assertRegex(duplicate['caller'], r'^core/tests\.py:\d+ in view$')
+
+    def test_few_repeats_are_not_reported(self):
+        def view(request):
+            for pk in range(middleware.DUPLICATE_THRESHOLD - 1):
+                User.objects.filter(pk=pk).exists()
+            return HttpResponse()
+
+        self.assertEqual(self.run_view(view)[1]['duplicates'], [])
+
+    def test_sampled_requests_get_server_timing(self):
+        def view(request):
+            Category.objects.count()
+            return HttpResponse()
+
+        response, _ = self.run_view(view)
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="1 queries", app;dur=[\d.]+, total;dur=[\d.]+$')
+        with mock.patch.object(middleware, 'SAMPLE_RATE', 0.0):
+            request = self.factory.get('/')
+            request.resolver_match = None
+            self.assertNotIn('Server-Timing', middleware.PerformanceMiddleware(view)(request))
+
+    def test_long_running_views_stay_out_of_the_slow_list(self):
+        def view(request):
+            return HttpResponse()
+
+        with mock.patch.object(middleware, 'SLOW_REQUEST_MS', 0):  # Every request counts as slow
+            self.run_view(view, '/slow/')
+            self.run_view(middleware.long_running(lambda request: HttpResponse()), '/poll/')
+        self.assertEqual([record['path'] for record in middleware.slow_requests()], ['/slow/'])
+        # The chat long poll is marked
+        self.assertTrue(resolve(reverse('items:wait_messages', args=[1])).func.long_running)
+
+    @override_settings(STORAGES={**settings.STORAGES, 'staticfiles': {  # No collectstatic manifest in tests
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+    def test_admin_index_links_to_slow_requests(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        self.assertContains(self.client.get(reverse('admin:index')), f'href="{reverse("slow_requests")}"')
+        self.assertEqual(self.client.get(reverse('slow_requests')).status_code, 200)
+
+
+class ImageVariantTests(SimpleTestCase):
+    def test_variant_names_keep_the_extension(self):
+        self.assertEqual(images.variant_name('items/bike.jpg', 320, 'webp'), 'items/bike.jpg-320w.webp')
+        # Two uploads that differ only in their extension get copies of their own
+        self.assertNotEqual(images.variant_name('items/bike.jpg', 320, 'webp'),
+                            images.variant_name('items/bike.png', 320, 'webp'))
+
+
+class ImageMetadataTests(TestCase):
+    """Uploads lose their EXIF/GPS block before they are stored, not only in the resized copies"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(MEDIA_ROOT=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        variant_storage = FileSystemStorage(os.path.join(directory.name, 'variants'))
+        variants = mock.patch.object(images, 'variant_storage', variant_storage)
+        variants.start()
+        self.addCleanup(variants.stop)
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.category = Category.objects.create(name='Tools')
+
+    def photo(self, image_format='JPEG', exif=True):
+        """A 40x20 picture; with EXIF, taken with the camera turned (so it shows 20x40) somewhere in Dhaka"""
+        options = {}
+        if exif:
+            tags = PILImage.Exif()
+            tags[0x0112] = 6  # Orientation: rotate 90 degrees
+            tags[0x010f] = 'PhoneCam'
+            tags[0x8825] = {1: 'N', 2: (23.0, 46.0, 0.0)}  # GPS position
+            options = {'exif': tags.tobytes()}
+            if image_format == 'JPEG':
+                options['comment'] = b'Home'
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (40, 20), 'red').save(buffer, image_format, **options)
+        return buffer.getvalue()
+
+    def opened(self, name):
+        with default_storage.open(name, 'rb') as stored:
+            image = PILImage.open(io.BytesIO(stored.read()))
+            image.load()
+        return image
+
+    def item(self, image):
+        return Item.objects.create(owner=self.owner, category=self.category, item_type='rent', name='Drill',
+                                   image=image)
+
+    def test_uploaded_originals_are_stored_without_metadata(self):
+        for image_format, extension in (('JPEG', 'jpg'), ('PNG', 'png'), ('WEBP', 'webp')):
+            item = self.item(SimpleUploadedFile(f'photo.{extension}', self.photo(image_format)))
+            stored = self.opened(item.image.name)
+            self.assertEqual(dict(stored.getexif()), {}, image_format)
+            self.assertNotIn('comment', stored.info)
+            self.assertEqual(stored.size, (20, 40), image_format)  # Turned upright before the tag went
+
+    def test_uploads_without_metadata_are_stored_as_they_came(self):
+        data = self.photo(exif=False)
+        item = self.item(SimpleUploadedFile('photo.jpg', data))
+        with default_storage.open(item.image.name, 'rb') as stored:
+            self.assertEqual(stored.read(), data)
+
+    def test_command_strips_files_stored_before(self):
+        old = media.ContentAddressedStorage().save('items/photo.jpg', ContentFile(self.photo()))
+        first, second = self.item(old), self.item(old)
+        output = io.StringIO()
+        call_command('strip_image_metadata', stdout=output)
+        self.assertIn('Stripped metadata from the images of 2 rows', output.getvalue())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertNotEqual(first.image.name, old)
+        self.assertRegex(first.image.name, r'^items/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(dict(self.opened(first.image.name).getexif()), {})
+        self.assertTrue(images.has_variants(first.image.name))
+        self.assertEqual(MediaBlob.objects.get(name=old).refs, 0)  # Left for collect_media_garbage
+        self.assertEqual(MediaBlob.objects.get(name=first.image.name).refs, 2)
+
+
+class CartTests(TestCase):
+    """DatabaseCart.add() when two requests add the same item at the same moment"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        cls.item = Item.objects.create(
+            owner=User.objects.create_user('owner', 'owner@example.com', 'pw'),
+            category=Category.objects.create(name='Tools'), item_type='rent', name='Drill',
+            description='Cordless', price=5, location='Dhaka', contact_info='owner@example.com',
+            image='items/drill.jpg',
+        )
+
+    def quantities(self):
+        return list(CartItem.objects.filter(cart__user=self.user).values_list('quantity', flat=True))
+
+    def test_add_increments(self):
+        shopping = cart.DatabaseCart(self.user)
+        shopping.add(self.item)
+        shopping.add(self.item, 2)
+        self.assertEqual(self.quantities(), [3])
+
+    def test_lost_insert_race(self):
+        # Our UPDATE finds no row; before our INSERT, another request inserts (and commits) its own
+        filter_ = CartItem.objects.filter
+
+        def other_request_inserts(**increment):
+            CartItem.objects.create(cart=cart.DatabaseCart(self.user)._cart(), item=self.item, quantity=1)
+            return 0  # Rows our UPDATE saw
+
+        def update_then_lose_race(**kwargs):
+            if filter_(**kwargs).exists():
+                return filter_(**kwargs)
+            return mock.Mock(**{'update.side_effect': other_request_inserts})
+
+        with transaction.atomic():  # As in a request: the lost race must not spoil the transaction
+            with mock.patch.object(CartItem.objects, 'filter', side_effect=update_then_lose_race):
+                cart.DatabaseCart(self.user).add(self.item, 2)
+            self.assertEqual(self.quantities(), [3])  # Both clicks counted, in one row
+
+    def test_concurrent_first_adds_share_one_cart(self):
+        first, second = cart.DatabaseCart(self.user), cart.DatabaseCart(self.user)
+        first.add(self.item)
+        second.add(self.item)
+        self.assertEqual(self.quantities(), [2])
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    """The delivery backend of MailTests: raises FAILURES[subject] for those subjects, delivers the rest"""
+    FAILURES = {}
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.subject in self.FAILURES:
+                raise self.FAILURES[message.subject]
+        return super().send_messages(messages)
+
+
+@mock.patch.object(mail, 'DELIVERY_BACKEND', f'{__name__}.FailingEmailBackend')
+class MailTests(TestCase):
+    """The queue of core/mail.py: claiming, retries and giving up"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(FailingEmailBackend.FAILURES, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, *subjects):
+        return [OutboundEmail.objects.create(subject=subject, body='Hello', from_email='site@example.com',
+                                             to=['buyer@example.com']) for subject in subjects]
+
+    def make_due(self):
+        OutboundEmail.objects.update(next_attempt_at=timezone.now())
+
+    def test_claims_never_overlap(self):
+        self.queue('a', 'b', 'c')
+        first, second = mail.claim(2), mail.claim(2)
+        self.assertEqual([row.subject for row in first], ['a', 'b'])
+        self.assertEqual([row.subject for row in second], ['c'])  # Only what the first worker left
+        self.assertEqual(mail.claim(2), [])
+        self.assertEqual({row.attempts for row in first + second}, {1})
+        self.assertGreater(first[0].next_attempt_at, timezone.now() + mail.LEASE - timedelta(minutes=1))
+
+    def test_expired_lease_is_claimed_again(self):
+        row, = self.queue('a')
+        mail.claim()  # A worker that claims and then dies
+        self.make_due()
+        reclaimed, = mail.claim()
+        self.assertEqual(reclaimed.pk, row.pk)
+        self.assertEqual(reclaimed.attempts, 2)
+
+    def test_sends_a_batch(self):
+        self.queue('a', 'b')
+        self.assertEqual(mail.send_batch(), (2, 0))
+        self.assertEqual([message.subject for message in outbox.outbox], ['a', 'b'])
+        self.assertEqual(set(OutboundEmail.objects.values_list('status', 'claim')), {(OutboundEmail.SENT, None)})
+
+    def test_temporary_failure_backs_off(self):
+        row, = self.queue('a')
+        FailingEmailBackend.FAILURES['a'] = smtplib.SMTPResponseException(451, b'Try again later')
+        delays = []
+        for _ in range(3):
+            started = timezone.now()
+            self.assertEqual(mail.send_batch(), (0, 1))
+            row.refresh_from_db()
+            delays.append((row.next_attempt_at - started).total_seconds())
+            self.make_due()
+        self.assertEqual(row.status, OutboundEmail.QUEUED)
+        self.assertIn('451', row.last_error)
+        for attempt, delay in enumerate(delays):  # 30 s, 60 s, 120 s, each within the jitter
+            self.assertAlmostEqual(delay, mail.RETRY_DELAY * 2 ** attempt, delta=mail.RETRY_DELAY * 2 ** attempt * 0.21)
+
+    def test_gives_up_after_max_attempts(self):
+        row, = self.queue('a')
+        FailingEmailBackend.FAILURES['a'] = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        for _ in range(mail.MAX_ATTEMPTS):
+            mail.send_batch()
+            self.make_due()
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.attempts), (OutboundEmail.FAILED, mail.MAX_ATTEMPTS))
+
+    def test_rejected_message_fails_at_once(self):
+        refused, sent = self.queue('refused', 'fine')
+        FailingEmailBackend.FAILURES['refused'] = smtplib.SMTPRecipientsRefused(
+            {'buyer@example.com': (550, b'No such user')})
+        self.assertEqual(mail.send_batch(), (1, 1))
+        refused.refresh_from_db()
+        self.assertEqual(refused.status, OutboundEmail.FAILED)
+
+    def test_unexpected_error_fails_only_its_message(self):
+        self.queue('broken', 'fine')
+        FailingEmailBackend.FAILURES['broken'] = ValueError('Header values may not contain linefeed')
+        self.assertEqual(mail.send_batch(), (1, 1))
+        self.assertEqual(dict(OutboundEmail.objects.values_list('subject', 'status')),
+                         {'broken': OutboundEmail.FAILED, 'fine': OutboundEmail.SENT})
+
+    def test_unreachable_server_hands_the_rest_back(self):
+        self.queue('a', 'b', 'c')
+        FailingEmailBackend.FAILURES['a'] = ConnectionRefusedError(111, 'Connection refused')
+        self.assertEqual(mail.send_batch(), (0, 1))
+        untried = OutboundEmail.objects.filter(subject__in=['b', 'c'])
+        self.assertEqual(set(untried.values_list('status', 'attempts', 'claim')), {(OutboundEmail.QUEUED, 0, None)})
+
+    def test_sent_messages_are_marked_when_the_run_dies(self):
+        self.queue('a', 'b')
+        FailingEmailBackend.FAILURES['b'] = KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            mail.send_batch()
+        self.assertEqual(OutboundEmail.objects.get(subject='a').status, OutboundEmail.SENT)  # Not sent twice
+
+    def test_sent_messages_are_purged_soon(self):
+        old, recent = self.queue('old', 'recent')
+        OutboundEmail.objects.update(status=OutboundEmail.SENT)
+        long_ago = timezone.now() - timedelta(hours=mail.KEEP_SENT_HOURS + 1)
+        OutboundEmail.objects.filter(pk=old.pk).update(sent_at=long_ago)
+        OutboundEmail.objects.filter(pk=recent.pk).update(sent_at=timezone.now())
+        self.assertEqual(mail.purge_sent(), 1)
+        self.assertEqual(list(OutboundEmail.objects.values_list('subject', flat=True)), ['recent'])
+
+
+@override_settings(STORAGES={**settings.STORAGES, 'staticfiles': {  # No collectstatic manifest in tests
+    'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+class OutboundEmailAdminTests(TestCase):
+    """Queued mail can hold live password-reset links"""
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        self.email = OutboundEmail.objects.create(subject='Reset your password', body='https://example.com/reset/abc/',
+                                                  from_email='site@example.com', to=['buyer@example.com'])
+        self.url = reverse('admin:core_outboundemail_change', args=[self.email.pk])
+
+    def test_message_cannot_be_edited(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'https://example.com/reset/abc/')
+        self.assertNotContains(response, 'name="to"')
+        self.assertNotContains(response, 'name="body"')
+        self.client.post(self.url, {'to': '["attacker@example.com"]', 'body': 'changed'})
+        self.email.refresh_from_db()
+        self.assertEqual((self.email.to, self.email.body), (['buyer@example.com'], 'https://example.com/reset/abc/'))
+
+    def test_sent_message_body_is_hidden(self):
+        OutboundEmail.objects.filter(pk=self.email.pk).update(status=OutboundEmail.SENT, sent_at=timezone.now())
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'https://example.com/reset/abc/')
+
+
+class MediaTests(TestCase):
+    """Content-addressed uploads and their reference counts (core/media.py): the only code that deletes user files"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(MEDIA_ROOT=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.category = Category.objects.create(name='Tools')
+
+    def store(self, content, name='items/photo.jpg'):
+        return media.ContentAddressedStorage().save(name, ContentFile(content))
+
+    def refs(self, name):
+        return MediaBlob.objects.filter(name=name).values_list('refs', flat=True).first()
+
+    def make_old(self, *names):
+        """Last used, and uploaded, well before the grace period"""
+        long_ago = time.time() - media.GRACE - 60
+        orphaned_at = timezone.now() - timedelta(seconds=media.GRACE + 60)
+        MediaBlob.objects.filter(name__in=names).update(orphaned_at=orphaned_at)
+        for name in names:
+            os.utime(default_storage.path(name), (long_ago, long_ago))
+
+    def item(self, image):
+        return Item.objects.create(owner=self.owner, category=self.category, item_type='rent', name='Drill',
+                                   description='Cordless', price=5, location='Dhaka',
+                                   contact_info='owner@example.com', image=image)
+
+    def test_identical_uploads_share_one_file(self):
+        first, second = self.store(b'same bytes'), self.store(b'same bytes', 'items/copy.JPG')
+        self.assertEqual(first, second)
+        self.assertRegex(first, media.HASHED_NAME_RE)
+        self.assertNotEqual(self.store(b'other bytes'), first)
+        self.assertEqual(len(os.listdir(os.path.dirname(default_storage.path(first)))), 1)
+
+    def test_rows_acquire_and_release(self):
+        name = self.store(b'photo')
+        first, second = self.item(name), self.item(name)
+        self.assertEqual(self.refs(name), 2)
+        first.delete()
+        self.assertEqual(self.refs(name), 1)
+        second.image = self.store(b'new photo')
+        second.save()
+        self.assertEqual(self.refs(name), 0)
+        self.assertIsNotNone(MediaBlob.objects.get(name=name).orphaned_at)
+        self.assertEqual(self.refs(second.image.name), 1)
+        media.release(name)  # Never below zero
+        self.assertEqual(self.refs(name), 0)
+
+    def test_deleting_a_partly_loaded_row(self):
+        name = self.store(b'photo')
+        Item.objects.only('id', 'name').get(pk=self.item(name).pk).delete()  # The image was never read
+        self.assertEqual(self.refs(name), 1)  # Left for a recount rather than guessed
+        self.assertEqual(media.recount(), 1)
+        self.assertEqual(self.refs(name), 0)
+
+    def test_acquire_many(self):
+        media.acquire('items/a.jpg')
+        media.acquire_many(['items/a.jpg', 'items/a.jpg', 'items/b.jpg', ''])
+        self.assertEqual((self.refs('items/a.jpg'), self.refs('items/b.jpg')), (3, 1))
+
+    def test_seed_data_counts_its_images(self):
+        call_command('seed_data', users=3, items=20, conversations=0, messages=0, carts=0, seed=1, stdout=io.StringIO())
+        counts = {}
+        for name in Item.objects.values_list('image', flat=True):
+            counts[name] = counts.get(name, 0) + 1
+        self.assertEqual(dict(MediaBlob.objects.filter(name__in=counts).values_list('name', 'refs')), counts)
+        self.assertEqual(media.recount(), 0)  # Nothing for a recount to correct
+
+    def test_collect_garbage_deletes_only_unused_files(self):
+        unused, recent, in_use, bulk_used = (self.store(content) for content in (b'a', b'b', b'c', b'd'))
+        for name in (unused, recent, bulk_used):
+            media.acquire(name)
+            media.release(name)
+        self.item(in_use)
+        Item.objects.filter(image=in_use).update(image=bulk_used)  # No signals: its count still says 0
+        self.item(in_use)
+        self.make_old(unused, bulk_used)
+        self.assertEqual(media.collect_garbage(dry_run=True), [unused])
+        self.assertTrue(default_storage.exists(unused))
+        self.assertEqual(media.collect_garbage(), [unused])
+        self.assertFalse(default_storage.exists(unused))
+        self.assertFalse(MediaBlob.objects.filter(name=unused).exists())
+        for name in (recent, in_use, bulk_used):
+            self.assertTrue(default_storage.exists(name), name)
+        self.assertEqual(self.refs(bulk_used), 1)  # Put right from the table
+
+    def test_reuploaded_file_survives(self):
+        name = self.store(b'photo')
+        media.acquire(name)
+        media.release(name)
+        self.make_old(name)
+        self.store(b'photo')  # Uploaded again; the row that will use it hasn't been saved yet
+        self.assertEqual(media.collect_garbage(), [])
+        self.assertTrue(default_storage.exists(name))
+
+    def test_command(self):
+        name = self.store(b'photo')
+        media.acquire(name)
+        media.release(name)
+        self.make_old(name)
+        out = io.StringIO()
+        call_command('collect_media_garbage', stdout=out)
+        self.assertIn('Deleted 1 unused files.', out.getvalue())
+        self.assertFalse(default_storage.exists(name))
 
-# Create your tests here.
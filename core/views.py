@@ -1,11 +1,29 @@
+from django.contrib import admin  # For the admin page chrome
+from django.conf import settings  # Project settings
+from django.http import HttpResponse, HttpResponseForbidden  # Plain-text responses for /metrics
 from django.shortcuts import render  # Tool for rendering HTML pages
 from items.models import Item  # Import our Item model to display items
+from . import caching  # Version-keyed page cache
+from . import metrics as metrics_registry  # Prometheus counters and histograms
+from .caching import cache_response, conditional_response  # Serve cached pages, and 304s for unchanged ones
+from .middleware import slow_requests as recorded_slow_requests  # Ring buffer kept by PerformanceMiddleware
+from .pagination import KeysetPaginator  # Cursor pagination that never uses OFFSET
 
 
+def _home_validators(request):
+    """The featured items come from the active catalogue"""
+    return caching.freshness(Item.objects.filter(is_active=True))
+
+
+@conditional_response(_home_validators)  # Repeat visits get a 304 when nothing changed
+@cache_response('home', [caching.ITEMS, caching.CATEGORIES])  # Rebuilt when items or categories change
 def home(request):
     """This is the main homepage that visitors see first"""
     # Get the 8 most recently added active items to feature on homepage
-    featured_items = Item.objects.filter(is_active=True).order_by('-created_at')[:8]
+    # (the cursor lets "show more" continue from the last item shown)
+    featured_items = KeysetPaginator(
+        Item.objects.filter(is_active=True), ('-created_at', '-id'), per_page=8
+    ).page(request.GET.get('cursor'))
 
     # Render the homepage template and pass the featured items to it
     return render(request, 'core/home.html', {
@@ -23,3 +41,29 @@ def contact(request):
     """Contact page where users can find how to reach us"""
     # Render the contact page template
     return render(request, 'core/contact.html')
+
+
+def slow_requests(request):
+    """Admin page listing the slowest recent requests this server process has seen"""
+    # Wrapped in admin.site.admin_view() in the project urls, so only staff get here
+    return render(request, 'admin/slow_requests.html', {
+        **admin.site.each_context(request),
+        'title': 'Slow requests',
+        'slow_requests': recorded_slow_requests(),
+    })
+
+
+def metrics(request):
+    """Prometheus scrape endpoint covering every worker process"""
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    # Cache hits and misses are already shared between processes through the cache itself
+    cache_stats = caching.stats()
+    extra = [
+        ('cache_hits_total', 'Page and fragment cache hits, by cache name.',
+         {(('cache', name),): counts['hits'] for name, counts in cache_stats.items()}),
+        ('cache_misses_total', 'Page and fragment cache misses, by cache name.',
+         {(('cache', name),): counts['misses'] for name, counts in cache_stats.items()}),
+    ]
+    return HttpResponse(metrics_registry.render(extra), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Item, Conversation, Message
+from .models import Item, Conversation, Message, MessageArchive
 
 @admin.register(Item)
 class ItemAdmin(admin.ModelAdmin):
@@ -16,6 +16,11 @@ class ConversationAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'conversation', 'is_read', 'created_at')
-    list_filter = ('is_read', 'created_at')
+    list_display = ('sender', 'conversation', 'created_at')
+    list_filter = ('created_at',)
     search_fields = ('sender__username', 'conversation__item__name', 'content')
+
+@admin.register(MessageArchive)
+class MessageArchiveAdmin(admin.ModelAdmin):
+    list_display = ('conversation', 'message_count', 'first_message_id', 'last_message_id', 'archived_at')
+    exclude = ('data',)
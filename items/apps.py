@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ItemsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'items'
+
+    def ready(self):
+        from .search import create_search_index
+        # The search index is raw SQL rather than a model, so create it after every migrate
+        post_migrate.connect(create_search_index, sender=self)
@@ -0,0 +1,95 @@
+"""Old chat messages moved out of the Message table into compressed blobs.
+
+`manage.py archive_messages` takes messages older than CHAT_ARCHIVE_AFTER_DAYS
+and stores them as MessageArchive rows: up to CHUNK_SIZE messages of one
+conversation per row, as zlib-compressed JSON in the same shape get_messages
+sends. It then deletes those messages from the Message table. That keeps
+the table, and with it the indexes every chat page and unread badge uses,
+down to recent messages. The newest KEEP_RECENT messages of each conversation
+stay put whatever their age, so opening even a long-quiet chat never reads the
+archive.
+
+Scrolling back past the oldest message still in the table continues in the
+archive (see messaging.history()), so nothing disappears from the chat.
+"""
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router
+from django.utils import timezone
+
+from core.db import write_transaction
+from .models import Conversation, Message, MessageArchive
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 365)  # Messages older than this are archived
+CHUNK_SIZE = 500  # Messages per archive row
+KEEP_RECENT = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)  # Always left in the table, per conversation
+
+
+def pack(payloads):
+    return zlib.compress(json.dumps(payloads, separators=(',', ':')).encode(), 9)
+
+
+def unpack(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def archive_conversation(conversation, cutoff):
+    """Archive this conversation's messages from before `cutoff`; returns how many were moved"""
+    from .messaging import message_payload
+    old = conversation.messages.filter(created_at__lt=cutoff).select_related('sender').order_by('created_at', 'id')
+    if KEEP_RECENT:
+        # The oldest of the messages that stay; with fewer than KEEP_RECENT of them, nothing moves
+        keep_from = next(iter(conversation.messages.order_by('-id').values_list('id', flat=True)
+                              [KEEP_RECENT - 1:KEEP_RECENT]), None)
+        if keep_from is None:
+            return 0
+        old = old.filter(id__lt=keep_from)
+    moved = 0
+    while True:
+        with write_transaction():
+            messages = list(old[:CHUNK_SIZE])
+            if not messages:
+                return moved
+            MessageArchive.objects.create(
+                conversation=conversation, first_message_id=messages[0].pk, last_message_id=messages[-1].pk,
+                message_count=len(messages), data=pack([message_payload(message) for message in messages]),
+            )
+            # Raw DELETE: a queryset delete() would load every row to send the Message signals,
+            # and archiving changes nothing they look after (unread counts live in read states)
+            using = router.db_for_write(Message)
+            with connections[using].cursor() as cursor:
+                cursor.execute(f'DELETE FROM {Message._meta.db_table} WHERE conversation_id = %s AND id IN '
+                               f'({", ".join(["%s"] * len(messages))})', [conversation.pk, *[m.pk for m in messages]])
+        moved += len(messages)
+
+
+def archive_old_messages(days=ARCHIVE_AFTER_DAYS):
+    """Archive every conversation's old messages; returns (conversations touched, messages moved)"""
+    cutoff = timezone.now() - timedelta(days=days)
+    touched = moved = 0
+    # Conversation by conversation, so each lookup uses the (conversation, created_at) index
+    for conversation in Conversation.objects.filter(created_at__lt=cutoff).order_by().iterator(chunk_size=500):
+        count = archive_conversation(conversation, cutoff)
+        touched += bool(count)
+        moved += count
+    return touched, moved
+
+
+def older(conversation_id, before, limit):
+    """Up to `limit` archived payloads older than message id `before` (newest first), and whether more exist"""
+    archives = MessageArchive.objects.filter(conversation_id=conversation_id).order_by('-last_message_id')
+    if before is not None:
+        archives = archives.filter(first_message_id__lt=before)
+    if limit <= 0:
+        return [], archives.exists()
+    payloads = []
+    for archive in archives.iterator(chunk_size=4):
+        chunk = [payload for payload in reversed(unpack(archive.data))
+                 if before is None or payload['id'] < before]
+        payloads += chunk
+        if len(payloads) > limit:
+            return payloads[:limit], True
+    return payloads, False
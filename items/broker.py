@@ -0,0 +1,167 @@
+"""Publish/subscribe fan-out for live chat events.
+
+Views and signals publish synchronously; WebSocket connections subscribe from
+the event loop. Pick the backend with settings.CHAT_BROKER:
+
+    CHAT_BROKER = {'BACKEND': 'items.broker.InProcessBroker'}  # single process (default)
+    CHAT_BROKER = {
+        'BACKEND': 'items.broker.RedisBroker',  # several processes / servers
+        'OPTIONS': {'url': 'redis://localhost:6379/0'},
+    }
+
+RedisBroker works with any server speaking the Redis protocol (Redis, Valkey,
+KeyDB, ...) and needs the optional `redis` package.
+"""
+import asyncio
+import json
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+DEFAULT_BROKER = {'BACKEND': 'items.broker.InProcessBroker'}
+
+
+def conversation_channel(conversation_id):
+    """Channel name that carries one conversation's events"""
+    return f'conversation.{conversation_id}'
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    """The configured broker, created once per process"""
+    config = getattr(settings, 'CHAT_BROKER', DEFAULT_BROKER)
+    try:
+        broker_class = import_string(config['BACKEND'])
+    except ImportError as e:
+        raise ImproperlyConfigured(f"Could not load CHAT_BROKER backend {config['BACKEND']!r}: {e}")
+    return broker_class(**config.get('OPTIONS', {}))
+
+
+class Subscription:
+    """Events for one subscriber; `await get(timeout)` returns the next event or None on timeout"""
+
+    async def get(self, timeout=None):
+        raise NotImplementedError
+
+
+class BaseBroker:
+    cross_process = False  # Whether events published by other worker processes reach our subscribers
+
+    def publish(self, channel, event):
+        """Send a JSON-serializable event to every current subscriber of `channel` (sync)"""
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        """Async context manager yielding a Subscription to `channel`"""
+        raise NotImplementedError
+
+
+class _QueueSubscription(Subscription):
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class _InProcessSubscriptionContext:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.subscription = None
+
+    async def __aenter__(self):
+        self.subscription = _QueueSubscription()
+        with self.broker.lock:
+            self.broker.subscribers.setdefault(self.channel, set()).add(self.subscription)
+        return self.subscription
+
+    async def __aexit__(self, *exc_info):
+        with self.broker.lock:
+            subscribers = self.broker.subscribers.get(self.channel, set())
+            subscribers.discard(self.subscription)
+            if not subscribers:
+                self.broker.subscribers.pop(self.channel, None)
+
+
+class InProcessBroker(BaseBroker):
+    """Fan-out inside one process; publishers may run on any thread or event loop"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}  # channel -> set of _QueueSubscription
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                # Subscribers live on an event loop; hand the event over thread-safely
+                subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, event)
+            except RuntimeError:  # Their loop has already shut down
+                pass
+
+    def subscribe(self, channel):
+        return _InProcessSubscriptionContext(self, channel)
+
+
+class _RedisSubscription(Subscription):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def get(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            # get_message() also returns None for skipped subscribe confirmations, so loop until the deadline
+            wait = 1.0 if deadline is None else max(deadline - loop.time(), 0)
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=wait)
+            if message is not None:
+                return json.loads(message['data'])
+            if deadline is not None and loop.time() >= deadline:
+                return None
+
+
+class _RedisSubscriptionContext:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+
+    async def __aenter__(self):
+        self.client = self.broker.asyncio_redis.from_url(self.broker.url)
+        self.pubsub = self.client.pubsub()
+        await self.pubsub.subscribe(self.channel)
+        return _RedisSubscription(self.pubsub)
+
+    async def __aexit__(self, *exc_info):
+        await self.pubsub.unsubscribe(self.channel)
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+
+class RedisBroker(BaseBroker):
+    """Fan-out across processes and servers through Redis PUBLISH/SUBSCRIBE"""
+    cross_process = True
+
+    def __init__(self, url='redis://localhost:6379/0'):
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError:
+            raise ImproperlyConfigured('RedisBroker needs the redis package: pip install redis')
+        self.url = url
+        self.asyncio_redis = redis.asyncio
+        self.client = redis.Redis.from_url(url)  # Thread-safe connection pool for publishing
+
+    def publish(self, channel, event):
+        self.client.publish(channel, json.dumps(event))
+
+    def subscribe(self, channel):
+        return _RedisSubscriptionContext(self, channel)
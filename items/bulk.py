@@ -0,0 +1,46 @@
+"""Shared pieces of the import_items / export_items management commands."""
+import csv
+import json
+
+# Columns of an item file, in order. owner and category hold a username and a category name.
+COLUMNS = ['owner', 'category', 'item_type', 'name', 'description', 'price', 'condition',
+           'location', 'contact_info', 'image', 'is_active']
+
+FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(path, fmt=None):
+    """Use the --format option if given, otherwise guess from the file extension"""
+    if fmt:
+        return fmt
+    return 'jsonl' if str(path).endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per item in the file without reading it all into memory"""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None  # A broken line is one bad row, not the end of the import
+
+
+class RowWriter:
+    """Write item dicts as CSV or JSON lines"""
+
+    def __init__(self, stream, fmt):
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(stream, fieldnames=COLUMNS)
+            self.writer.writeheader()
+
+    def write(self, row):
+        if self.fmt == 'csv':
+            self.writer.writerow(row)
+        else:
+            self.stream.write(json.dumps(row, default=str) + '\n')
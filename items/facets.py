@@ -0,0 +1,156 @@
+"""Result counts per item type, category and condition for the browse page.
+
+Everything comes from one table of counts per (item_type, category, condition)
+combination. Counts for each facet honour the filters on the *other* facets but
+not its own, so with "Rent" selected the type facet still shows how many Swap
+and Donate items there are - the usual way shop filters behave.
+
+For the unfiltered catalogue (no search text) that table lives in the cache,
+one counter per combination, and the Item signals in items/models.py add and
+subtract as listings are created, edited or deleted. A search (by text or by
+place) builds the table with a single GROUP BY over the matching items instead.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count
+
+from core import navigation
+from .models import Item
+
+TIMEOUT = getattr(settings, 'FACET_CACHE_TIMEOUT', 3600)  # Counters are rebuilt from the database this often
+GENERATION_KEY = 'facets:generation'
+
+FACETS = ('item_type', 'category', 'condition')
+COUNTED_FIELDS = {'is_active', 'item_type', 'category_id', 'condition'}  # What decides where an item counts
+UNKNOWN = 'unknown'  # State of an item loaded without some of COUNTED_FIELDS
+
+
+def _counter_key(generation, combination):
+    item_type, category_id, condition = combination
+    return f'facets:{generation}:{item_type}:{category_id}:{condition}'
+
+
+def _all_combinations():
+    category_ids = [category.pk for category in navigation.category_list()]
+    return [(item_type, category_id, condition)
+            for item_type, _ in Item.ITEM_TYPES
+            for category_id in category_ids
+            for condition, _ in Item.CONDITION_CHOICES]
+
+
+def grouped_counts(queryset):
+    """{(item_type, category_id, condition): count} for a queryset, in one grouped query"""
+    rows = (queryset.order_by().values_list('item_type', 'category_id', 'condition')
+            .annotate(count=Count('id')))
+    return {(item_type, category_id, condition): count for item_type, category_id, condition, count in rows}
+
+
+def rebuild():
+    """Recount the active catalogue and start a fresh set of cached counters"""
+    # From the primary: a lagging replica would leave the counters off for good, as they only move by deltas.
+    # Named directly, as asking the router for a write alias would pin the browser to the primary
+    counts = grouped_counts(Item.objects.db_manager(DEFAULT_DB_ALIAS).filter(is_active=True))
+    generation = time.time_ns()
+    combinations = set(_all_combinations()) | set(counts)
+    cache.set_many({_counter_key(generation, combination): counts.get(combination, 0)
+                    for combination in combinations}, TIMEOUT)
+    cache.set(GENERATION_KEY, generation, TIMEOUT)  # Last, so readers never see a half-written set
+    return counts
+
+
+def catalogue_counts():
+    """Cached counts for every active item"""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        return rebuild()
+    combinations = _all_combinations()
+    keys = {_counter_key(generation, combination): combination for combination in combinations}
+    cached = cache.get_many(list(keys))
+    if len(cached) < len(keys):
+        return rebuild()  # Some counters were evicted, or a category is new; recount everything
+    return {keys[key]: count for key, count in cached.items() if count}
+
+
+def invalidate():
+    """Forget the cached counters (after bulk changes that skip the Item signals)"""
+    cache.delete(GENERATION_KEY)
+
+
+def counted_state(item):
+    """The combination an item counts towards, None if it is not listed, or UNKNOWN"""
+    if COUNTED_FIELDS & item.get_deferred_fields():
+        return UNKNOWN  # Reading them would cost a query per item (e.g. after .only())
+    if not item.is_active:
+        return None
+    return item.item_type, item.category_id, item.condition
+
+
+def _apply(combination, delta):
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        return  # Nothing cached; the next reader recounts anyway
+    key = _counter_key(generation, combination)
+    try:
+        cache.incr(key, delta)
+    except ValueError:  # Evicted, or a category created after the last rebuild
+        invalidate()
+
+
+def record_change(before, after):
+    """Move one item's count from one combination to another once the transaction commits"""
+    if before == after:
+        return
+    if UNKNOWN in (before, after):
+        transaction.on_commit(invalidate)  # Can't tell what moved; recount on the next read
+        return
+
+    def apply():
+        if before is not None:
+            _apply(before, -1)
+        if after is not None:
+            _apply(after, 1)
+
+    transaction.on_commit(apply)
+
+
+def facet_counts(counts, item_type='', category_id=None, condition=''):
+    """Per-facet counts from a combination table, each facet ignoring its own filter
+
+    Returns {'item_type': {value: n}, 'category': {id: n}, 'condition': {value: n}}.
+    """
+    result = {facet: {} for facet in FACETS}
+    for (row_type, row_category, row_condition), count in counts.items():
+        type_ok = not item_type or row_type == item_type
+        category_ok = category_id is None or row_category == category_id
+        condition_ok = not condition or row_condition == condition
+        if category_ok and condition_ok:
+            result['item_type'][row_type] = result['item_type'].get(row_type, 0) + count
+        if type_ok and condition_ok:
+            result['category'][row_category] = result['category'].get(row_category, 0) + count
+        if type_ok and category_ok:
+            result['condition'][row_condition] = result['condition'].get(row_condition, 0) + count
+    return result
+
+
+def for_request(queryset, narrowed, item_type='', category_id=None, condition=''):
+    """Facets for the browse page as lists of {'value', 'label', 'count', 'selected'}
+
+    `queryset` is the active items narrowed by search text or place only, not by the
+    facet filters; `narrowed` is False when it is the whole catalogue.
+    """
+    counts = grouped_counts(queryset) if narrowed else catalogue_counts()
+    counts = facet_counts(counts, item_type, category_id, condition)
+
+    def options(facet, choices, selected):
+        return [{'value': value, 'label': label, 'count': counts[facet].get(value, 0),
+                 'selected': value == selected} for value, label in choices]
+
+    categories = [(category.pk, category.name) for category in navigation.category_list()]
+    return {
+        'item_type': options('item_type', Item.ITEM_TYPES, item_type),
+        'category': options('category', categories, category_id),
+        'condition': options('condition', Item.CONDITION_CHOICES, condition),
+    }
@@ -0,0 +1,201 @@
+"""Coordinates for item locations and "near me" queries.
+
+The free-text `Item.location` is turned into latitude/longitude by a pluggable
+geocoder when an item is saved. Pick it with settings.GEOCODER:
+
+    GEOCODER = {'BACKEND': 'items.geo.GazetteerGeocoder'}  # offline, items/data/gazetteer.csv (default)
+    GEOCODER = {
+        'BACKEND': 'items.geo.GazetteerGeocoder',
+        'OPTIONS': {'path': '/srv/data/places.csv'},  # name,latitude,longitude[,alias|alias...]
+    }
+
+Each item also stores the geohash of its coordinates. Items in the same
+small area share a geohash prefix, so a radius or box query becomes a few
+range scans over item_geohash_idx - one per run of covering cells - instead
+of a distance calculation for every row in the table.
+"""
+import csv
+import math
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import Sqrt
+from django.utils.module_loading import import_string
+
+DEFAULT_GEOCODER = {'BACKEND': 'items.geo.GazetteerGeocoder'}
+DEFAULT_GAZETTEER = os.path.join(os.path.dirname(__file__), 'data', 'gazetteer.csv')
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'  # Geohash alphabet
+STORED_PRECISION = 9  # Characters kept per item (cells of about 5 m)
+MAX_CELLS = 16  # Most geohash cells one query may cover before we use bigger ones
+KM_PER_DEGREE = 111.32  # Length of one degree of latitude
+MAX_RADIUS_KM = 100  # Largest radius accepted; the flat-earth distance below is fine up to here
+
+NAME_RE = re.compile(r'[^\w]+', re.UNICODE)
+
+
+@lru_cache(maxsize=None)
+def get_geocoder():
+    """The configured geocoder, created once per process"""
+    config = getattr(settings, 'GEOCODER', DEFAULT_GEOCODER)
+    try:
+        geocoder_class = import_string(config['BACKEND'])
+    except ImportError as e:
+        raise ImproperlyConfigured(f"Could not load GEOCODER backend {config['BACKEND']!r}: {e}")
+    return geocoder_class(**config.get('OPTIONS', {}))
+
+
+def normalize(name):
+    return NAME_RE.sub(' ', name.lower()).strip()
+
+
+class BaseGeocoder:
+    def geocode(self, text):
+        """(latitude, longitude) for a free-text place, or None if it is not known"""
+        raise NotImplementedError
+
+
+class GazetteerGeocoder(BaseGeocoder):
+    """Looks places up in a local CSV of name,latitude,longitude[,alias|alias...]
+
+    "Gulshan 2, Dhaka" is tried whole, then part by part ("Gulshan 2", "Dhaka"),
+    then by its words, so the most specific place that is known wins.
+    """
+
+    def __init__(self, path=DEFAULT_GAZETTEER):
+        self.places = {}
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                point = (float(row['latitude']), float(row['longitude']))
+                for name in [row['name']] + (row.get('aliases') or '').split('|'):
+                    if name.strip():
+                        self.places.setdefault(normalize(name), point)
+
+    def geocode(self, text):
+        text = text or ''
+        candidates = [text] + re.split(r'[,;/()-]', text)
+        words = normalize(text).split()
+        candidates += [' '.join(words[i:i + 2]) for i in range(len(words) - 1)] + words
+        for candidate in candidates:
+            point = self.places.get(normalize(candidate))
+            if point:
+                return point
+        return None
+
+
+def encode(latitude, longitude, precision=STORED_PRECISION):
+    """Geohash of a point"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    bits, bit_count, even, chars = 0, 0, True, []
+    while len(chars) < precision:
+        value, bounds = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """(height, width) of a geohash cell in degrees"""
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def covering_cells(south, west, north, east):
+    """The fewest-and-smallest geohash prefixes that together cover a box (at most MAX_CELLS)"""
+    for precision in range(STORED_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = math.floor((north + 90) / height) - math.floor((south + 90) / height) + 1
+        columns = math.floor((east + 180) / width) - math.floor((west + 180) / width) + 1
+        if rows * columns <= MAX_CELLS:
+            break
+    cells = set()
+    latitude = south
+    while True:
+        longitude = west
+        while True:
+            cells.add(encode(min(latitude, north), min(longitude, east), precision))
+            if longitude >= east:
+                break
+            longitude = min(longitude + width, east)
+        if latitude >= north:
+            break
+        latitude = min(latitude + height, north)
+    return sorted(cells)
+
+
+def box_around(latitude, longitude, radius_km):
+    """(south, west, north, east) of the box that just contains a circle"""
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    return (max(latitude - lat_delta, -90), max(longitude - lng_delta, -180),
+            min(latitude + lat_delta, 90), min(longitude + lng_delta, 180))
+
+
+def _cell_ranges(cells):
+    """[(first, last)] runs of cells that sit next to each other in geohash order"""
+    ranges = []
+    for cell in cells:
+        if ranges and len(cell) == len(ranges[-1][1]) and ranges[-1][1][:-1] == cell[:-1] \
+                and BASE32.index(cell[-1]) == BASE32.index(ranges[-1][1][-1]) + 1:
+            ranges[-1][1] = cell
+        else:
+            ranges.append([cell, cell])
+    return ranges
+
+
+def _in_cells(cells):
+    """Q for items whose geohash starts with any of these prefixes, as index range scans"""
+    condition = Q()
+    for first, last in _cell_ranges(cells):
+        # A range rather than startswith: LIKE can't use a plain index on SQLite
+        condition |= Q(geohash__gte=first, geohash__lt=last + '{')  # '{' sorts right after 'z'
+    return condition
+
+
+def distance_km(latitude, longitude):
+    """Expression for the distance from a point, on a locally flat earth (good to well under 1% here)"""
+    lng_scale = KM_PER_DEGREE * math.cos(math.radians(latitude))
+    d_lat = (F('latitude') - Value(latitude)) * Value(KM_PER_DEGREE)
+    d_lng = (F('longitude') - Value(longitude)) * Value(lng_scale)
+    return Sqrt(d_lat * d_lat + d_lng * d_lng, output_field=FloatField())
+
+
+def within_radius(queryset, latitude, longitude, radius_km):
+    """Items within `radius_km` of a point, annotated with `distance_km`"""
+    south, west, north, east = box_around(latitude, longitude, radius_km)
+    return (queryset.filter(_in_cells(covering_cells(south, west, north, east)))
+            .annotate(distance_km=distance_km(latitude, longitude))
+            .filter(distance_km__lte=radius_km))
+
+
+def within_box(queryset, south, west, north, east):
+    """Items inside a box, annotated with `distance_km` from its centre"""
+    return (queryset.filter(_in_cells(covering_cells(south, west, north, east)),
+                            latitude__range=(south, north), longitude__range=(west, east))
+            .annotate(distance_km=distance_km((south + north) / 2, (west + east) / 2)))
+
+
+def locate(item):
+    """Fill in an item's coordinates and geohash from its location text (cleared if unknown)"""
+    point = get_geocoder().geocode(item.location)
+    if point:
+        item.latitude, item.longitude = point
+        item.geohash = encode(*point)
+    else:
+        item.latitude = item.longitude = None
+        item.geohash = ''
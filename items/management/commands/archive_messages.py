@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from items import archive
+
+
+class Command(BaseCommand):
+    help = 'Move old chat messages into compressed per-conversation archive rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=archive.ARCHIVE_AFTER_DAYS,
+                            help='Archive messages older than this many days')
+
+    def handle(self, *args, **options):
+        touched, moved = archive.archive_old_messages(options['days'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} messages from {touched} conversations.'))
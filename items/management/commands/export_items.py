@@ -0,0 +1,44 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from items.bulk import COLUMNS, FORMATS, RowWriter, detect_format
+from items.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Export item listings to CSV or JSON lines, streaming so memory use stays flat'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help="Output file, or '-' for standard output")
+        parser.add_argument('--format', choices=FORMATS, help='File format (default: from the extension)')
+        parser.add_argument('--active-only', action='store_true', help='Skip listings that were taken down')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at a time')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = detect_format(path, options['format'])
+
+        items = Item.objects.order_by('id')
+        if options['active_only']:
+            items = items.filter(is_active=True)
+        # values() + iterator(): plain tuples straight from a server-side cursor, no model instances
+        rows = items.values_list('owner__username', 'category__name', *COLUMNS[2:]).iterator(
+            chunk_size=options['chunk_size'])
+
+        stream = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        started = time.monotonic()
+        exported = 0
+        try:
+            writer = RowWriter(stream, fmt)
+            for values in rows:
+                writer.write(dict(zip(COLUMNS, values)))
+                exported += 1
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        elapsed = time.monotonic() - started
+        self.stderr.write(self.style.SUCCESS(
+            f'Exported {exported} items in {elapsed:.1f}s ({exported / elapsed if elapsed else 0:.0f} rows/s).'))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import caching
+from items import geo
+from items.models import Item
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Fill in coordinates and geohashes for every item from its location text'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing', action='store_true',
+                            help='Only items that have no coordinates yet')
+
+    def handle(self, *args, **options):
+        items = Item.objects.only('id', 'location', 'latitude', 'longitude', 'geohash').order_by('id')
+        if options['missing']:
+            items = items.filter(latitude__isnull=True)
+
+        located = unknown = 0
+        last_id = 0
+        while True:
+            # Walk by id rather than offset so rows located in an earlier batch aren't skipped
+            batch = list(items.filter(id__gt=last_id)[:BATCH_SIZE])
+            if not batch:
+                break
+            for item in batch:
+                geo.locate(item)
+                if item.geohash:
+                    located += 1
+                else:
+                    unknown += 1
+            with transaction.atomic():
+                Item.objects.bulk_update(batch, ['latitude', 'longitude', 'geohash'])
+            last_id = batch[-1].pk
+        if located or unknown:
+            caching.bump(caching.ITEMS)  # bulk_update skips the Item signals
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Located {located} items; {unknown} have a location the geocoder does not know.'))
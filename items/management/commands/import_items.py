@@ -0,0 +1,153 @@
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core import caching, media, metrics
+from core.models import Category
+from items import facets, geo, search
+from items.bulk import COLUMNS, FORMATS, detect_format, read_rows
+from items.models import Item
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+TEXT_COLUMNS = [column for column in COLUMNS if column not in ('price', 'is_active')]  # JSON numbers etc. rejected
+
+
+class Command(BaseCommand):
+    help = 'Import item listings from a CSV or JSON-lines file in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for standard input")
+        parser.add_argument('--format', choices=FORMATS, help='File format (default: from the extension)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT and per transaction')
+        parser.add_argument('--create-categories', action='store_true',
+                            help='Create categories that do not exist yet instead of skipping their rows')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip the rows a previous, interrupted run already imported')
+        parser.add_argument('--checkpoint', help='Progress file (default: <path>.progress)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        self.verbosity = options['verbosity']
+        if path == '-' and options['resume']:
+            raise CommandError('--resume needs a file, not standard input.')
+        fmt = detect_format(path, options['format'])
+        batch_size = options['batch_size']
+        checkpoint = Path(options['checkpoint'] or f'{path}.progress')
+
+        # Look owners and categories up once instead of once per row
+        self.owners = dict(User.objects.values_list('username', 'id'))
+        self.categories = dict(Category.objects.values_list('name', 'id'))
+        self.create_categories = options['create_categories']
+
+        skip = int(checkpoint.read_text()) if options['resume'] and checkpoint.exists() else 0
+        if skip:
+            self.stdout.write(f'Resuming after row {skip}.')
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        started = time.monotonic()
+        done = skip
+        imported = rejected = 0
+        batch = []
+        try:
+            for number, row in enumerate(read_rows(stream, fmt), start=1):
+                if number <= skip:
+                    continue
+                item = self.build_item(number, row)
+                if item is None:
+                    rejected += 1
+                else:
+                    batch.append(item)
+                if number - done >= batch_size:
+                    imported += self.flush(batch, checkpoint, number, path != '-')
+                    done, batch = number, []
+                    self.report(imported, rejected, started)
+            imported += self.flush(batch, checkpoint, None, False)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            metrics.flush()  # A one-off command: report what it did now, nothing flushes it at exit
+
+        if path != '-' and checkpoint.exists():
+            checkpoint.unlink()  # Finished, so there is nothing left to resume
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} items, rejected {rejected}, in {elapsed:.1f}s '
+            f'({imported / elapsed if elapsed else 0:.0f} rows/s).'))
+
+    def flush(self, batch, checkpoint, row_number, save_progress):
+        """Insert one batch in its own transaction, then record how far we got"""
+        if batch:
+            with transaction.atomic():
+                created = Item.objects.bulk_create(batch)
+                # bulk_create skips the search and media reference signals
+                search.index_items(item.pk for item in created)
+                media.acquire_many(item.image.name for item in created)
+            # Committed, so show these items now: a later batch may fail and stop the run
+            caching.bump(caching.ITEMS)  # bulk_create skips the Item signals
+            facets.invalidate()
+            metrics.inc('items_created_total', len(created))
+        if save_progress and row_number is not None:
+            checkpoint.write_text(str(row_number))  # Only after the batch has committed
+        return len(batch)
+
+    def report(self, imported, rejected, started):
+        if self.verbosity >= 1:
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'  {imported} imported, {rejected} rejected, '
+                              f'{imported / elapsed if elapsed else 0:.0f} rows/s')
+
+    def build_item(self, number, row):
+        """Turn one file row into an unsaved Item, or None (with a warning) if it is invalid"""
+        if not isinstance(row, dict):
+            return self.reject(number, 'not a JSON object')
+        not_text = [column for column in TEXT_COLUMNS
+                    if row.get(column) is not None and not isinstance(row[column], str)]
+        if not_text:
+            return self.reject(number, f"{', '.join(not_text)} must be text")
+        owner_id = self.owners.get((row.get('owner') or '').strip())
+        if owner_id is None:
+            return self.reject(number, f"unknown owner {row.get('owner')!r}")
+        category_id = self.category_id((row.get('category') or '').strip())
+        if category_id is None:
+            return self.reject(number, f"unknown category {row.get('category')!r}")
+
+        item_type = row.get('item_type', '')
+        if item_type not in dict(Item.ITEM_TYPES):
+            return self.reject(number, f'bad item_type {item_type!r}')
+        condition = row.get('condition') or 'good'
+        if condition not in dict(Item.CONDITION_CHOICES):
+            return self.reject(number, f'bad condition {condition!r}')
+        try:
+            price = Decimal(str(row['price'])) if row.get('price') not in (None, '') else None
+        except InvalidOperation:
+            return self.reject(number, f"bad price {row.get('price')!r}")
+        if not row.get('name'):
+            return self.reject(number, 'missing name')
+
+        is_active = row.get('is_active', True)
+        if isinstance(is_active, str):
+            is_active = is_active.strip().lower() in TRUE_VALUES if is_active.strip() else True
+        item = Item(
+            owner_id=owner_id, category_id=category_id, item_type=item_type,
+            name=row['name'][:200], description=row.get('description') or '', price=price,
+            condition=condition, location=(row.get('location') or '')[:200],
+            contact_info=(row.get('contact_info') or '')[:200], image=row.get('image') or '',
+            is_active=bool(is_active),
+        )
+        geo.locate(item)  # bulk_create skips the pre_save geocoding signal
+        return item
+
+    def category_id(self, name):
+        if name not in self.categories and name and self.create_categories:
+            self.categories[name] = Category.objects.create(name=name).pk
+        return self.categories.get(name)
+
+    def reject(self, number, reason):
+        if self.verbosity >= 2:
+            self.stderr.write(f'Row {number}: {reason}; skipped.')
+        return None
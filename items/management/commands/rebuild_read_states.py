@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import navigation
+from items import messaging
+from items.models import Conversation
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-participant unread counts and inbox previews from the messages table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('conversation_ids', nargs='*', type=int,
+                            help='Only rebuild these conversations (default: all of them)')
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.all()
+        if options['conversation_ids']:
+            conversations = conversations.filter(id__in=options['conversation_ids'])
+
+        with transaction.atomic():
+            rebuilt = messaging.rebuild(conversations)
+        # Every cached unread badge may now be wrong
+        navigation.invalidate_unread(
+            conversations.values_list('participants', flat=True).distinct())
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} inbox entries.'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from items import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for item listings from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='Database alias to rebuild the index on')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        engine = search.backend(using)
+        if engine is None:
+            self.stdout.write(self.style.WARNING(
+                'This database has no full-text support; searches will use icontains scans.'))
+            return
+
+        with transaction.atomic(using=using):  # Readers never see a half-built index
+            count = search.rebuild(using)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} items ({engine}).'))
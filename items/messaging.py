@@ -0,0 +1,195 @@
+"""Bookkeeping for conversations: unread counts and inbox previews.
+
+Each participant has a ConversationReadState row. Posting a message bumps the
+other participants' unread counts with one UPDATE, and reading a conversation
+resets the reader's count with another, so nothing ever has to count messages
+to draw the inbox or the unread badge. New messages and read receipts are also
+published to the chat broker (items/broker.py) for open chat windows.
+
+What someone has read is a high-water mark, last_read_message_id: every
+message up to it counts as read, everything after it from someone else as
+unread. Reading never touches the Message rows themselves.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    BigIntegerField, Case, Count, F, Max, OuterRef, PositiveIntegerField, Q, Subquery, Sum, Value, When,
+)
+from django.db.models.functions import Coalesce
+
+from .broker import conversation_channel, get_broker
+from .models import Conversation, ConversationReadState, Message
+
+SNIPPET_LENGTH = 200  # Matches ConversationReadState.last_message_snippet
+HISTORY_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)  # Messages per page of chat history
+
+
+def snippet(content):
+    """Shorten message text for the inbox preview"""
+    content = ' '.join(content.split())
+    if len(content) > SNIPPET_LENGTH:
+        content = content[:SNIPPET_LENGTH - 1] + '…'
+    return content
+
+
+def add_participants(conversation, users):
+    """Give each user an inbox entry for this conversation (existing entries are kept)"""
+    ConversationReadState.objects.bulk_create([
+        ConversationReadState(conversation=conversation, user=user,
+                              last_message_at=conversation.updated_at)
+        for user in users
+    ], ignore_conflicts=True)
+
+
+def record_message(message):
+    """Update every participant's inbox entry for a newly saved message with one UPDATE
+
+    The sender has obviously read everything up to their own message; everyone
+    else gets one more unread message.
+    """
+    sender_id = message.sender_id
+    ConversationReadState.objects.filter(conversation_id=message.conversation_id).update(
+        unread_count=Case(When(user_id=sender_id, then=Value(0)), default=F('unread_count') + 1,
+                          output_field=PositiveIntegerField()),
+        last_read_message_id=Case(When(user_id=sender_id, then=Value(message.pk)),
+                                  default=F('last_read_message_id'), output_field=BigIntegerField()),
+        last_message_snippet=snippet(message.content),
+        last_message_at=message.created_at,
+    )
+
+
+def unread_after(conversation_id, user, mark):
+    """Messages from others after the read mark `mark` (a value or expression), newest first"""
+    messages = Message.objects.filter(conversation_id=conversation_id).exclude(sender=user)
+    return messages.filter(id__gt=mark) if mark is not None else messages
+
+
+def mark_read_up_to(conversation_id, user, up_to=None):
+    """Move this user's read mark forward to message id `up_to` (default: the newest) with one UPDATE
+
+    The mark never moves back and never past the newest message, so sending the
+    same request twice, or an older one late, changes nothing. Returns the
+    conversation's (last_read_message_id, unread_count) afterwards, or None if
+    the user has no inbox entry for it.
+    """
+    from core import navigation
+    newest = Message.objects.filter(conversation_id=conversation_id).aggregate(newest=Max('id'))['newest']
+    up_to = min(up_to, newest or 0) if up_to is not None else newest or 0
+    unread = (unread_after(OuterRef('conversation_id'), user, up_to).order_by()
+              .values('conversation').annotate(count=Count('id')).values('count'))
+    states = ConversationReadState.objects.filter(conversation_id=conversation_id, user=user)
+    moved = up_to and states.filter(Q(last_read_message_id__lt=up_to) | Q(last_read_message_id__isnull=True)).update(
+        last_read_message_id=up_to, unread_count=Coalesce(Subquery(unread), Value(0)),
+    )
+    if moved:
+        navigation.invalidate_unread([user.pk])
+        publish_read(conversation_id, user, up_to)
+    return states.values_list('last_read_message_id', 'unread_count').first()
+
+
+def has_unread(conversation_id, user):
+    """Whether mark_read would move this user's read mark (a read, so a view with nothing new skips the write lock)"""
+    newest = Message.objects.filter(conversation_id=OuterRef('conversation_id')).order_by('-id').values('id')[:1]
+    return (ConversationReadState.objects.filter(conversation_id=conversation_id, user=user)
+            .annotate(newest=Subquery(newest))
+            .filter(Q(last_read_message_id__lt=F('newest'))
+                    | Q(last_read_message_id__isnull=True, newest__isnull=False))
+            .exists())
+
+
+def mark_read(conversation, user):
+    """Mark everything in the conversation as read by this user"""
+    return mark_read_up_to(conversation.pk, user)
+
+
+def unread_total(user):
+    """All unread messages across this user's conversations"""
+    total = ConversationReadState.objects.filter(user=user).aggregate(total=Sum('unread_count'))['total']
+    return total or 0
+
+
+def inbox(user):
+    """This user's inbox entries, most recently active first, in a single query"""
+    other_user = Conversation.participants.through.objects.filter(
+        conversation_id=OuterRef('conversation_id'),
+    ).exclude(user_id=user.id).values('user__username')[:1]
+    return (
+        ConversationReadState.objects.filter(user=user)
+        .select_related('conversation__item')
+        .annotate(other_username=Subquery(other_user))
+        .order_by('-last_message_at')
+    )
+
+
+def rebuild(conversations=None):
+    """Recreate inbox entries from the messages themselves (backfill or repair)"""
+    conversations = conversations if conversations is not None else Conversation.objects.all()
+    rebuilt = 0
+    for conversation in conversations.prefetch_related('participants').iterator(chunk_size=500):
+        last_message = conversation.messages.order_by('-id').first()
+        # Read marks can't be worked out from the messages, so keep the ones there are
+        marks = dict(conversation.read_states.values_list('user_id', 'last_read_message_id'))
+        ConversationReadState.objects.filter(conversation=conversation).delete()
+        states = []
+        for user in conversation.participants.all():
+            # Without a mark, the user has at least read up to their own last message
+            last_read = marks.get(user.pk) or conversation.messages.filter(sender=user).aggregate(
+                latest=Max('id'))['latest']
+            states.append(ConversationReadState(
+                conversation=conversation, user=user,
+                unread_count=unread_after(conversation.pk, user, last_read).count(),
+                last_read_message_id=last_read,
+                last_message_snippet=snippet(last_message.content) if last_message else '',
+                last_message_at=last_message.created_at if last_message else conversation.updated_at,
+            ))
+        ConversationReadState.objects.bulk_create(states)
+        rebuilt += len(states)
+    return rebuilt
+
+
+def message_payload(message):
+    """JSON for a message that does not depend on who is looking at it"""
+    return {
+        'id': message.pk,
+        'content': message.content,
+        'sender': message.sender.username,
+        'sender_id': message.sender_id,
+        'created_at': message.created_at.strftime('%b %d, %Y %H:%M'),
+    }
+
+
+def history(conversation, before=None, limit=HISTORY_PAGE_SIZE):
+    """One page of chat history as message payloads, oldest first, and whether older messages exist
+
+    The newest page without `before`, otherwise the page just older than message id
+    `before`. Once the Message table runs out it carries on into the archive
+    (items/archive.py).
+    """
+    from . import archive
+    messages = conversation.messages.select_related('sender').order_by('-id')
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    rows = list(messages[:limit + 1])  # One extra tells us whether there is more
+    payloads = [message_payload(message) for message in rows[:limit]]
+    has_older = len(rows) > limit
+    if not has_older:
+        oldest = payloads[-1]['id'] if payloads else before
+        archived, has_older = archive.older(conversation.pk, oldest, limit - len(payloads))
+        payloads += archived
+    payloads.reverse()
+    return payloads, has_older
+
+
+def publish_message(message):
+    """Push a new message to everyone watching the conversation once it is committed"""
+    event = {'type': 'message', 'message': message_payload(message)}
+    channel = conversation_channel(message.conversation_id)
+    transaction.on_commit(lambda: get_broker().publish(channel, event))
+
+
+def publish_read(conversation_id, user, last_read_message_id):
+    """Tell the other participants how far this user has read (a read receipt)"""
+    event = {'type': 'read', 'user_id': user.pk, 'user': user.username,
+             'last_read_message_id': last_read_message_id}
+    channel = conversation_channel(conversation_id)
+    transaction.on_commit(lambda: get_broker().publish(channel, event))
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:44
+
+import django.db.models.functions.comparison
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_initial'),
+        ('items', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-created_at', '-id'], name='item_active_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['category', '-created_at', '-id'], name='item_active_cat_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['item_type', '-created_at', '-id'], name='item_active_type_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(django.db.models.functions.comparison.Coalesce('price', models.Value(0)), models.F('id'), condition=models.Q(('is_active', True)), name='item_active_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['owner', '-created_at', '-id'], name='item_owner_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at'], name='message_conv_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['conversation', 'sender'], name='message_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def snippet(content):
+    """Inbox preview of a message, as items.messaging.snippet() made it when this migration was written"""
+    content = ' '.join(content.split())
+    if len(content) > 200:  # The length of last_message_snippet
+        content = content[:199] + '…'
+    return content
+
+
+def backfill_read_states(apps, schema_editor):
+    """Give every existing conversation its inbox entries, as messaging.rebuild() does"""
+    Conversation = apps.get_model('items', 'Conversation')
+    ConversationReadState = apps.get_model('items', 'ConversationReadState')
+    using = schema_editor.connection.alias
+    states = []
+    for conversation in Conversation.objects.using(using).prefetch_related('participants').iterator(chunk_size=500):
+        messages = conversation.messages.using(using)
+        last_message = messages.order_by('-id').first()
+        for user in conversation.participants.all():
+            unread = messages.filter(is_read=False).exclude(sender=user)
+            states.append(ConversationReadState(
+                conversation=conversation, user=user,
+                unread_count=unread.count(),
+                last_read_message_id=messages.exclude(pk__in=unread.values('pk')).aggregate(latest=Max('id'))['latest'],
+                last_message_snippet=snippet(last_message.content) if last_message else '',
+                last_message_at=last_message.created_at if last_message else conversation.updated_at,
+            ))
+        if len(states) >= 500:
+            ConversationReadState.objects.using(using).bulk_create(states)
+            states = []
+    ConversationReadState.objects.using(using).bulk_create(states)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0002_item_and_message_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_read_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_snippet', models.CharField(blank=True, max_length=200)),
+                ('last_message_at', models.DateTimeField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='items.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_message_at'], name='readstate_inbox_idx')],
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_read_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_media_blob'),
+        ('items', '0004_item_coordinates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['updated_at'], name='item_active_updated_idx'),
+        ),
+    ]
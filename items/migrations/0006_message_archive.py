@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0005_item_active_updated_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', '-id'], name='message_conv_history_idx'),
+        ),
+        migrations.AddField(
+            model_name='messagearchive',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archives', to='items.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='messagearchive',
+            index=models.Index(fields=['conversation', '-last_message_id'], name='archive_conv_history_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:31
+
+from django.db import migrations
+from django.db.models import Max, Q
+
+
+def carry_over_read_flags(apps, schema_editor):
+    """Move each read mark up to the newest message marked read through is_read, before the flag goes
+
+    Until now a reader could mark messages read through is_read alone, so a mark
+    may lag behind what its user has read. Marks only move forward.
+    """
+    Message = apps.get_model('items', 'Message')
+    ConversationReadState = apps.get_model('items', 'ConversationReadState')
+    using = schema_editor.connection.alias
+    for state in ConversationReadState.objects.using(using).iterator(chunk_size=500):
+        messages = Message.objects.using(using).filter(conversation_id=state.conversation_id)
+        # Everyone has read their own messages too
+        read_up_to = messages.filter(Q(is_read=True) | Q(sender_id=state.user_id)).aggregate(latest=Max('id'))['latest']
+        if read_up_to is None or (state.last_read_message_id or 0) >= read_up_to:
+            continue
+        state.last_read_message_id = read_up_to
+        state.unread_count = messages.filter(id__gt=read_up_to).exclude(sender_id=state.user_id).count()
+        state.save(update_fields=['last_read_message_id', 'unread_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0006_message_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(carry_over_read_flags, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_unread_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
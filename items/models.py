@@ -1,5 +1,9 @@
 from django.db import models  # Database tools
 from django.contrib.auth.models import User  # User accounts
+from django.db.models.expressions import RawSQL  # Literal SQL for the price sort
+from django.db.models.functions import Coalesce  # Used by the price index
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete  # Hook into item changes
+from django.dispatch import receiver  # Connect functions to events
 from core.models import Category  # Our category system
 
 
@@ -31,6 +35,9 @@ class Item(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)  # Price for rent/sale items
     condition = models.CharField(max_length=10, choices=CONDITION_CHOICES, default='good')  # Item condition
     location = models.CharField(max_length=200)  # Where the item is located
+    latitude = models.FloatField(null=True, blank=True, editable=False)  # Geocoded from location
+    longitude = models.FloatField(null=True, blank=True, editable=False)  # Geocoded from location
+    geohash = models.CharField(max_length=12, blank=True, editable=False)  # Grid cell of the coordinates
     contact_info = models.CharField(max_length=200)  # How to contact the owner
     image = models.ImageField(upload_to='items/')  # Photo of the item
     is_active = models.BooleanField(default=True)  # Whether this listing is still available
@@ -40,8 +47,41 @@ class Item(models.Model):
     def __str__(self):
         return f"{self.name} ({self.get_item_type_display()})"  # Show item name and type
 
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is not None and 'location' in update_fields:
+            # geocode_item_location fills these in from the location, so they must be written too
+            update_fields = {*update_fields, 'latitude', 'longitude', 'geohash'}
+        super().save(*args, update_fields=update_fields, **kwargs)
+
     class Meta:
         ordering = ['-created_at']  # Show newest items first by default
+        indexes = [
+            # Browse pages only ever show active items, so the hot indexes skip the rest.
+            # Each one ends in id so keyset pagination can seek straight to a cursor.
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(is_active=True),
+                         name='item_active_newest_idx'),  # Home feed and default browse order
+            models.Index(fields=['category', '-created_at', '-id'], condition=models.Q(is_active=True),
+                         name='item_active_cat_newest_idx'),  # Browse one category
+            models.Index(fields=['item_type', '-created_at', '-id'], condition=models.Q(is_active=True),
+                         name='item_active_type_newest_idx'),  # Browse swap / donate / rent
+            models.Index(Coalesce('price', models.Value(0)), 'id', condition=models.Q(is_active=True),
+                         name='item_active_price_idx'),  # Sort by price (no price counts as 0)
+            models.Index(fields=['owner', '-created_at', '-id'], name='item_owner_newest_idx'),  # My items
+            models.Index(fields=['updated_at'], condition=models.Q(is_active=True),
+                         name='item_active_updated_idx'),  # Newest edit, for ETags (see core/caching.py)
+            # Items near a place (see items/geo.py). Not partial: SQLite won't OR range scans over a partial index
+            models.Index(fields=['geohash', 'is_active'], name='item_geohash_idx'),
+        ]
+
+
+def sort_price():
+    """COALESCE(price, 0) for ordering by price
+
+    Written out as literal SQL: SQLite only uses item_active_price_idx when the
+    query repeats the indexed expression exactly, and a bound 0 parameter does not count.
+    """
+    return RawSQL(f'COALESCE({Item._meta.db_table}.price, 0)', [],
+                  output_field=models.DecimalField(max_digits=10, decimal_places=2))  # Same type as price
 
 
 class Conversation(models.Model):
@@ -65,7 +105,6 @@ class Message(models.Model):
                                      related_name='messages')  # Which chat this belongs to
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')  # Who sent this message
     content = models.TextField()  # The actual message text
-    is_read = models.BooleanField(default=False)  # Whether recipient has read this
     created_at = models.DateTimeField(auto_now_add=True)  # When message was sent
 
     def __str__(self):
@@ -73,3 +112,175 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['created_at']  # Show messages in chronological order
+        indexes = [
+            models.Index(fields=['conversation', 'created_at'], name='message_conv_created_idx'),  # Archiving
+            models.Index(fields=['conversation', '-id'], name='message_conv_history_idx'),  # Chat pages, newest first
+        ]
+
+
+
+class MessageArchive(models.Model):
+    """Old messages of one conversation, moved out of the Message table as compressed JSON (see items/archive.py)"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE,
+                                     related_name='archives')  # Which chat they belong to
+    first_message_id = models.BigIntegerField()  # Oldest message in this row
+    last_message_id = models.BigIntegerField()  # Newest message in this row
+    message_count = models.PositiveIntegerField()  # How many messages it holds
+    data = models.BinaryField()  # zlib-compressed JSON list of messages, oldest first
+    archived_at = models.DateTimeField(auto_now_add=True)  # When they were moved here
+
+    def __str__(self):
+        return f"{self.message_count} archived messages of {self.conversation_id}"  # Show size and chat
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', '-last_message_id'], name='archive_conv_history_idx'),  # Scrolling back
+        ]
+
+
+class ConversationReadState(models.Model):
+    """One row per (conversation, participant) holding that user's inbox entry
+
+    Keeping the unread count and last-message preview here means the inbox and
+    the unread badge read one small indexed table instead of counting messages.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE,
+                                     related_name='read_states')  # Which chat this is about
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='conversation_states')  # Whose inbox entry this is
+    unread_count = models.PositiveIntegerField(default=0)  # Messages from others not read yet
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)  # Newest message this user has seen
+    last_message_snippet = models.CharField(max_length=200, blank=True)  # Preview shown in the inbox
+    last_message_at = models.DateTimeField()  # When the chat last had activity
+
+    def __str__(self):
+        return f"{self.user.username} in {self.conversation}"  # Show whose state this is
+
+    class Meta:
+        unique_together = ['conversation', 'user']  # One inbox entry per participant
+        indexes = [
+            models.Index(fields=['user', '-last_message_at'], name='readstate_inbox_idx'),  # Inbox order
+        ]
+
+# Keep the full-text search index in step with the items table
+@receiver(post_save, sender=Item)  # Run this after an Item is created or edited
+def index_item_for_search(sender, instance, using, **kwargs):
+    """Refresh this item's entry in the search index"""
+    from . import search  # Imported here because search.py imports these models
+    search.index_item(instance, using=using)
+
+
+@receiver(post_delete, sender=Item)  # Run this after an Item is deleted
+def remove_item_from_search(sender, instance, using, **kwargs):
+    """Drop a deleted item from the search index"""
+    from . import search
+    search.remove_item(instance.pk, using=using)
+
+
+@receiver([post_save, post_delete], sender=Item)  # Run this when an item is created, edited or deleted
+def refresh_cached_item_pages(sender, **kwargs):
+    """Invalidate every cached page and fragment that shows items"""
+    from core import caching
+    caching.bump(caching.ITEMS)
+
+
+@receiver([post_save, post_delete], sender=Message)  # Run this when a message is sent or removed
+def refresh_unread_counts(sender, instance, origin=None, **kwargs):
+    """Drop the cached unread badge of everyone in the conversation"""
+    from core import navigation
+    if getattr(origin, 'model', type(origin)) in (Conversation, Item):
+        return  # The whole conversation is going; clear_unread_counts() has done it once for all its messages
+    participants = Conversation.participants.through.objects.filter(conversation_id=instance.conversation_id)
+    navigation.invalidate_unread(participants.values_list('user_id', flat=True))
+
+
+@receiver(pre_delete, sender=Conversation)  # Run this before a conversation is deleted, directly or with its item
+def clear_unread_counts(sender, instance, **kwargs):
+    """Drop the cached unread badge of everyone in a conversation that is about to go"""
+    from core import navigation
+    navigation.invalidate_unread(instance.participants.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Message)  # Run this after a message is saved
+def push_new_message(sender, instance, created, **kwargs):
+    """Send brand new messages to open chat windows over the live broker"""
+    if created:
+        from . import messaging
+        from core import metrics
+        messaging.publish_message(instance)
+        metrics.inc('messages_sent_total')
+
+
+@receiver(post_init, sender=Item)  # Run this when an Item is loaded or created in memory
+def remember_facet_state(sender, instance, **kwargs):
+    """Note which facet counts the item contributes to, to compare against after a save"""
+    from . import facets
+    instance._facet_state = facets.counted_state(instance)
+
+
+@receiver(post_save, sender=Item)  # Run this after an Item is saved
+def update_facet_counts(sender, instance, created, **kwargs):
+    """Move the item between the cached facet counts if its type, category, condition or status changed"""
+    from . import facets
+    after = facets.counted_state(instance)
+    before = None if created else getattr(instance, '_facet_state', facets.UNKNOWN)
+    facets.record_change(before, after)
+    instance._facet_state = after
+
+
+@receiver(post_delete, sender=Item)  # Run this after an Item is deleted
+def remove_from_facet_counts(sender, instance, **kwargs):
+    """Take a deleted item out of the cached facet counts"""
+    from . import facets
+    facets.record_change(getattr(instance, '_facet_state', facets.UNKNOWN), None)
+
+
+@receiver(post_save, sender=Item)  # Run this after an Item is saved
+def count_new_item(sender, instance, created, **kwargs):
+    """Count new listings for /metrics"""
+    if created:
+        from core import metrics
+        metrics.inc('items_created_total')
+
+
+@receiver(pre_save, sender=Item)  # Run this before an Item is saved
+def geocode_item_location(sender, instance, update_fields=None, **kwargs):
+    """Work out the item's coordinates from its location text"""
+    if update_fields is None or 'location' in update_fields:
+        from . import geo
+        geo.locate(instance)
+
+
+@receiver(pre_save, sender=Item)  # Run this before an Item is saved
+def note_item_image_upload(sender, instance, **kwargs):
+    """Spot a newly uploaded photo before Django stores it"""
+    from core import images
+    images.note_new_uploads(instance, 'image')
+
+
+@receiver(post_save, sender=Item)  # Run this after an Item is saved
+def make_item_image_variants(sender, instance, **kwargs):
+    """Resize a newly uploaded photo in the background"""
+    from core import images
+    images.process_new_uploads(instance)
+
+
+@receiver(post_init, sender=Item)  # Run this when an Item is loaded or created in memory
+def remember_item_image(sender, instance, **kwargs):
+    """Note which stored photo the item points at, to compare against after a save"""
+    from core import media
+    media.remember_names(instance, 'image')
+
+
+@receiver(post_save, sender=Item)  # Run this after an Item is saved
+def count_item_image_use(sender, instance, created, update_fields=None, **kwargs):
+    """Move the reference count to the item's new photo"""
+    from core import media
+    media.update_references(instance, 'image', created=created, update_fields=update_fields)
+
+
+@receiver(post_delete, sender=Item)  # Run this after an Item is deleted
+def release_item_image(sender, instance, **kwargs):
+    """The deleted item no longer uses its photo"""
+    from core import media
+    media.release_references(instance, 'image')
@@ -0,0 +1,112 @@
+"""WebSocket endpoint that pushes chat events to open conversation pages.
+
+This is a plain ASGI application mounted by swapdonaterent/asgi.py for
+`websocket` connections to /ws/conversations/<id>/. It authenticates with the
+normal session cookie, checks that the user takes part in the conversation and
+then forwards that conversation's broker events until either side hangs up.
+"""
+import asyncio
+import json
+import re
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+
+from .broker import conversation_channel, get_broker
+from .models import Conversation
+
+PATH_RE = re.compile(r'^/ws/conversations/(?P<conversation_id>\d+)/$')
+
+# Close codes in the 4000-4999 range are ours to define
+CLOSE_NOT_FOUND = 4404
+CLOSE_FORBIDDEN = 4403
+
+
+class _SessionRequest:
+    """Just enough of a request for django.contrib.auth.get_user()"""
+
+    def __init__(self, session):
+        self.session = session
+
+
+def _headers(scope):
+    return {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope.get('headers', [])}
+
+
+def _same_origin(headers):
+    """Browsers always send Origin on WebSockets; refuse pages from other sites"""
+    origin = headers.get('origin')
+    return origin is None or urlsplit(origin).netloc == headers.get('host')
+
+
+@sync_to_async
+def _authorize(session_key, conversation_id):
+    """Return the logged-in user if they may watch this conversation, else None"""
+    try:
+        engine = import_module(settings.SESSION_ENGINE)
+        user = get_user(_SessionRequest(engine.SessionStore(session_key)))
+        if not user.is_authenticated:
+            return None
+        allowed = Conversation.objects.filter(id=conversation_id, participants=user).exists()
+        return user if allowed else None
+    finally:
+        close_old_connections()  # Long-lived sockets must not pin a DB connection
+
+
+def _for_viewer(event, user):
+    """Add the per-viewer bits (is_own) to a broker event"""
+    if event.get('type') == 'message':
+        message = dict(event['message'], is_own=event['message']['sender_id'] == user.pk)
+        return dict(event, message=message)
+    if event.get('type') == 'read':
+        return dict(event, is_own=event['user_id'] == user.pk)
+    return event
+
+
+async def websocket_application(scope, receive, send):
+    match = PATH_RE.match(scope['path'])
+    if match is None:
+        await receive()  # websocket.connect
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    headers = _headers(scope)
+    cookies = SimpleCookie(headers.get('cookie', ''))
+    session_cookie = cookies.get(settings.SESSION_COOKIE_NAME)
+    conversation_id = int(match['conversation_id'])
+    user = None
+    if session_cookie and _same_origin(headers):
+        user = await _authorize(session_cookie.value, conversation_id)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+
+    await send({'type': 'websocket.accept'})
+    async with get_broker().subscribe(conversation_channel(conversation_id)) as subscription:
+
+        async def forward_events():
+            while True:
+                broker_event = await subscription.get()
+                if broker_event is not None:
+                    await send({'type': 'websocket.send', 'text': json.dumps(_for_viewer(broker_event, user))})
+
+        forwarder = asyncio.ensure_future(forward_events())
+        try:
+            # Clients only listen; anything they send is ignored until they disconnect
+            while (await receive())['type'] != 'websocket.disconnect':
+                pass
+        finally:
+            forwarder.cancel()
+            try:
+                await forwarder
+            except (asyncio.CancelledError, OSError):
+                pass
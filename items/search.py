@@ -0,0 +1,166 @@
+"""Full-text search for item listings.
+
+On SQLite the searchable text lives in an FTS5 side table that the Item
+signals in items/models.py keep in sync. On PostgreSQL a GIN index over a
+weighted tsvector expression does the same job without a side table. Any
+other database falls back to the old icontains scan.
+"""
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Item
+
+FTS_TABLE = 'items_item_fts'  # SQLite FTS5 virtual table, rowid == Item.id
+PG_INDEX = 'items_item_search_gin'  # PostgreSQL GIN expression index
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)  # Words we pass on to the search engine
+
+# Name matches are weighted above description matches on both backends
+PG_VECTOR = (
+    "(setweight(to_tsvector('english', coalesce({table}name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({table}description, '')), 'B'))"
+)
+FTS_WEIGHTS = (10.0, 1.0)  # bm25() column weights for (name, description)
+
+_fts5_support = {}  # alias -> whether that SQLite build was compiled with FTS5
+
+
+def backend(using='default'):
+    """Return 'fts5', 'postgres' or None for the given database alias"""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return 'postgres'
+    if connection.vendor == 'sqlite':
+        if using not in _fts5_support:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                _fts5_support[using] = bool(cursor.fetchone()[0])
+        if _fts5_support[using]:
+            return 'fts5'
+    return None
+
+
+def tokenize(query):
+    """Split raw user input into plain words, dropping any search syntax"""
+    return TOKEN_RE.findall(query.lower())
+
+
+def ensure_index(using='default'):
+    """Create the search structures if they are missing (safe to call repeatedly)"""
+    engine = backend(using)
+    with connections[using].cursor() as cursor:
+        if engine == 'fts5':
+            # prefix='2 3' keeps short prefix lookups ("ph"*, "pho"*) index-only
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                f"name, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+        elif engine == 'postgres':
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {PG_INDEX} ON {Item._meta.db_table} "
+                f"USING GIN ({PG_VECTOR.format(table='')})"
+            )
+
+
+def create_search_index(sender, using='default', **kwargs):
+    """post_migrate hook: make sure the index exists after migrate / test setup"""
+    ensure_index(using)
+
+
+def index_item(item, using='default'):
+    """Insert or refresh one item in the FTS table"""
+    if backend(using) != 'fts5':
+        return  # PostgreSQL maintains its expression index by itself
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [item.pk])
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)",
+            [item.pk, item.name, item.description],
+        )
+
+
+def index_items(pks, using='default'):
+    """Refresh a batch of items in the FTS table with two statements"""
+    pks = list(pks)
+    if not pks or backend(using) != 'fts5':
+        return
+    placeholders = ', '.join(['%s'] * len(pks))
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", pks)
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+            f"SELECT id, name, description FROM {Item._meta.db_table} WHERE id IN ({placeholders})",
+            pks,
+        )
+
+
+def remove_item(pk, using='default'):
+    """Drop one item from the FTS table"""
+    if backend(using) != 'fts5':
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [pk])
+
+
+def rebuild(using='default'):
+    """Rebuild the whole index from the items table and return how many rows it covers"""
+    engine = backend(using)
+    ensure_index(using)
+    table = Item._meta.db_table
+    with connections[using].cursor() as cursor:
+        if engine == 'fts5':
+            # One INSERT ... SELECT is far faster than re-saving items one at a time
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+                f"SELECT id, name, description FROM {table}"
+            )
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+        elif engine == 'postgres':
+            cursor.execute(f"REINDEX INDEX {PG_INDEX}")
+    return Item.objects.using(using).count()
+
+
+def search(queryset, query):
+    """Filter an Item queryset down to matches for `query`, annotated with `search_rank`
+
+    Every word is prefix-matched and all words must match. Higher `search_rank`
+    means a better match, so callers order by '-search_rank'.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return queryset.none()
+
+    engine = backend(queryset.db)
+    table = Item._meta.db_table
+    if engine == 'fts5':
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+        # bm25() is "lower is better", flip it so both backends sort the same way
+        ranks = f"SELECT rowid, -bm25({FTS_TABLE}, {weights}) AS rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+        if connections[queryset.db].Database.sqlite_version_info >= (3, 35):
+            # Run the MATCH once and look each row's rank up in the result, instead of
+            # re-running the full-text query for every matching item
+            rank_sql = f"(WITH ranks AS MATERIALIZED ({ranks}) SELECT rank FROM ranks WHERE rowid = {table}.id)"
+        else:
+            rank_sql = f"(SELECT rank FROM ({ranks}) WHERE rowid = {table}.id)"
+        return queryset.filter(
+            id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match])
+        ).annotate(search_rank=RawSQL(rank_sql, [match], output_field=FloatField()))
+    if engine == 'postgres':
+        tsquery = ' & '.join(f'{token}:*' for token in tokens)
+        vector = PG_VECTOR.format(table=f'{table}.')
+        return queryset.filter(RawSQL(
+            f"{vector} @@ to_tsquery('english', %s)", [tsquery], output_field=BooleanField()
+        )).annotate(search_rank=RawSQL(
+            f"ts_rank({vector}, to_tsquery('english', %s))", [tsquery], output_field=FloatField()
+        ))
+
+    # No full-text support: fall back to scanning name and description
+    condition = Q()
+    for token in tokens:
+        condition &= Q(name__icontains=token) | Q(description__icontains=token)
+    return queryset.filter(condition).annotate(search_rank=Value(0.0, output_field=FloatField()))
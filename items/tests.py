@@ -1,3 +1,718 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import re
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Max
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core import caching, navigation
+from core.pagination import KeysetPaginator
+from core.models import Cart, CartItem, Category, MediaBlob, OutboundEmail
+from .models import Item, Conversation, ConversationReadState, Message, MessageArchive, sort_price
+from . import archive, facets, geo, messaging, realtime, search, views
+from .broker import conversation_channel, get_broker
+from .bulk import COLUMNS
+
+
+class QueryPlanTests(TestCase):
+    """Run EXPLAIN on every hot query and fail if any of them scans a whole table
+
+    An index scan used only for ordering (e.g. "SCAN items_item USING INDEX ...")
+    is fine; a bare "SCAN items_item" / "Seq Scan on items_item" is not, and
+    neither is sorting the whole filtered result in a temporary B-tree.
+    """
+
+    # Tables that grow with usage; small lookup tables like categories are allowed to scan
+    HOT_TABLES = ('items_item', 'items_message', 'items_conversation', 'items_conversationreadstate',
+                  'items_conversation_participants', 'core_cart', 'core_cartitem', 'core_outboundemail',
+                  'core_mediablob', 'items_messagearchive')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        cls.category = Category.objects.create(name='Electronics')
+        cls.item = Item.objects.create(
+            owner=cls.owner, category=cls.category, item_type='rent', name='Phone',
+            description='Works fine', price=10, location='Dhaka', contact_info='owner@example.com',
+            image='items/phone.jpg',
+        )
+        cls.conversation = Conversation.objects.create(item=cls.item)
+        cls.conversation.participants.add(cls.owner, cls.buyer)
+        messaging.add_participants(cls.conversation, [cls.owner, cls.buyer])
+        messaging.record_message(
+            Message.objects.create(conversation=cls.conversation, sender=cls.buyer, content='Hi'))
+        cls.cart = Cart.objects.create(user=cls.buyer)
+        CartItem.objects.create(cart=cls.cart, item=cls.item)
+
+    def full_scans(self, queryset, sorted_by_index=True):
+        """Return the plan lines that read a hot table without an index (`queryset` may be a plan already)"""
+        plan = queryset if isinstance(queryset, str) else queryset.explain()
+        if connection.vendor == 'postgresql':
+            pattern = re.compile(r'Seq Scan on (\w+)')
+        else:
+            pattern = re.compile(r'SCAN (\w+)(?! USING)(?:\s|$)')
+        problems = [line.strip() for line in plan.splitlines()
+                    if (match := pattern.search(line)) and match.group(1) in self.HOT_TABLES]
+        if sorted_by_index and connection.vendor == 'sqlite':
+            problems += [line.strip() for line in plan.splitlines() if 'TEMP B-TREE FOR ORDER BY' in line]
+        return problems
+
+    def assertIndexed(self, queryset, sorted_by_index=True):
+        plan = queryset if isinstance(queryset, str) else queryset.explain()
+        self.assertEqual(self.full_scans(plan, sorted_by_index), [], plan)
+
+    def last_query_plan(self, run):
+        """EXPLAIN output for the last query `run()` makes, e.g. an aggregate, which has no .explain()"""
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        prefix = 'EXPLAIN ' if connection.vendor == 'postgresql' else 'EXPLAIN QUERY PLAN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + queries[-1]['sql'])
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def active_items(self):
+        return Item.objects.filter(is_active=True)
+
+    def test_home_feed(self):
+        self.assertIndexed(self.active_items().order_by('-created_at', '-id')[:9])
+
+    def test_browse_by_category(self):
+        self.assertIndexed(
+            self.active_items().filter(category_id=self.category.pk).order_by('-created_at', '-id')[:25])
+
+    def test_browse_by_type(self):
+        self.assertIndexed(self.active_items().filter(item_type='rent').order_by('-created_at', '-id')[:25])
+
+    def test_browse_by_price(self):
+        items = self.active_items().annotate(sort_price=sort_price())
+        self.assertIndexed(items.order_by('sort_price', 'id')[:25])
+        self.assertIndexed(items.order_by('-sort_price', '-id')[:25])
+
+    def test_my_items(self):
+        self.assertIndexed(Item.objects.filter(owner=self.owner).order_by('-created_at', '-id')[:25])
+
+    def test_search(self):
+        # Relevance is computed per query, so only the matching itself has to use an index
+        self.assertIndexed(search.search(self.active_items(), 'pho').order_by('-search_rank', '-id')[:25],
+                           sorted_by_index=False)
+
+    def test_nearby(self):
+        # Distance is computed per query, so only the geohash cells have to come from an index
+        nearby = geo.within_radius(self.active_items(), 23.81, 90.41, 10).order_by('distance_km', 'id')[:25]
+        self.assertIndexed(nearby, sorted_by_index=False)
+        if connection.vendor == 'sqlite':
+            # Range searches on the geohash, not a walk over the whole index
+            self.assertNotIn('SCAN items_item', nearby.explain())
+
+    def test_chat_history(self):
+        # Pages of messages.history(): the newest, then older ones before a message id
+        self.assertIndexed(self.conversation.messages.order_by('-id')[:51])
+        self.assertIndexed(self.conversation.messages.filter(id__lt=1000).order_by('-id')[:51])
+        self.assertIndexed(MessageArchive.objects.filter(conversation=self.conversation, first_message_id__lt=1000)
+                           .order_by('-last_message_id'))
+        # What archive_messages moves out, per conversation
+        self.assertIndexed(self.conversation.messages.filter(created_at__lt=timezone.now()).order_by('created_at', 'id'))
+
+    def test_conversation_unread_count(self):
+        # Messages after the read mark (see messaging.mark_read_up_to); order_by() mirrors .count()
+        self.assertIndexed(messaging.unread_after(self.conversation.pk, self.owner, 1).order_by())
+        self.assertIndexed(self.last_query_plan(lambda: messaging.has_unread(self.conversation.pk, self.owner)))
+
+    def test_global_unread_count(self):
+        self.assertIndexed(ConversationReadState.objects.filter(user=self.owner).order_by())
+
+    def test_inbox(self):
+        self.assertIndexed(messaging.inbox(self.buyer))
+
+    def test_cart_contents(self):
+        self.assertIndexed(CartItem.objects.filter(cart=self.cart))
+
+    def test_email_queue(self):
+        # What send_queued_email claims each batch (see core/mail.py)
+        self.assertIndexed(OutboundEmail.objects.filter(status=OutboundEmail.QUEUED, next_attempt_at__lte=timezone.now())
+                           .order_by('next_attempt_at').values('id')[:100])
+        self.assertIndexed(OutboundEmail.objects.filter(claim='abc').order_by('id'), sorted_by_index=False)
+
+    def test_media_garbage(self):
+        # What collect_media_garbage looks at, and the count update on every upload (see core/media.py)
+        self.assertIndexed(MediaBlob.objects.filter(refs=0, orphaned_at__lt=timezone.now())
+                           .order_by('orphaned_at').values('name')[:1000])
+        self.assertIndexed(MediaBlob.objects.filter(name=self.item.image.name), sorted_by_index=False)
+
+    def test_conditional_get(self):
+        # The validators behind the 304s of home, item_list and get_messages (see core/caching.py)
+        self.assertIndexed(self.last_query_plan(lambda: caching.freshness(self.active_items())))
+        self.assertIndexed(self.last_query_plan(lambda: caching.freshness(self.active_items().filter(
+            category=self.category))))
+        self.assertIndexed(self.active_items().filter(pk=self.item.pk).values('updated_at'), sorted_by_index=False)
+        self.assertIndexed(self.last_query_plan(lambda: Conversation.objects.filter(
+            id=self.conversation.pk, participants=self.buyer).aggregate(latest=Max('messages__id'))))
+
+    def test_browse_by_price_next_page(self):
+        # The cursor value is cast to a number, which must not stop the index from seeking to it
+        items = self.active_items().annotate(sort_price=sort_price())
+        after = KeysetPaginator(items, ('sort_price', 'id'))._after(['10.00', self.item.pk])
+        self.assertIndexed(items.filter(after).order_by('sort_price', 'id')[:25])
+
+
+class BrowsePagingTests(TestCase):
+    """Walk every page of the browse feed and check each item turns up exactly once"""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        category = Category.objects.create(name='Furniture')
+        # Repeated prices and donations without one, so ties are broken by id across page boundaries
+        prices = [None, 0, 5, '5.50', 5, 12, 100, '99.99']
+        Item.objects.bulk_create([
+            Item(owner=owner, category=category, item_type='donate' if prices[n % len(prices)] is None else 'rent',
+                 name=f'Lamp {n}' if n % 5 == 0 else f'Chair {n}' + ' chair' * (n % 3),  # Varied relevance
+                 description='Sturdy',  price=prices[n % len(prices)],
+                 location='Dhaka', contact_info='owner@example.com', image=f'items/chair{n}.jpg')
+            for n in range(60)
+        ])
+        cls.count = Item.objects.count()
+        search.rebuild()  # bulk_create skips the receivers that index each item
+
+    def walk(self, **params):
+        """Item ids in the order the feed pages hand them out"""
+        ids, cursor = [], None
+        for _ in range(self.count + 1):  # Never more pages than items; stops a cursor that goes round in circles
+            response = self.client.get(reverse('items:item_list_json'), {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            ids += [item['id'] for item in data['items']]
+            cursor = data['next_cursor']
+            if not cursor:
+                return ids
+        self.fail(f'Paging with {params} never reached the last page')
+
+    def test_price_sorts(self):
+        for sort, descending in (('price_low_high', False), ('price_high_low', True)):
+            with self.subTest(sort=sort):
+                ids = self.walk(sort=sort)
+                self.assertEqual(len(ids), len(set(ids)))
+                expected = sorted(Item.objects.values_list('price', 'id'),
+                                  key=lambda row: (row[0] or 0, row[1]), reverse=descending)
+                self.assertEqual(ids, [pk for _, pk in expected])
+
+    def test_date_sorts(self):
+        for sort, descending in (('newest', True), ('oldest', False), ('', True)):
+            with self.subTest(sort=sort):
+                expected = sorted(Item.objects.values_list('created_at', 'id'), reverse=descending)
+                self.assertEqual(self.walk(sort=sort), [pk for _, pk in expected])
+
+    def test_search_relevance(self):
+        expected = list(search.search(Item.objects.all(), 'chair').order_by('-search_rank', '-id')
+                        .values_list('id', flat=True))
+        self.assertEqual(len(expected), 48)
+        self.assertEqual(self.walk(search='chair'), expected)
+
+    def test_filtered(self):
+        expected = list(Item.objects.filter(item_type='rent').order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(self.walk(type='rent'), expected)
+
+    def test_bad_cursor(self):
+        response = self.client.get(reverse('items:item_list_json'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(STORAGES={**settings.STORAGES, 'staticfiles': {  # No collectstatic manifest in tests
+    'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+class ConditionalGetTests(TestCase):
+    """304s for browse pages (see core/caching.py conditional_response)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        category = Category.objects.create(name='Tools')
+        cls.items = [Item.objects.create(
+            owner=owner, category=category, item_type='rent', name=f'Drill {n}', description='Cordless',
+            price=5, location='Dhaka', contact_info='owner@example.com', image=f'items/drill{n}.jpg',
+        ) for n in range(2)]
+
+    def revalidate(self, url, response):
+        return self.client.get(url, headers={'if-none-match': response['ETag'],
+                                             'if-modified-since': timezone.now().strftime('%a, %d %b %Y %H:%M:%S GMT')})
+
+    def test_catalogue_pages_change_when_an_item_goes(self):
+        urls = [reverse('core:home'), reverse('items:item_list')]
+        first = {}
+        for url in urls:
+            first[url] = self.client.get(url)
+            self.assertEqual(first[url].status_code, 200)
+            self.assertNotIn('Last-Modified', first[url])  # The newest edit doesn't move when an item goes
+            self.assertEqual(self.revalidate(url, first[url]).status_code, 304)
+        # Taking the older item down leaves the newest updated_at as it was
+        Item.objects.filter(pk=self.items[0].pk).update(is_active=False)
+        caching.bump(caching.ITEMS)
+        for url in urls:
+            self.assertEqual(self.revalidate(url, first[url]).status_code, 200, url)
+
+
+class ImportExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('importer', password='pw')
+        cls.category = Category.objects.create(name='Tools')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def row(self, n, **fields):
+        return {'owner': 'importer', 'category': 'Tools', 'item_type': 'swap', 'name': f'Drill {n}',
+                'price': '', 'condition': 'good', 'image': f'items/drill{n}.jpg', **fields}
+
+    def write_jsonl(self, name, rows):
+        with open(self.path(name), 'w', encoding='utf-8') as stream:
+            for row in rows:
+                stream.write((row if isinstance(row, str) else json.dumps(row)) + '\n')
+        return self.path(name)
+
+    def run_import(self, path, *args):
+        out = io.StringIO()
+        call_command('import_items', path, *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def listed(self):
+        return list(Item.objects.order_by('name').values_list('owner__username', 'category__name', *COLUMNS[2:]))
+
+    def test_export_then_import_gives_back_the_same_items(self):
+        Item.objects.create(owner=self.owner, category=self.category, item_type='rent', name='Saw, "sharp"',
+                            description='Two lines\nof text', price='12.50', condition='new', location='Dhaka',
+                            contact_info='a@example.com', image='items/saw.jpg')
+        Item.objects.create(owner=self.owner, category=self.category, item_type='donate', name='Ladder',
+                            is_active=False)
+        before = self.listed()
+        for name in ('items.csv', 'items.jsonl'):
+            call_command('export_items', self.path(name), stderr=io.StringIO())
+            Item.objects.all().delete()
+            self.assertIn('Imported 2 items, rejected 0', self.run_import(self.path(name)))
+            self.assertEqual(self.listed(), before, name)
+            self.assertEqual(MediaBlob.objects.get(name='items/saw.jpg').refs, 1)
+
+    def test_resume_skips_the_rows_already_imported(self):
+        path = self.write_jsonl('items.jsonl', [self.row(n) for n in range(1, 6)])
+        with open(f'{path}.progress', 'w') as checkpoint:
+            checkpoint.write('3')  # An earlier run committed rows 1-3
+        output = self.run_import(path, '--resume')
+        self.assertIn('Resuming after row 3.', output)
+        self.assertEqual(list(Item.objects.order_by('name').values_list('name', flat=True)), ['Drill 4', 'Drill 5'])
+        self.assertFalse(os.path.exists(f'{path}.progress'))  # Finished, so nothing is left to resume
+
+    def test_a_failed_run_keeps_its_committed_batches_visible_and_resumable(self):
+        path = self.write_jsonl('items.jsonl', [self.row(n) for n in range(1, 6)])
+        versions = caching.get_versions([caching.ITEMS])
+        facets.rebuild()
+        bulk_create = Item.objects.bulk_create
+        calls = []
+
+        def fail_second_batch(objs, *args, **kwargs):
+            calls.append(len(objs))
+            if len(calls) == 2:
+                raise RuntimeError('disk full')
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(Item.objects, 'bulk_create', side_effect=fail_second_batch):
+            with self.assertRaises(RuntimeError):
+                self.run_import(path, '--batch-size', '2')
+        self.assertEqual(Item.objects.count(), 2)
+        # The first batch committed, so cached pages and facet counts must not hide it
+        self.assertNotEqual(caching.get_versions([caching.ITEMS]), versions)
+        self.assertIsNone(cache.get(facets.GENERATION_KEY))
+        with open(f'{path}.progress') as checkpoint:
+            self.assertEqual(checkpoint.read(), '2')
+
+        self.run_import(path, '--resume', '--batch-size', '2')
+        self.assertEqual(sorted(Item.objects.values_list('name', flat=True)), [f'Drill {n}' for n in range(1, 6)])
+
+    def test_bad_rows_are_rejected_without_stopping_the_import(self):
+        path = self.write_jsonl('items.jsonl', [
+            self.row(1),
+            self.row(2, name=123),  # Numbers where text belongs
+            self.row(3, owner=['importer']),
+            self.row(4, description={'long': True}),
+            '{"owner": "importer", "name": ',  # Cut off half way
+            '[1, 2, 3]',  # JSON, but not an object
+            self.row(7, price='cheap'),
+            self.row(8, owner='nobody'),
+            self.row(9, item_type='steal'),
+            self.row(10, price=7.5),  # A JSON number is fine for the price
+        ])
+        self.assertIn('Imported 2 items, rejected 8', self.run_import(path))
+        self.assertEqual(dict(Item.objects.values_list('name', 'price')), {'Drill 1': None, 'Drill 10': Decimal('7.50')})
+
+
+class FacetTests(TestCase):
+    """Delta-maintained facet counters (items/facets.py) against a fresh GROUP BY"""
+
+    FILTERS = [('', None, ''), ('rent', None, ''), ('', 'tools', 'good'), ('swap', 'garden', 'new')]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        cls.tools = Category.objects.create(name='Tools')
+        cls.garden = Category.objects.create(name='Garden')
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.item = self.create('rent', self.tools, 'good')
+        self.create('swap', self.tools, 'new')
+        self.create('rent', self.garden, 'good')
+        self.create('donate', self.garden, 'fair', is_active=False)
+        facets.rebuild()
+        self.generation = cache.get(facets.GENERATION_KEY)
+
+    def create(self, item_type, category, condition, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Item.objects.create(owner=self.owner, category=category, item_type=item_type, name='Thing',
+                                       condition=condition, **fields)
+
+    def filters(self, item_type, category, condition):
+        return item_type, category and getattr(self, category).pk, condition
+
+    def expected(self, item_type='', category_id=None, condition=''):
+        """Each facet counted straight from the table, filtered by the other two facets only"""
+        filters = {'item_type': item_type, 'category_id': category_id, 'condition': condition}
+        result = {}
+        for facet, field in (('item_type', 'item_type'), ('category', 'category_id'), ('condition', 'condition')):
+            others = {name: value for name, value in filters.items() if name != field and value not in ('', None)}
+            rows = (Item.objects.filter(is_active=True, **others).order_by().values_list(field)
+                    .annotate(count=Count('id')))
+            result[facet] = dict(rows)
+        return result
+
+    def assertCountsMatch(self):
+        self.assertEqual(cache.get(facets.GENERATION_KEY), self.generation)  # Moved by deltas, not recounted
+        for filters in self.FILTERS:
+            filters = self.filters(*filters)
+            self.assertEqual(facets.facet_counts(facets.catalogue_counts(), *filters), self.expected(*filters),
+                             filters)
+
+    def test_counters_follow_creates_updates_and_deletes(self):
+        self.assertCountsMatch()
+        self.create('swap', self.garden, 'new')
+        self.assertCountsMatch()
+        for field, value in (('item_type', 'swap'), ('category', self.garden), ('condition', 'new'),
+                             ('is_active', False), ('is_active', True)):
+            with self.captureOnCommitCallbacks(execute=True):
+                setattr(self.item, field, value)
+                self.item.save()
+            self.assertCountsMatch()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.delete()
+        self.assertCountsMatch()
+
+    def test_an_edit_that_moves_nothing_leaves_the_counters(self):
+        with mock.patch.object(facets, '_apply') as apply, self.captureOnCommitCallbacks(execute=True):
+            self.item.name = 'Renamed'
+            self.item.save()
+        apply.assert_not_called()
+        self.assertCountsMatch()
+
+    def test_partially_loaded_items_make_a_recount(self):
+        item = Item.objects.only('id', 'name').get(pk=self.item.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            item.delete()  # Which combination it counted in isn't known
+        self.assertIsNone(cache.get(facets.GENERATION_KEY))
+        self.generation = None
+        filters = self.filters('rent', None, '')
+        self.assertEqual(facets.facet_counts(facets.catalogue_counts(), *filters), self.expected(*filters))
+
+    def test_each_facet_ignores_its_own_filter(self):
+        counts = facets.facet_counts(facets.catalogue_counts(), 'rent', self.tools.pk, '')
+        # Swap and Donate still show how many Tools items there are; categories only count Rent
+        self.assertEqual(counts['item_type'], {'rent': 1, 'swap': 1})
+        self.assertEqual(counts['category'], {self.tools.pk: 1, self.garden.pk: 1})
+        self.assertEqual(counts['condition'], {'good': 1})
+
+    def test_endpoint_returns_the_counts_for_the_browse_filters(self):
+        self.create('donate', self.tools, 'good')
+        response = self.client.get(reverse('items:item_facets'), {'type': 'rent', 'condition': 'good'})
+        self.assertEqual(response.status_code, 200)
+        options = response.json()['facets']
+        expected = self.expected('rent', None, 'good')
+        for facet in facets.FACETS:
+            counts = {option['value']: option['count'] for option in options[facet] if option['count']}
+            self.assertEqual(counts, expected[facet], facet)
+        self.assertEqual([option['value'] for option in options['item_type'] if option['selected']], ['rent'])
+        self.assertFalse(any(option['selected'] for option in options['category']))
+
+
+class GeocodingTests(TestCase):
+    """Coordinates follow the location text, however the item gets saved"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.item = Item.objects.create(
+            owner=User.objects.create_user('owner', 'owner@example.com', 'pw'),
+            category=Category.objects.create(name='Tools'), item_type='rent', name='Drill',
+            description='Cordless', price=5, location='Dhaka', contact_info='owner@example.com',
+            image='items/drill.jpg',
+        )
+
+    def test_save_with_update_fields(self):
+        self.item.location = 'Chittagong'
+        self.item.save(update_fields=['location'])
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.latitude, self.item.longitude), (22.3569, 91.7832))
+        self.assertEqual(self.item.geohash, geo.encode(22.3569, 91.7832))
+
+    def test_geocode_items_invalidates_cached_pages(self):
+        Item.objects.filter(pk=self.item.pk).update(latitude=None, longitude=None, geohash='')
+        before, = caching.get_versions([caching.ITEMS])
+        call_command('geocode_items', '--missing', stdout=io.StringIO())
+        self.assertNotEqual(caching.get_versions([caching.ITEMS]), [before])
+        self.assertTrue(Item.objects.get(pk=self.item.pk).geohash)
+
+
+class ChatTests(TestCase):
+    """Behaviour of the chat helpers in items/messaging.py"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        cls.category = Category.objects.create(name='Electronics')
+        cls.item = Item.objects.create(
+            owner=cls.owner, category=cls.category, item_type='rent', name='Phone',
+            description='Works fine', price=10, location='Dhaka', contact_info='owner@example.com',
+            image='items/phone.jpg',
+        )
+        cls.conversation = Conversation.objects.create(item=cls.item)
+        cls.conversation.participants.add(cls.owner, cls.buyer)
+        messaging.add_participants(cls.conversation, [cls.owner, cls.buyer])
+
+    def send(self, sender, count=1):
+        """Post `count` messages from `sender`; returns their ids"""
+        messages = [Message.objects.create(conversation=self.conversation, sender=sender, content=f'Message {n}')
+                    for n in range(count)]
+        for message in messages:
+            messaging.record_message(message)
+        return [message.pk for message in messages]
+
+    def test_get_messages_since_returns_only_newer_messages(self):
+        ids = self.send(self.buyer, 3)
+        self.client.force_login(self.owner)
+        url = reverse('items:get_messages', args=[self.conversation.pk])
+        data = self.client.get(url, {'since': ids[0]}).json()
+        self.assertEqual([message['id'] for message in data['messages']], ids[1:])
+        self.assertEqual(data['last_id'], ids[-1])
+        self.assertFalse(any(message['is_own'] for message in data['messages']))
+        self.assertEqual(self.client.get(url, {'since': ids[-1]}).json()['messages'], [])
+        timestamp = Message.objects.get(pk=ids[0]).created_at - timedelta(seconds=1)
+        self.assertEqual([message['id'] for message in self.client.get(url, {'since': timestamp.isoformat()})
+                          .json()['messages']], ids)
+        self.assertEqual(self.client.get(url, {'since': 'yesterday'}).status_code, 400)
+        self.client.force_login(User.objects.create_user('stranger', 'stranger@example.com', 'pw'))
+        self.assertEqual(self.client.get(url, {'since': 0}).status_code, 404)
+
+    def test_get_messages_answers_unchanged_polls_with_304(self):
+        ids = self.send(self.buyer, 2)
+        self.client.force_login(self.owner)
+        url = reverse('items:get_messages', args=[self.conversation.pk])
+        first = self.client.get(url, {'since': ids[-1]})
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('private', first['Cache-Control'])
+        unchanged = self.client.get(url, {'since': ids[-1]}, headers={'if-none-match': first['ETag']})
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.content, b'')
+
+        [new_id] = self.send(self.buyer)
+        changed = self.client.get(url, {'since': ids[-1]}, headers={'if-none-match': first['ETag']})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertEqual([message['id'] for message in changed.json()['messages']], [new_id])
+        self.client.force_login(self.buyer)  # The ETag is per viewer: is_own differs
+        self.assertNotEqual(self.client.get(url, {'since': ids[-1]})['ETag'], changed['ETag'])
+
+    def test_delete_conversation_clears_badges_once(self):
+        self.send(self.buyer, 30)
+        self.assertEqual(navigation.unread_count(self.owner), 30)  # Now cached
+        # A handful of queries for the cascade, not a couple per message
+        with self.assertNumQueries(7):
+            self.conversation.delete()
+        self.assertEqual(navigation.unread_count(self.owner), 0)
+
+    def test_mark_read(self):
+        ids = self.send(self.buyer, 5)
+        other = Conversation.objects.create(item=self.item)
+        other.participants.add(self.owner, self.buyer)
+        messaging.add_participants(other, [self.owner, self.buyer])
+        messaging.record_message(Message.objects.create(conversation=other, sender=self.buyer, content='Also'))
+        self.client.force_login(self.owner)
+        url = reverse('items:mark_read', args=[self.conversation.pk])
+
+        def read(up_to):
+            response = self.client.post(url, {'up_to': up_to})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            return data['last_read_message_id'], data['unread_count'], data['unread_total']
+
+        self.assertEqual(read(ids[2]), (ids[2], 2, 3))
+        self.assertEqual(read(ids[2]), (ids[2], 2, 3))  # Sent twice: nothing changes
+        self.assertEqual(read(ids[0]), (ids[2], 2, 3))  # An older request arriving late: never backward
+        self.assertEqual(read(ids[-1] + 100), (ids[-1], 0, 1))  # Never past the newest message
+        self.assertEqual(messaging.unread_total(self.owner), 1)  # The other conversation is still unread
+        self.assertEqual(self.client.post(url, {'up_to': 'latest'}).status_code, 400)
+        self.client.force_login(User.objects.create_user('stranger', 'stranger@example.com', 'pw'))
+        self.assertEqual(self.client.post(url, {'up_to': ids[-1]}).status_code, 404)
+
+    def test_history_carries_on_into_the_archive(self):
+        ids = self.send(self.buyer, 12)
+        # The newest 5 stay in the table; the other 7 go into archive rows of 3, 3 and 1
+        with mock.patch.object(archive, 'KEEP_RECENT', 5), mock.patch.object(archive, 'CHUNK_SIZE', 3):
+            self.assertEqual(archive.archive_conversation(self.conversation, timezone.now() + timedelta(days=1)), 7)
+        self.assertEqual(self.conversation.messages.count(), 5)
+        for limit in (3, 4, 5, 12, 13):  # Pages that end inside, and exactly at, the table and each archive row
+            with self.subTest(limit=limit):
+                pages, before = [], None
+                while True:
+                    payloads, has_older = messaging.history(self.conversation, before, limit)
+                    pages.insert(0, [payload['id'] for payload in payloads])
+                    if not has_older:
+                        break
+                    before = payloads[0]['id']
+                self.assertEqual(sum(pages, []), ids)  # Each message once, oldest first
+                self.assertTrue(all(len(page) == limit for page in pages[1:]))  # Only the oldest page is short
+                self.assertTrue(pages[0])  # has_older was never true with nothing left
+
+    @override_settings(STORAGES={**settings.STORAGES, 'staticfiles': {  # No collectstatic manifest in tests
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+    def test_viewing_takes_the_write_lock_only_to_move_the_mark(self):
+        self.client.force_login(self.owner)
+        url = reverse('items:conversation_detail', args=[self.conversation.pk])
+        self.send(self.buyer, 2)
+        with mock.patch.object(views, 'write_transaction', wraps=views.write_transaction) as write:
+            self.client.get(url)
+            self.assertEqual(write.call_count, 1)
+            self.assertEqual(messaging.unread_total(self.owner), 0)
+            self.client.get(url)  # Nothing new since
+            self.assertEqual(write.call_count, 1)
+            self.send(self.owner)  # Their own message moves their mark itself
+            self.client.get(url)
+            self.assertEqual(write.call_count, 1)
+
+    @override_settings(CHAT_LONG_POLL_TIMEOUT=30, CHAT_LONG_POLL_RECHECK=0.2)
+    async def test_long_poll_sees_other_workers(self):
+        # bulk_create sends no signals, so nothing is published: like a message saved by another process
+        await self.async_client.aforce_login(self.owner)
+
+        async def post_elsewhere():
+            await asyncio.sleep(0.3)
+            await Message.objects.abulk_create([Message(conversation=self.conversation, sender=self.buyer, content='Hi')])
+
+        started = time.monotonic()
+        response, _ = await asyncio.gather(
+            self.async_client.get(reverse('items:wait_messages', args=[self.conversation.pk]), {'since': 0}),
+            post_elsewhere(),
+        )
+        self.assertEqual([message['content'] for message in response.json()['messages']], ['Hi'])
+        self.assertLess(time.monotonic() - started, 5)
+
+
+class RealtimeTests(TransactionTestCase):
+    """The chat WebSocket endpoint (items/realtime.py), driven like an ASGI server would"""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        self.stranger = User.objects.create_user('stranger', 'stranger@example.com', 'pw')
+        item = Item.objects.create(owner=self.owner, category=Category.objects.create(name='Electronics'),
+                                   item_type='rent', name='Phone')
+        self.conversation = Conversation.objects.create(item=item)
+        self.conversation.participants.add(self.owner, self.buyer)
+        messaging.add_participants(self.conversation, [self.owner, self.buyer])
+        self.path = f'/ws/conversations/{self.conversation.pk}/'
+
+    def session_cookie(self, user):
+        client = Client()
+        client.force_login(user)
+        return f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    async def connect(self, user=None, path=None, origin='http://testserver'):
+        """Open a socket; returns the communicator and the server's first reply"""
+        headers = [(b'host', b'testserver')]
+        if user is not None:
+            headers.append((b'cookie', (await sync_to_async(self.session_cookie)(user)).encode()))
+        if origin is not None:
+            headers.append((b'origin', origin.encode()))
+        communicator = ApplicationCommunicator(realtime.websocket_application, {
+            'type': 'websocket', 'path': path or self.path, 'headers': headers})
+        await communicator.send_input({'type': 'websocket.connect'})
+        return communicator, await communicator.receive_output(timeout=5)
+
+    async def disconnect(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(timeout=5)
+
+    async def next_event(self, communicator):
+        return json.loads((await communicator.receive_output(timeout=5))['text'])
+
+    async def test_only_participants_may_connect(self):
+        refused = {'type': 'websocket.close', 'code': realtime.CLOSE_FORBIDDEN}
+        self.assertEqual((await self.connect())[1], refused)  # Anonymous
+        self.assertEqual((await self.connect(self.stranger))[1], refused)
+        self.assertEqual((await self.connect(self.owner, path='/ws/conversations/0/'))[1], refused)
+        self.assertEqual((await self.connect(self.owner, path='/ws/elsewhere/'))[1],
+                         {'type': 'websocket.close', 'code': realtime.CLOSE_NOT_FOUND})
+        communicator, reply = await self.connect(self.owner)
+        self.assertEqual(reply, {'type': 'websocket.accept'})
+        await self.disconnect(communicator)
+
+    async def test_pages_from_other_sites_are_refused(self):
+        _, reply = await self.connect(self.owner, origin='https://evil.example')
+        self.assertEqual(reply, {'type': 'websocket.close', 'code': realtime.CLOSE_FORBIDDEN})
+        communicator, reply = await self.connect(self.owner, origin=None)  # Not a browser: nothing to forge
+        self.assertEqual(reply, {'type': 'websocket.accept'})
+        await self.disconnect(communicator)
+
+    async def test_events_reach_both_participants_marked_for_each(self):
+        owner_socket, _ = await self.connect(self.owner)
+        buyer_socket, _ = await self.connect(self.buyer)
+        message = await Message.objects.acreate(conversation=self.conversation, sender=self.buyer,
+                                                content='Still free?')
+        owner_event, buyer_event = await self.next_event(owner_socket), await self.next_event(buyer_socket)
+        self.assertEqual((owner_event['type'], owner_event['message']['id']), ('message', message.pk))
+        self.assertEqual(owner_event['message']['content'], 'Still free?')
+        self.assertFalse(owner_event['message']['is_own'])
+        self.assertTrue(buyer_event['message']['is_own'])
+
+        await sync_to_async(messaging.publish_read)(self.conversation.pk, self.owner, message.pk)
+        self.assertTrue((await self.next_event(owner_socket))['is_own'])
+        read = await self.next_event(buyer_socket)
+        self.assertEqual((read['type'], read['last_read_message_id'], read['is_own']), ('read', message.pk, False))
+
+        for communicator in (owner_socket, buyer_socket):
+            await self.disconnect(communicator)
+        self.assertNotIn(conversation_channel(self.conversation.pk), get_broker().subscribers)
+
+    async def test_other_conversations_are_not_forwarded(self):
+        communicator, _ = await self.connect(self.owner)
+        get_broker().publish(conversation_channel(self.conversation.pk + 1), {'type': 'message'})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        await self.disconnect(communicator)
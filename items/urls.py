@@ -7,6 +7,8 @@ app_name = 'items'  # Namespace for item URLs
 urlpatterns = [
     # Item browsing and management
     path('', views.item_list, name='item_list'),  # Browse all items
+    path('feed/', views.item_list_json, name='item_list_json'),  # Same results as JSON pages for infinite scroll
+    path('facets/', views.item_facets, name='item_facets'),  # Filter counts for the current browse as JSON
     path('my-items/', views.my_items, name='my_items'),  # View user's own items
     path('create/', views.item_create, name='item_create'),  # Post new item
     path('<int:pk>/', views.item_detail, name='item_detail'),  # View item details
@@ -16,7 +18,7 @@ urlpatterns = [
     # Shopping cart functionality
     path('cart/', views.cart_view, name='cart'),  # View cart
     path('cart/add/<int:pk>/', views.add_to_cart, name='add_to_cart'),  # Add item to cart
-    path('cart/remove/<int:pk>/', views.remove_from_cart, name='remove_from_cart'),  # Remove from cart
+    path('cart/remove/<int:pk>/', views.remove_from_cart, name='remove_from_cart'),  # Remove item <pk> from cart
 
     # Messaging system
     path('conversations/', views.conversations_list, name='conversations'),  # List conversations
@@ -24,7 +26,10 @@ urlpatterns = [
     # View conversation
     path('conversations/<int:conversation_id>/messages/', views.get_messages, name='get_messages'),
     # AJAX: get messages
+    path('conversations/<int:conversation_id>/messages/wait/', views.wait_messages, name='wait_messages'),
+    # AJAX long-poll: wait for the next message
     path('conversations/start/<int:item_id>/', views.start_conversation, name='start_conversation'),  # Start new chat
+    path('conversations/<int:conversation_id>/read/', views.mark_read, name='mark_read'),  # Read up to a message
     path('messages/<int:message_id>/read/', views.mark_message_read, name='mark_message_read'),  # Mark message as read
     path('conversations/<int:conversation_id>/delete/', views.delete_conversation, name='delete_conversation'),
     # Delete conversation
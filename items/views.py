@@ -1,17 +1,105 @@
+import asyncio
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Q
-from django.http import JsonResponse
-from .models import Item, Conversation, Message
+from django.db.models import Max
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_POST
+from .models import Item, Conversation, Message, sort_price
 from .forms import ItemForm, MessageForm
-from core.models import Cart, CartItem
+from . import facets, geo, messaging, search
+from .broker import conversation_channel, get_broker
+from core import caching, navigation
+from core.caching import cache_response, conditional_response
+from core.cart import get_cart
+from core.db import retry_on_busy, write_transaction, write_view
+from core.middleware import long_running
+from core.routers import read_from_primary
+from core.pagination import KeysetPaginator
+
+
+# Keyset orderings for each sort mode; the trailing id keeps every ordering unique
+SORT_ORDERINGS = {
+    'price_low_high': ('sort_price', 'id'),
+    'price_high_low': ('-sort_price', '-id'),
+    'newest': ('-created_at', '-id'),
+    'oldest': ('created_at', 'id'),
+}
+
+
+def _facet_filters(request):
+    """The type, category and condition filters from the query string; unknown values are ignored"""
+    item_type = request.GET.get('type', '')
+    category_id = request.GET.get('category', '')
+    condition = request.GET.get('condition', '')
+    return (
+        item_type if item_type in dict(Item.ITEM_TYPES) else '',
+        int(category_id) if category_id.isdigit() else None,
+        condition if condition in dict(Item.CONDITION_CHOICES) else '',
+    )
+
+
+def _float_param(request, name, low, high):
+    try:
+        value = float(request.GET[name])
+    except ValueError:
+        raise BadRequest(f'{name} must be a number.')
+    if not low <= value <= high:
+        raise BadRequest(f'{name} must be between {low} and {high}.')
+    return value
+
+
+def _near_items(request, items):
+    """Narrow to a place if the query string names one; returns (items, whether it did)
+
+    ?near=<place> or ?lat=&lng= with an optional ?radius= in km, or
+    ?bbox=south,west,north,east. Matches are annotated with distance_km.
+    """
+    if request.GET.get('bbox'):
+        try:
+            south, west, north, east = (float(value) for value in request.GET['bbox'].split(','))
+        except ValueError:
+            raise BadRequest('bbox must be south,west,north,east.')
+        if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+            raise BadRequest('bbox must be south,west,north,east.')
+        return geo.within_box(items, south, west, north, east), True
+
+    if request.GET.get('near'):
+        point = geo.get_geocoder().geocode(request.GET['near'])
+        if point is None:
+            return items.none(), True  # A place we don't know has nothing near it
+    elif request.GET.get('lat') and request.GET.get('lng'):
+        point = (_float_param(request, 'lat', -90, 90), _float_param(request, 'lng', -180, 180))
+    else:
+        return items, False
+    radius = _float_param(request, 'radius', 0, geo.MAX_RADIUS_KM) if request.GET.get('radius') else 10
+    return geo.within_radius(items, *point, radius), True
 
 
-def item_list(request):
+def _searched_items(request):
+    """Active items matching the search text and place (if any), before the facet filters
+
+    Returns (items, narrowed) where `narrowed` says whether anything was filtered out.
+    """
     items = Item.objects.filter(is_active=True)
-    item_type = request.GET.get('type', '')
-    category_id = request.GET.get('category', '')
+    search_query = request.GET.get('search', '')
+    if search_query:
+        # Search by name or description through the full-text index
+        items = search.search(items, search_query)
+    items, near = _near_items(request, items)
+    return items, bool(search_query) or near
+
+
+def _browse_items(request):
+    """Apply the browse filters from the query string and return (items, ordering)"""
+    items, _ = _searched_items(request)
+    item_type, category_id, condition = _facet_filters(request)
     sort = request.GET.get('sort', '')
     search_query = request.GET.get('search', '')
 
@@ -20,44 +108,108 @@ def item_list(request):
         items = items.filter(item_type=item_type)
 
     # Filter by category
-    if category_id:
+    if category_id is not None:
         items = items.filter(category_id=category_id)
 
-    # Search by name or description
-    if search_query:
-        items = items.filter(
-            Q(name__icontains=search_query) |
-            Q(description__icontains=search_query)
-        )
+    # Filter by condition
+    if condition:
+        items = items.filter(condition=condition)
 
     # Sort items
-    if sort == 'price_low_high':
-        items = items.order_by('price')
-    elif sort == 'price_high_low':
-        items = items.order_by('-price')
-    elif sort == 'newest':
-        items = items.order_by('-created_at')
-    elif sort == 'oldest':
-        items = items.order_by('created_at')
+    if sort in ('price_low_high', 'price_high_low'):
+        # Donated items have no price; treat them as free so the cursor never holds NULL.
+        # sort_price() matches item_active_price_idx so the sort comes from the index.
+        items = items.annotate(sort_price=sort_price())
+        ordering = SORT_ORDERINGS[sort]
+    elif sort in SORT_ORDERINGS:
+        ordering = SORT_ORDERINGS[sort]
+    elif 'distance_km' in items.query.annotations:
+        ordering = ('distance_km', 'id')  # Nearest first
+    elif search_query:
+        ordering = ('-search_rank', '-id')  # Best matches first
     else:
-        items = items.order_by('-created_at')
+        ordering = SORT_ORDERINGS['newest']
+
+    return items, ordering
+
+
+def _browse_facets(request):
+    """Result counts for each type, category and condition option of the current browse page"""
+    items, narrowed = _searched_items(request)
+    return facets.for_request(items, narrowed, *_facet_filters(request))
+
+
+def _serialize_item(item):
+    return {
+        'id': item.pk,
+        'name': item.name,
+        'item_type': item.item_type,
+        'price': str(item.price) if item.price is not None else None,
+        'condition': item.condition,
+        'location': item.location,
+        'image': item.image.url if item.image else None,
+        'url': reverse('items:item_detail', args=[item.pk]),
+        'created_at': item.created_at.isoformat(),
+        'latitude': item.latitude,
+        'longitude': item.longitude,
+        'distance_km': round(item.distance_km, 2) if getattr(item, 'distance_km', None) is not None else None,
+    }
+
+
+def _item_list_validators(request):
+    """Results and facet counts both come from the searched items"""
+    items, _ = _searched_items(request)
+    return caching.freshness(items)
+
+
+@conditional_response(_item_list_validators)
+@cache_response('item_list', [caching.ITEMS, caching.CATEGORIES])
+def item_list(request):
+    items, ordering = _browse_items(request)
+    page = KeysetPaginator(items, ordering).page(request.GET.get('cursor'))
+    return render(request, 'items/item_list.html', {
+        'items': page, 'page': page,
+        'facets': _browse_facets(request),  # Counts next to each filter option
+    })
+
+
+def item_list_json(request):
+    """Same results as item_list, as JSON pages for infinite scroll"""
+    items, ordering = _browse_items(request)
+    page = KeysetPaginator(items, ordering).page(request.GET.get('cursor'))
+    return JsonResponse({
+        'items': [_serialize_item(item) for item in page],
+        'next_cursor': page.next_cursor,
+    })
+
+
+def item_facets(request):
+    """Facet counts for the current browse filters as JSON, for updating the filter sidebar"""
+    return JsonResponse({'facets': _browse_facets(request)})
 
-    return render(request, 'items/item_list.html', {'items': items})
 
+def _item_detail_validators(request, pk):
+    updated_at = Item.objects.filter(pk=pk, is_active=True).order_by().values_list('updated_at', flat=True).first()
+    return None if updated_at is None else ([updated_at], updated_at)
 
+
+@conditional_response(_item_detail_validators)
+@cache_response('item_detail', [caching.ITEMS, caching.CATEGORIES])
 def item_detail(request, pk):
     item = get_object_or_404(Item, pk=pk, is_active=True)
     return render(request, 'items/item_detail.html', {'item': item})
 
 
 @login_required
+@retry_on_busy
 def item_create(request):
     if request.method == 'POST':
         form = ItemForm(request.POST, request.FILES)
         if form.is_valid():
             item = form.save(commit=False)
             item.owner = request.user
-            item.save()
+            with write_transaction():  # The item and its search index entry in one write
+                item.save()
             messages.success(request, 'Item posted successfully!')
             return redirect('items:item_detail', pk=item.pk)
     else:
@@ -66,12 +218,14 @@ def item_create(request):
 
 
 @login_required
+@retry_on_busy
 def item_update(request, pk):
     item = get_object_or_404(Item, pk=pk, owner=request.user)
     if request.method == 'POST':
         form = ItemForm(request.POST, request.FILES, instance=item)
         if form.is_valid():
-            form.save()
+            with write_transaction():
+                form.save()
             messages.success(request, 'Item updated successfully!')
             return redirect('items:item_detail', pk=item.pk)
     else:
@@ -80,10 +234,12 @@ def item_update(request, pk):
 
 
 @login_required
+@retry_on_busy
 def item_delete(request, pk):
     item = get_object_or_404(Item, pk=pk, owner=request.user)
     if request.method == 'POST':
-        item.delete()
+        with write_transaction():  # The item, its conversations and cart lines together
+            item.delete()
         messages.success(request, 'Item deleted successfully!')
         return redirect('users:profile')
     return render(request, 'items/item_confirm_delete.html', {'item': item})
@@ -91,35 +247,31 @@ def item_delete(request, pk):
 
 @login_required
 def my_items(request):
-    items = Item.objects.filter(owner=request.user).order_by('-created_at')
-    return render(request, 'items/my_items.html', {'items': items})
+    items = Item.objects.filter(owner=request.user)
+    page = KeysetPaginator(items, SORT_ORDERINGS['newest']).page(request.GET.get('cursor'))
+    return render(request, 'items/my_items.html', {'items': page, 'page': page})
 
 
-@login_required
+@write_view
 def add_to_cart(request, pk):
     item = get_object_or_404(Item, pk=pk, is_active=True)
-    cart, created = Cart.objects.get_or_create(user=request.user)
-
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, item=item)
-    if not created:
-        cart_item.quantity += 1
-        cart_item.save()
+    get_cart(request).add(item)  # Guests get a session cart, users a database one
 
     messages.success(request, f'{item.name} added to cart!')
     return redirect('items:cart')
 
 
-@login_required
 def cart_view(request):
-    cart, created = Cart.objects.get_or_create(user=request.user)
-    cart_items = CartItem.objects.filter(cart=cart)
-    return render(request, 'items/cart.html', {'cart_items': cart_items})
+    # One query: the cart's items with their line totals and the cart total
+    cart_items, cart_total = get_cart(request).lines()
+    return render(request, 'items/cart.html', {'cart_items': cart_items, 'cart_total': cart_total})
 
 
-@login_required
+@write_view
 def remove_from_cart(request, pk):
-    cart_item = get_object_or_404(CartItem, pk=pk, cart__user=request.user)
-    cart_item.delete()
+    # pk is the Item id, so the same link works for session and database carts
+    if not get_cart(request).remove(pk):
+        raise Http404('That item is not in your cart.')
     messages.success(request, 'Item removed from cart!')
     return redirect('items:cart')
 
@@ -129,53 +281,41 @@ def remove_from_cart(request, pk):
 
 @login_required
 def conversations_list(request):
-    conversations = Conversation.objects.filter(participants=request.user).order_by('-updated_at')
-
-    # Add unread counts to each conversation
-    for conversation in conversations:
-        # Calculate unread messages for this conversation
-        unread_count = Message.objects.filter(
-            conversation=conversation,
-            is_read=False
-        ).exclude(sender=request.user).count()
-
-        # Add as attribute to the conversation object
-        conversation.unread_count = unread_count
-
+    # Unread counts and last-message previews come from the read-state table in one query
+    conversations = messaging.inbox(request.user)
     return render(request, 'items/conversations.html', {'conversations': conversations})
 
 
 @login_required
+@retry_on_busy
 def conversation_detail(request, conversation_id):
     conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
 
     if request.method == 'POST':
         form = MessageForm(request.POST)
         if form.is_valid():
-            message = form.save(commit=False)
-            message.conversation = conversation
-            message.sender = request.user
-            message.save()
+            with write_transaction():
+                message = form.save(commit=False)
+                message.conversation = conversation
+                message.sender = request.user
+                message.save()
 
-            conversation.save()  # Update updated_at
+                conversation.save()  # Update updated_at
+                messaging.record_message(message)  # Bump everyone else's unread count
 
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return JsonResponse({
                     'success': True,
-                    'message': {
-                        'content': message.content,
-                        'sender': message.sender.username,
-                        'created_at': message.created_at.strftime('%b %d, %Y %H:%M'),
-                        'is_own': True
-                    }
+                    'message': _serialize_message(message, request.user)
                 })
             return redirect('items:conversation_detail', conversation_id=conversation_id)
     else:
         form = MessageForm()
 
-    # Mark messages as read when user views the conversation
-    unread_messages = conversation.messages.filter(is_read=False).exclude(sender=request.user)
-    unread_messages.update(is_read=True)
+    # Mark messages as read when user views the conversation (most views have nothing new to mark)
+    if messaging.has_unread(conversation.pk, request.user):
+        with write_transaction():
+            messaging.mark_read(conversation, request.user)
 
     # Get the other user in the conversation
     other_user = conversation.participants.exclude(id=request.user.id).first()
@@ -188,6 +328,7 @@ def conversation_detail(request, conversation_id):
 
 
 @login_required
+@write_view
 def start_conversation(request, item_id):
     item = get_object_or_404(Item, id=item_id, is_active=True)
 
@@ -204,6 +345,7 @@ def start_conversation(request, item_id):
     if not conversation:
         conversation = Conversation.objects.create(item=item)
         conversation.participants.add(request.user, item.owner)
+        messaging.add_participants(conversation, [request.user, item.owner])
         messages.success(request, f"Conversation started with {item.owner.username} about '{item.name}'")
     else:
         messages.info(request, f"Continuing conversation with {item.owner.username} about '{item.name}'")
@@ -211,41 +353,156 @@ def start_conversation(request, item_id):
     return redirect('items:conversation_detail', conversation_id=conversation.id)
 
 
+def _for_viewer(payload, user):
+    return dict(payload, is_own=payload['sender_id'] == user.id)
+
+
+def _serialize_message(msg, user):
+    return _for_viewer(messaging.message_payload(msg), user)
+
+
+def _conversation_validators(request, conversation_id):
+    """The newest message, from the participant check's own query"""
+    row = (Conversation.objects.filter(id=conversation_id, participants=request.user)
+           .aggregate(updated_at=Max('updated_at'), latest=Max('messages__id'),
+                      latest_at=Max('messages__created_at')))
+    if row['updated_at'] is None:
+        return None  # Not found, or not a participant; the view answers 404
+    return [request.user.pk, row['latest']], max(row['updated_at'], row['latest_at'] or row['updated_at'])
+
+
 @login_required
+@conditional_response(_conversation_validators, page=False)
 def get_messages(request, conversation_id):
+    """Messages newer than ?since=<message id> (or an ISO timestamp)
+
+    Without it, the newest page of history; ?before=<message id> gives the page
+    before that message, for scrolling back. Pages come with `has_older`.
+    The ETag names the newest message, so a poll that finds nothing new is
+    answered with an empty 304 after a single indexed lookup.
+    """
     conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
-    messages_list = conversation.messages.all().order_by('created_at')
+    since = request.GET.get('since', '')
+    before = request.GET.get('before', '')
+    if before and not before.isdigit():
+        return HttpResponseBadRequest('before must be a message id')
+    latest_id = conversation.messages.aggregate(latest=Max('id'))['latest'] or 0
+
+    if not since:
+        payloads, has_older = messaging.history(conversation, int(before) if before else None)
+        return JsonResponse({'messages': [_for_viewer(payload, request.user) for payload in payloads],
+                             'last_id': latest_id, 'has_older': has_older})
+
+    messages_list = conversation.messages.select_related('sender').order_by('id')
+    if since.isdigit():
+        messages_list = messages_list.filter(id__gt=int(since))
+    else:
+        try:
+            since_time = parse_datetime(since)
+        except ValueError:  # Looks like a timestamp but is not a real date
+            since_time = None
+        if since_time is None:
+            return HttpResponseBadRequest('since must be a message id or an ISO timestamp')
+        if timezone.is_naive(since_time):
+            since_time = timezone.make_aware(since_time)
+        messages_list = messages_list.filter(created_at__gt=since_time)
+
+    messages_data = [_serialize_message(msg, request.user) for msg in messages_list]
+    return JsonResponse({'messages': messages_data, 'last_id': latest_id})
+
+
+@long_running  # Waiting is the point; keep it out of the slow-request list
+@read_from_primary  # Woken by a message just saved on the primary; a replica may not have it yet
+@login_required
+async def wait_messages(request, conversation_id):
+    """Long-poll: answer as soon as a message newer than ?since=<id> exists, or after a timeout
+
+    Runs as an async view, so under ASGI a waiting client holds no worker thread.
+    The wake-up comes from the Message post_save receiver publishing to the chat
+    broker, not from re-querying the database while waiting. The in-process broker
+    never hears of messages saved by other worker processes, so with it the view
+    also looks again every CHAT_LONG_POLL_RECHECK seconds.
+    """
+    user = await request.auser()
+    since = request.GET.get('since', '0')
+    if not since.isdigit():
+        return HttpResponseBadRequest('since must be a message id')
+    since = int(since)
+    if not await Conversation.objects.filter(id=conversation_id, participants=user).aexists():
+        raise Http404('No conversation matches the given query.')
+
+    async def newer_messages():
+        return [_serialize_message(msg, user) async for msg in
+                Message.objects.filter(conversation_id=conversation_id, id__gt=since)
+                .select_related('sender').order_by('id')]
+
+    timeout = getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 55)
+    broker = get_broker()
+    recheck = None if broker.cross_process else getattr(settings, 'CHAT_LONG_POLL_RECHECK', 5)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # Subscribe before looking, so a message saved in between still wakes us up
+    async with broker.subscribe(conversation_channel(conversation_id)) as subscription:
+        messages_data = await newer_messages()
+        while not messages_data:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break  # Timed out; the client simply asks again
+            event = await subscription.get(timeout=min(remaining, recheck) if recheck else remaining)
+            if event is None and recheck is None:
+                break
+            if event is None or event.get('type') == 'message':
+                messages_data = await newer_messages()
+
+    last_id = messages_data[-1]['id'] if messages_data else since
+    return JsonResponse({'messages': messages_data, 'last_id': last_id})
+
+
+def _read_response(request, state):
+    if state is None:  # No inbox entry: not a participant (run rebuild_read_states for old chats)
+        raise Http404('No conversation matches the given query.')
+    last_read_message_id, unread_count = state
+    return JsonResponse({
+        'success': True,
+        'last_read_message_id': last_read_message_id,
+        'unread_count': unread_count,  # Left in this conversation
+        'unread_total': navigation.unread_count(request.user),  # For the badge in the navigation bar
+    })
 
-    messages_data = []
-    for msg in messages_list:
-        messages_data.append({
-            'content': msg.content,
-            'sender': msg.sender.username,
-            'created_at': msg.created_at.strftime('%b %d, %Y %H:%M'),
-            'is_own': msg.sender == request.user
-        })
 
-    return JsonResponse({'messages': messages_data})
+@login_required
+@require_POST
+@write_view
+def mark_read(request, conversation_id):
+    """Mark every message up to the posted `up_to` message id as read, in one UPDATE
+
+    Safe to repeat: the read mark only ever moves forward. Returns the new unread counts.
+    """
+    up_to = request.POST.get('up_to', '')
+    if not up_to.isdigit():
+        return HttpResponseBadRequest('up_to must be a message id')
+    return _read_response(request, messaging.mark_read_up_to(conversation_id, request.user, int(up_to)))
 
 
 # Additional utility view to mark a single message as read
 @login_required
+@write_view
 def mark_message_read(request, message_id):
+    """Older single-message form of mark_read: reading a message means reading everything before it too"""
     message = get_object_or_404(Message, id=message_id, conversation__participants=request.user)
-    if message.sender != request.user:  # Only mark others' messages as read
-        message.is_read = True
-        message.save()
-
-    return JsonResponse({'success': True})
+    return _read_response(request, messaging.mark_read_up_to(message.conversation_id, request.user, message.pk))
 
 
 # View to delete a conversation
 @login_required
+@retry_on_busy
 def delete_conversation(request, conversation_id):
     conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
 
     if request.method == 'POST':
-        conversation.delete()
+        navigation.invalidate_unread(conversation.participants.values_list('id', flat=True))
+        with write_transaction():
+            conversation.delete()
         messages.success(request, 'Conversation deleted successfully!')
         return redirect('items:conversations')
 
@@ -7,7 +7,20 @@ class Chat {
         this.messagesContainer = document.getElementById('chat-messages');  // Where messages appear
         this.messageForm = document.getElementById('message-form');  // The message sending form
         this.messageInput = document.getElementById('message-input');  // The message text box
+        this.olderButton = document.getElementById('load-older');  // "Load older messages" above the first one
         this.loading = false;  // Track if we're currently loading messages
+        this.lastId = 0;  // Newest message id the server has sent us; polls ask for newer ones
+        this.oldestId = null;  // Oldest message id we have shown; scrolling back fetches the page before it
+        this.hasOlder = false;  // Whether the server has older messages than the ones on screen
+        this.loadingOlder = false;  // Track if we're currently fetching an older page
+        this.etag = null;  // Lets the server answer "nothing new" with an empty 304
+        this.renderedIds = new Set();  // Messages already on screen (sent ones can also come back in a poll)
+        this.socket = null;  // Live connection that pushes new messages to us
+        this.polling = null;  // Stops the long-poll loop, which runs only while the live connection is unavailable
+        this.reconnectDelay = 1000;  // Grows each time the live connection fails
+        this.latestOtherId = 0;  // Newest message from the other person we have shown
+        this.readUpTo = 0;  // Newest message the server knows we have read
+        this.readTimer = null;  // Batches read receipts into one request
 
         this.init();  // Start up the chat system
     }
@@ -16,9 +29,90 @@ class Chat {
         // Set up the chat when page loads
         this.loadMessages();  // Load existing messages
         this.setupEventListeners();  // Set up click and typing handlers
+        this.connectSocket();  // Get new messages pushed to us as they are sent
+    }
+
+    connectSocket() {
+        // Open the live connection; poll for new messages only while it is unavailable
+        if (!('WebSocket' in window)) {
+            this.startPolling();
+            return;
+        }
+
+        const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        try {
+            this.socket = new WebSocket(`${scheme}://${window.location.host}/ws/conversations/${this.conversationId}/`);
+        } catch (error) {
+            this.startPolling();
+            return;
+        }
 
-        // Check for new messages every 5 seconds
-        setInterval(() => this.loadMessages(), 5000);
+        this.socket.addEventListener('open', () => {
+            this.stopPolling();  // Messages are pushed from now on
+            this.reconnectDelay = 1000;
+            this.loadMessages();  // Catch up on anything sent while we were not connected
+        });
+        this.socket.addEventListener('message', (event) => this.handleEvent(JSON.parse(event.data)));
+        this.socket.addEventListener('close', () => {
+            // Server without WebSockets, restart or network drop: poll, and try again later
+            this.socket = null;
+            this.startPolling();
+            setTimeout(() => this.connectSocket(), this.reconnectDelay);
+            this.reconnectDelay = Math.min(this.reconnectDelay * 2, 60000);
+        });
+    }
+
+    handleEvent(event) {
+        // Something happened in this conversation
+        if (event.type === 'message') {
+            this.lastId = Math.max(this.lastId, event.message.id);  // Pushed in order, so nothing older is missing
+            this.appendMessage(event.message);
+            this.scrollToBottom();
+            this.markRead();
+        } else if (event.type === 'read' && !event.is_own) {
+            this.showReadReceipt(event.last_read_message_id);
+        }
+    }
+
+    showReadReceipt(lastReadId) {
+        // Tick our own messages the other person has now read
+        this.messagesContainer.querySelectorAll('.message-own').forEach(element => {
+            if (Number(element.dataset.id) <= lastReadId) {
+                element.classList.add('message-read');
+            }
+        });
+    }
+
+    startPolling() {
+        // Fall back to long-polling: the server holds each request until a message arrives
+        if (this.polling) return;
+        this.polling = new AbortController();  // One loop at a time, however often the socket drops
+        this.longPoll(this.polling.signal);
+    }
+
+    stopPolling() {
+        if (!this.polling) return;
+        this.polling.abort();  // Ends the loop and cancels the request in flight
+        this.polling = null;
+    }
+
+    async longPoll(signal) {
+        while (!signal.aborted) {
+            try {
+                const response = await fetch(
+                    `/items/conversations/${this.conversationId}/messages/wait/?since=${this.lastId}`,
+                    {cache: 'no-store', signal: signal}
+                );
+                if (!response.ok) throw new Error(`Unexpected response ${response.status}`);
+                const data = await response.json();
+                if (data.messages.length) this.renderMessages(data.messages);
+            } catch (error) {
+                if (signal.aborted) return;  // Stopped on purpose
+                // Server or network trouble: wait a little before asking again
+                console.error('Error waiting for messages:', error);
+                await new Promise(resolve => setTimeout(resolve, 5000));
+            }
+        }
     }
 
     setupEventListeners() {
@@ -28,6 +122,12 @@ class Chat {
             this.sendMessage();  // Send message using AJAX
         });
 
+        // Older messages: on request, or as soon as the user scrolls to the top
+        this.olderButton?.addEventListener('click', () => this.loadOlder());
+        this.messagesContainer.addEventListener('scroll', () => {
+            if (this.messagesContainer.scrollTop < 50) this.loadOlder();
+        });
+
         // Auto-resize message input as user types
         this.messageInput.addEventListener('input', () => {
             this.messageInput.style.height = 'auto';  // Reset height
@@ -42,13 +142,24 @@ class Chat {
 
         this.loading = true;  // Mark as loading
         try {
-            // Ask server for latest messages
-            const response = await fetch(`/items/conversations/${this.conversationId}/messages/`);
+            // Ask server only for messages newer than the last one we have
+            // (the first time, for the newest page of history)
+            const headers = this.etag ? {'If-None-Match': this.etag} : {};
+            const query = this.lastId ? `?since=${this.lastId}` : '';
+            const response = await fetch(
+                `/items/conversations/${this.conversationId}/messages/${query}`,
+                {headers: headers, cache: 'no-store'}
+            );
+            if (response.status === 304) return;  // Nothing new since the last poll
+            if (!response.ok) throw new Error(`Unexpected response ${response.status}`);
+
+            this.etag = response.headers.get('ETag');
             const data = await response.json();  // Parse JSON response
 
-            if (data.messages) {  // If we got messages back
-                this.renderMessages(data.messages);  // Show them in the chat
+            if (data.messages && data.messages.length) {  // If we got new messages back
+                this.renderMessages(data.messages);  // Add them to the chat
             }
+            if (!query) this.setHasOlder(data.has_older);  // The first page says whether there is more
         } catch (error) {
             // If something went wrong, log error but don't crash
             console.error('Error loading messages:', error);
@@ -56,23 +167,105 @@ class Chat {
             this.loading = false;  // No longer loading
         }
     }
-renderMessages(messages) {
-        // Clear current messages and show new ones
-        this.messagesContainer.innerHTML = '';  // Empty the container
+async loadOlder() {
+        // Fetch the page of messages just before the oldest one on screen
+        if (!this.hasOlder || this.loadingOlder || this.oldestId === null) return;
 
-        // Create and add each message to the chat
+        this.loadingOlder = true;
+        try {
+            const response = await fetch(
+                `/items/conversations/${this.conversationId}/messages/?before=${this.oldestId}`
+            );
+            if (!response.ok) throw new Error(`Unexpected response ${response.status}`);
+            const data = await response.json();
+
+            // Keep the messages the user was reading where they were on screen
+            const previousHeight = this.messagesContainer.scrollHeight;
+            // Newest first, each going in just above the one after it
+            data.messages.slice().reverse().forEach(message => this.prependMessage(message));
+            this.messagesContainer.scrollTop += this.messagesContainer.scrollHeight - previousHeight;
+            this.setHasOlder(data.has_older);
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            this.loadingOlder = false;
+        }
+    }
+
+    setHasOlder(hasOlder) {
+        this.hasOlder = hasOlder;
+        if (this.olderButton) this.olderButton.hidden = !hasOlder;
+    }
+
+    renderMessages(messages) {
+        // Append messages from a poll below the ones already shown
         messages.forEach(message => {
-            const messageElement = this.createMessageElement(message);
-            this.messagesContainer.appendChild(messageElement);
+            this.lastId = Math.max(this.lastId, message.id);
+            this.appendMessage(message);
         });
 
         this.scrollToBottom();  // Keep view at latest message
+        this.markRead();
+    }
+
+    markRead() {
+        // Tell the server we have read up to the newest message on screen, at most once a second
+        if (this.latestOtherId <= this.readUpTo || this.readTimer) return;
+        this.readTimer = setTimeout(async () => {
+            this.readTimer = null;
+            const upTo = this.latestOtherId;
+            const body = new FormData();
+            body.append('up_to', upTo);
+            try {
+                const response = await fetch(`/items/conversations/${this.conversationId}/read/`, {
+                    method: 'POST',
+                    body: body,
+                    headers: {'X-CSRFToken': this.getCsrfToken()}  // Security token
+                });
+                if (!response.ok) throw new Error(`Unexpected response ${response.status}`);
+                this.readUpTo = Math.max(this.readUpTo, upTo);
+            } catch (error) {
+                console.error('Error marking messages read:', error);  // The next message tries again
+            }
+        }, 1000);
+    }
+
+    appendMessage(message) {
+        // Add one message unless it is already on screen
+        if (this.renderedIds.has(message.id)) return;
+        this.renderedIds.add(message.id);
+        if (!message.is_own) this.latestOtherId = Math.max(this.latestOtherId, message.id);
+        this.oldestId = this.oldestId === null ? message.id : Math.min(this.oldestId, message.id);
+
+        const messageElement = this.createMessageElement(message);
+        // Normally the newest; but a poll can bring a message sent just before one of ours already on screen
+        const last = this.messagesContainer.lastElementChild;
+        const later = last && Number(last.dataset.id) > message.id
+            ? [...this.messagesContainer.querySelectorAll('.message-bubble')]
+                .find(element => Number(element.dataset.id) > message.id)
+            : null;
+        this.messagesContainer.insertBefore(messageElement, later || null);
+    }
+
+    prependMessage(message) {
+        // Add one older message above the ones already shown
+        if (this.renderedIds.has(message.id)) return;
+        this.renderedIds.add(message.id);
+        this.oldestId = this.oldestId === null ? message.id : Math.min(this.oldestId, message.id);
+
+        const messageElement = this.createMessageElement(message);
+        if (this.olderButton) {
+            this.olderButton.after(messageElement);  // The button stays at the very top
+        } else {
+            this.messagesContainer.prepend(messageElement);
+        }
     }
 createMessageElement(message) {
         // Create HTML element for a single message
         const messageDiv = document.createElement('div');
         // Add CSS class based on who sent the message
         messageDiv.className = `message-bubble ${message.is_own ? 'message-own' : 'message-other'}`;
+        messageDiv.dataset.id = message.id;  // Lets read receipts find this message
 
         // Fill in the message content and info
         messageDiv.innerHTML = `
@@ -121,8 +314,8 @@ async sendMessage() {
     }
 addMessageToChat(message) {
         // Add a new message to the chat without reloading
-        const messageElement = this.createMessageElement(message);
-        this.messagesContainer.appendChild(messageElement);
+        // (lastId stays put: someone else's message may have been saved just before this one)
+        this.appendMessage(message);
         this.scrollToBottom();  // Scroll to show new message
     }
 
@@ -2,6 +2,8 @@
 ASGI config for swapdonaterent project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django as usual; WebSocket connections go to the live chat
+endpoint in items/realtime.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +15,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'swapdonaterent.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from items.realtime import websocket_application  # noqa: E402  (needs the apps loaded above)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
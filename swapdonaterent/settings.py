@@ -1,4 +1,6 @@
 import os
+import sys
+import tempfile
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -22,7 +24,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',  # First, so its timings include the other middleware
+    'core.middleware.PerformanceMiddleware',
+    'core.routers.ReplicaRoutingMiddleware',  # Before sessions, so it sees their writes too
     'django.middleware.security.SecurityMiddleware',
+    'core.staticfiles.StaticFilesMiddleware',  # Collected static files, before sessions and auth get involved
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -31,11 +37,27 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Request timing and N+1 detection (see core/middleware.py). Every request is timed;
+# this share of them also gets query counts, duplicate-query checks and a Server-Timing header.
+PERF_SAMPLE_RATE = 1.0 if DEBUG else 0.05
+PERF_SLOW_REQUEST_MS = 500  # Slower requests are logged and listed at /admin/slow-requests/
+PERF_DUPLICATE_THRESHOLD = 5  # The same query this many times in one request is reported as an N+1
+
+# Prometheus metrics at /metrics (see core/metrics.py). Each worker process writes its
+# totals here and a scrape adds them all up, so every worker must see the same directory.
+# METRICS_ALLOWED_IPS limits who may scrape (loopback only unless opened up); None lets anyone.
+METRICS_DIR = BASE_DIR / 'metrics'
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+if sys.argv[1:2] == ['test']:
+    # Test requests must not add to the real totals; the directory goes when the run ends
+    _test_metrics_dir = tempfile.TemporaryDirectory(prefix='swapdonaterent-test-metrics-')
+    METRICS_DIR = Path(_test_metrics_dir.name)
+
 ROOT_URLCONF = 'swapdonaterent.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'core.template_backends.InstrumentedDjangoTemplates',  # Django's engine, timed for /metrics
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -44,22 +66,67 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
-                'core.context_processors.cart_count',
-                'core.context_processors.categories',
-                'core.context_processors.unread_messages_count',
+                'core.context_processors.navigation_context',
             ],
         },
     },
 ]
 
 WSGI_APPLICATION = 'swapdonaterent.wsgi.application'
-
+ASGI_APPLICATION = 'swapdonaterent.asgi.application'
+
+# Fan-out for live chat over WebSockets (see items/broker.py). The in-process
+# broker only reaches sockets served by the same process; run several workers
+# behind RedisBroker instead:
+#   CHAT_BROKER = {'BACKEND': 'items.broker.RedisBroker', 'OPTIONS': {'url': 'redis://localhost:6379/0'}}
+CHAT_BROKER = {'BACKEND': 'items.broker.InProcessBroker'}
+
+# Seconds a long-poll request for new chat messages waits before returning empty.
+# Kept under the common 60s proxy timeout.
+CHAT_LONG_POLL_TIMEOUT = 55
+# With the in-process broker a long poll can't hear of messages posted through other
+# worker processes, so it also re-checks the database this often (seconds)
+CHAT_LONG_POLL_RECHECK = 5
+
+# Chat history is sent this many messages at a time, newest first. `manage.py
+# archive_messages` moves messages older than CHAT_ARCHIVE_AFTER_DAYS into compressed
+# per-conversation blobs (see items/archive.py), keeping each chat's newest page in place.
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_ARCHIVE_AFTER_DAYS = 365
+
+# SQLite tuned for many concurrent requests (see core/db.py): WAL so reads never wait
+# for a write, every atomic() block starting with BEGIN IMMEDIATE, and up to `timeout`
+# seconds of waiting for the write lock before "database is locked".
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 5,
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'  # Safe with WAL; only the last commits can be lost on power failure
+                'PRAGMA cache_size=-20000;'  # 20 MB page cache per connection
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=134217728;'  # Read through a 128 MB memory map
+                'PRAGMA journal_size_limit=67108864;'  # Trim the WAL file back to 64 MB after checkpoints
+            ),
+        },
     }
 }
+DATABASE_BUSY_RETRIES = 3  # Times a write view is run again when the lock wait still times out
+
+# Read replicas (see core/routers.py). Requests' reads go to these aliases from DATABASES and
+# writes to 'default'; a browser that wrote reads from 'default' for the next
+# DATABASE_PRIMARY_PIN_SECONDS. To try it locally, add an alias whose NAME is the
+# same SQLite file (or a Postgres standby) and list it here, e.g.
+#   DATABASES['replica1'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+#   DATABASE_REPLICAS = ['replica1']
+DATABASE_ROUTERS = ['core.routers.PrimaryReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_PRIMARY_PIN_SECONDS = 10
+DATABASE_REPLICA_MAX_LAG = 5  # Seconds; a replica further behind is skipped until it catches up
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -85,9 +152,42 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# `collectstatic` minifies, content-hashes and precompresses (.gz, and .br with the brotli
+# package) into STATIC_ROOT; with DEBUG off StaticFilesMiddleware serves it from there with
+# year-long immutable caching for the hashed names (see core/staticfiles.py).
+STORAGES = {
+    'default': {'BACKEND': 'core.media.ContentAddressedStorage'},  # Uploads named by content hash
+    'staticfiles': {'BACKEND': 'core.staticfiles.CompressedManifestStaticFilesStorage'},
+}
+
+# Seconds cached pages and template fragments live (see core/caching.py). Saving an
+# Item or Category invalidates them straight away, so this is only an upper bound.
+PAGE_CACHE_TIMEOUT = 600
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are stored once per distinct content, under their SHA-256 (see core/media.py),
+# so /media/ URLs never change meaning and the web server can serve them with
+# `Cache-Control: public, max-age=31536000, immutable`. `manage.py collect_media_garbage`
+# deletes files nothing has used for this many seconds.
+MEDIA_GC_GRACE = 24 * 3600
+
+# Uploaded images get resized WebP/JPEG copies at these widths (see core/images.py),
+# made by this many background threads per process
+IMAGE_VARIANT_WIDTHS = (320, 640, 1024)
+IMAGE_WORKERS = 2
+
+# Outgoing email is queued in the database and sent by `manage.py send_queued_email --loop`
+# (see core/mail.py), over SMTP to EMAIL_HOST:EMAIL_PORT. Port 1025 is a local stand-in for
+# development, e.g. `python -m aiosmtpd -n -l localhost:1025`, which prints every message.
+EMAIL_BACKEND = 'core.mail.QueuedEmailBackend'
+EMAIL_QUEUE_DELIVERY_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_HOST = 'localhost'
+EMAIL_PORT = 1025
+EMAIL_TIMEOUT = 10  # Seconds before a stuck mail server counts as a failed attempt
+DEFAULT_FROM_EMAIL = 'SwapDonateRent <noreply@swapdonaterent.local>'
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_URL = 'users:login'
@@ -2,18 +2,21 @@ from django.contrib import admin  # Import the admin panel
 from django.urls import path, include  # Tools for creating website URLs
 from django.conf import settings  # Access our project settings
 from django.conf.urls.static import static  # Serve files during development
+from core import views as core_views  # Admin slow-request page and /metrics
 
 # This list tells Django which URLs go to which pages
 urlpatterns = [
+    path('admin/slow-requests/', admin.site.admin_view(core_views.slow_requests),
+         name='slow_requests'),  # Listed before admin/ so the admin doesn't claim the URL
     path('admin/', admin.site.urls),          # The admin dashboard lives at /admin/
+    path('metrics', core_views.metrics, name='metrics'),  # Prometheus scrape target
     path('', include('core.urls', namespace='core')),      # Homepage and basic pages
     path('users/', include('users.urls', namespace='users')),  # All user account pages
     path('items/', include('items.urls', namespace='items')),  # All item-related pages
 ]
 
-# During development, serve user-uploaded files and static files
+# During development, serve user-uploaded files. Static files come from runserver in
+# development and from core.staticfiles.StaticFilesMiddleware after collectstatic.
 if settings.DEBUG:
     # This makes uploaded images available at /media/
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-    # This makes CSS/JS files available at /static/
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -1,6 +1,6 @@
 from django.db import models  # Database tools
 from django.contrib.auth.models import User  # Built-in user system
-from django.db.models.signals import post_save  # Hook into when users are saved
+from django.db.models.signals import post_init, pre_save, post_save, post_delete  # Hook into when users are saved
 from django.dispatch import receiver  # Connect functions to events
 
 class Profile(models.Model):
@@ -27,3 +27,38 @@ def create_user_profile(sender, instance, created, **kwargs):
 def save_user_profile(sender, instance, **kwargs):
     """Whenever a user is saved, make sure their profile gets saved too"""
     instance.profile.save()  # Save the profile linked to this user
+
+
+@receiver(pre_save, sender=Profile)  # Run this before a profile is saved
+def note_profile_picture_upload(sender, instance, **kwargs):
+    """Spot a newly uploaded profile picture before Django stores it"""
+    from core import images
+    images.note_new_uploads(instance, 'profile_picture')
+
+
+@receiver(post_save, sender=Profile)  # Run this after a profile is saved
+def make_profile_picture_variants(sender, instance, **kwargs):
+    """Resize a newly uploaded profile picture in the background"""
+    from core import images
+    images.process_new_uploads(instance)
+
+
+@receiver(post_init, sender=Profile)  # Run this when a profile is loaded or created in memory
+def remember_profile_picture(sender, instance, **kwargs):
+    """Note which stored picture the profile points at, to compare against after a save"""
+    from core import media
+    media.remember_names(instance, 'profile_picture')
+
+
+@receiver(post_save, sender=Profile)  # Run this after a profile is saved
+def count_profile_picture_use(sender, instance, created, update_fields=None, **kwargs):
+    """Move the reference count to the profile's new picture"""
+    from core import media
+    media.update_references(instance, 'profile_picture', created=created, update_fields=update_fields)
+
+
+@receiver(post_delete, sender=Profile)  # Run this after a profile is deleted
+def release_profile_picture(sender, instance, **kwargs):
+    """The deleted profile no longer uses its picture"""
+    from core import media
+    media.release_references(instance, 'profile_picture')
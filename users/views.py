@@ -8,7 +8,7 @@ from django.contrib.auth.tokens import default_token_generator  # Secure passwor
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode  # URL-safe encoding
 from django.utils.encoding import force_bytes, force_str  # String encoding utilities
 from django.template.loader import render_to_string  # Render HTML templates to strings
-from django.core.mail import send_mail  # Email sending functionality
+from django.core.mail import send_mass_mail  # Email sending functionality
 from django.conf import settings  # Access project settings
 from .forms import UserRegisterForm, UserUpdateForm, ProfileUpdateForm, AccountDeleteForm, PasswordResetRequestForm, \
     SetNewPasswordForm  # Our custom forms
@@ -120,12 +120,12 @@ def password_reset_request(request):
             associated_users = User.objects.filter(email=email)  # Find users with this email
 
             if associated_users.exists():  # If we found matching users
+                reset_emails = []
                 for user in associated_users:
                     # Create secure reset token and encoded user ID
                     token = default_token_generator.make_token(user)  # One-time use token
                     uid = urlsafe_base64_encode(force_bytes(user.pk))  # Safe user ID for URL
 
-
                     reset_url = request.build_absolute_uri(
                         f'/users/password-reset-confirm/{uid}/{token}/'
                     )
@@ -137,20 +137,16 @@ def password_reset_request(request):
                         'reset_url': reset_url,
                         'site_name': 'SwapDonateRent'
                     })
-
-                    try:
-
-                        send_mail(
-                            subject,
-                            message,
-                            settings.DEFAULT_FROM_EMAIL,
-                            [email],
-                            fail_silently=False,
-                        )
-                        messages.success(request, 'Password reset email sent! Check your inbox for instructions.')
-                        return redirect('users:login')  # Back to login page
-                    except Exception as e:
-                        messages.error(request, 'Failed to send email. Please try again later.')
+                    reset_emails.append((subject, message, settings.DEFAULT_FROM_EMAIL, [user.email]))
+
+                try:
+                    # One email per account with this address, all handed over at once. With the
+                    # queued backend this only stores them; send_queued_email does the sending.
+                    send_mass_mail(reset_emails, fail_silently=False)
+                    messages.success(request, 'Password reset email sent! Check your inbox for instructions.')
+                    return redirect('users:login')  # Back to login page
+                except Exception as e:
+                    messages.error(request, 'Failed to send email. Please try again later.')
             else:
                 messages.error(request, 'No account found with that email address.')
     else: